@@ -0,0 +1,260 @@
+"""
+端到端性能基准：在本地的 mock_xai_server 上以非交互方式运行 async_main 的完整流程。
+
+报告总耗时、各阶段耗时、各类API调用的次数和延迟、写入的字节数以及峰值RSS，
+并可以与保存的基准结果比较。
+
+用法:
+    python benchmark.py --runs 3 --latency 0.2 --tokens-per-sec 400
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.1
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import xAI_Engineer
+from mock_xai_server import MockXAIServer, Scenario, classify_messages
+
+# 计入阶段耗时的流程函数，一个阶段可以对应多个函数（--pipeline 时由流式执行器执行计划）
+STAGES = {
+    'planning': ('async_plan_project',),
+    'structure': ('async_determine_project_structure',),
+    'sizes': ('async_estimate_file_sizes',),
+    'plan': ('async_decompose_goal',),
+    'execute': ('async_execute_plan', 'async_execute_plan_stream'),
+}
+
+# 与基准比较时检查的指标（越小越好）
+COMPARED_METRICS = ['wall_time', 'api_calls', 'peak_rss_kb'] + [f"stage_{stage}" for stage in STAGES]
+
+
+class CountingClient(xAI_Engineer.AsyncGrokClient):
+    """记录每次API调用的类型和延迟的AsyncGrokClient"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    async def chat(self, messages, bypass_cache=False, **options):
+        start = time.perf_counter()
+        try:
+            return await super().chat(messages, bypass_cache, **options)
+        finally:
+            self.calls.append((classify_messages(messages), time.perf_counter() - start))
+
+    async def stream_chat(self, messages, **options):
+        start = time.perf_counter()
+        try:
+            async for chunk in super().stream_chat(messages, **options):
+                yield chunk
+        finally:
+            self.calls.append((classify_messages(messages), time.perf_counter() - start))
+
+
+@contextlib.contextmanager
+def timed_stages(timings):
+    """在运行期间替换流程函数，记录每个阶段的耗时"""
+    originals = {}
+
+    def wrap(stage, function):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+        return wrapper
+
+    for stage, names in STAGES.items():
+        for name in names:
+            originals[name] = getattr(xAI_Engineer, name)
+            setattr(xAI_Engineer, name, wrap(stage, originals[name]))
+    try:
+        yield timings
+    finally:
+        for name, function in originals.items():
+            setattr(xAI_Engineer, name, function)
+
+
+def _folder_bytes(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _peak_rss_kb():
+    # resource 只在Unix上可用，其他平台不报告峰值RSS
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def _auto_confirm(prompt, data=None):
+    return True
+
+
+def run_once(server, goal, stream, workers, quiet=True, pipeline=False):
+    """在临时目录中运行一次完整流程，返回该次运行的指标"""
+    server.reset_stats()
+    client = CountingClient(url=server.url)
+    timings = {}
+    previous_workers = xAI_Engineer.MAX_WORKERS
+    with tempfile.TemporaryDirectory() as workdir:
+        xAI_Engineer.MAX_WORKERS = workers
+        output = open(os.devnull, 'w') if quiet else sys.stdout
+        try:
+            with timed_stages(timings), contextlib.redirect_stdout(output):
+                start = time.perf_counter()
+                project_folder = asyncio.run(xAI_Engineer.async_main(goal, _auto_confirm, client, stream=stream,
+                                                                     output_root=workdir, pipeline=pipeline))
+                wall_time = time.perf_counter() - start
+        finally:
+            xAI_Engineer.MAX_WORKERS = previous_workers
+            if quiet:
+                output.close()
+        bytes_written = _folder_bytes(project_folder) if project_folder else 0
+
+    calls = {}
+    for kind, latency in client.calls:
+        calls.setdefault(kind, []).append(latency)
+    result = {
+        'wall_time': wall_time,
+        'api_calls': len(client.calls),
+        'server_requests': server.snapshot_stats()['requests'],
+        'bytes_written': bytes_written,
+        'peak_rss_kb': _peak_rss_kb(),
+        'calls': {kind: {'count': len(values), 'mean': statistics.mean(values), 'max': max(values)}
+                  for kind, values in calls.items()},
+    }
+    for stage in STAGES:
+        result[f"stage_{stage}"] = timings.get(stage, 0.0)
+    return result
+
+
+def summarize(results):
+    """多次运行取中位数"""
+    summary = {}
+    for key in results[0]:
+        if key == 'calls':
+            continue
+        summary[key] = statistics.median(result[key] for result in results)
+    summary['calls'] = results[-1]['calls']
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """返回超出基准 tolerance 比例的指标列表"""
+    regressions = []
+    for key in COMPARED_METRICS:
+        if key not in baseline or key not in summary:
+            continue
+        old, new = baseline[key], summary[key]
+        if old > 0 and (new - old) / old > tolerance:
+            regressions.append((key, old, new))
+    return regressions
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'metric':<22}{'value':>14}{'baseline':>14}{'change':>10}")
+    for key, value in summary.items():
+        if key == 'calls':
+            continue
+        line = f"{key:<22}{value:>14.3f}"
+        if baseline and key in baseline:
+            old = baseline[key]
+            change = f"{(value - old) / old * 100:+.1f}%" if old else ''
+            line += f"{old:>14.3f}{change:>10}"
+        print(line)
+    print()
+    print(f"{'api call':<22}{'count':>8}{'mean (s)':>12}{'max (s)':>12}")
+    for kind, stats in sorted(summary['calls'].items()):
+        print(f"{kind:<22}{stats['count']:>8}{stats['mean']:>12.3f}{stats['max']:>12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of xAI_Engineer against a mock server.')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--goal', default='A command line tool that exercises many modules')
+    parser.add_argument('--stream', action='store_true', help='use streaming generation')
+    parser.add_argument('--pipeline', action='store_true', help='execute steps while the plan is streamed')
+    parser.add_argument('--workers', type=int, default=xAI_Engineer.MAX_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--tokens-per-sec', type=float, default=2000.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='probability of a slow (tail latency) request')
+    parser.add_argument('--slow-factor', type=float, default=5.0, help='latency multiplier of slow requests')
+    parser.add_argument('--hedge', type=float, help='hedge file generation calls at this latency percentile')
+    parser.add_argument('--combined-planning', action='store_true',
+                        help='get the structure and file sizes from one structured-output call')
+    parser.add_argument('--rate-limit', type=int, help='mock server requests per minute')
+    parser.add_argument('--max-output-chars', type=int, help='mock model output limit (forces continuations)')
+    parser.add_argument('--modules', type=int, default=8)
+    parser.add_argument('--module-size', type=int, default=2048)
+    parser.add_argument('--main-chunks', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='compare against this baseline JSON file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed regression ratio')
+    parser.add_argument('--verbose', action='store_true', help='show the pipeline output')
+    args = parser.parse_args()
+
+    scenario = Scenario(args.modules, args.module_size, args.main_chunks)
+    server = MockXAIServer(('127.0.0.1', 0), scenario, latency=args.latency, jitter=args.jitter,
+                           tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate, seed=args.seed,
+                           requests_per_minute=args.rate_limit, max_output_chars=args.max_output_chars,
+                           slow_rate=args.slow_rate, slow_factor=args.slow_factor).start()
+    if args.hedge is not None:
+        xAI_Engineer.HEDGE_PERCENTILE = args.hedge
+    if args.combined_planning:
+        xAI_Engineer.COMBINED_PLANNING = True
+    try:
+        results = []
+        for i in range(args.runs):
+            result = run_once(server, args.goal, args.stream, args.workers, quiet=not args.verbose,
+                              pipeline=args.pipeline)
+            print(f"run {i + 1}/{args.runs}: {result['wall_time']:.3f}s, {result['api_calls']} API calls")
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    summary = summarize(results)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print()
+    print_summary(summary, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=4)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if baseline:
+        regressions = compare(summary, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for key, old, new in regressions:
+                print(f"  {key}: {old:.3f} -> {new:.3f}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
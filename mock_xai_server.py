@@ -0,0 +1,396 @@
+"""
+本地的xAI API替身：一个兼容OpenAI chat completions接口的HTTP服务器，用于在不访问 api.x.ai
+的情况下测量和回归测试 xAI_Engineer.py 的性能。
+
+响应来源:
+- 脚本化的场景（Scenario）：根据请求的类型（目录结构、文件大小估算、计划、文件内容）生成一个合成项目
+- 录制的响应：--replay-cache 指向一个 ResponseCache 目录（xAI_Engineer.CACHE_DIR），
+  命中时按原样回放真实API的响应
+
+可以配置延迟、抖动、错误率和生成速度，并支持流式（server-sent events）响应。
+
+用法:
+    python mock_xai_server.py --port 8000 --latency 0.5 --jitter 0.2 --error-rate 0.05
+然后把 xAI_Engineer.API_URL 设置为 http://127.0.0.1:8000/v1/chat/completions
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from xAI_Engineer import _CONTINUE_PROMPT, ResponseCache, estimate_tokens
+
+
+def classify_messages(messages):
+    """根据system prompt判断请求属于哪个阶段：project（结构和大小）、structure、sizes、plan 或 file"""
+    system = messages[0].get('content', '') if messages else ''
+    if 'directory structure and file size estimates' in system:
+        return 'project'
+    if 'project directory structure based on' in system:
+        return 'structure'
+    if 'software project estimation' in system:
+        return 'sizes'
+    if 'break down the user' in system:
+        return 'plan'
+    return 'file'
+
+
+class Scenario:
+    """
+    脚本化的合成项目：modules 个Python模块，以及由 main_chunks 个tmp分块拼接而成的 main.py。
+
+    每个文件的内容是可以编译的Python代码，大小约为 module_size / chunk_size 字节。
+    """
+
+    def __init__(self, modules=8, module_size=2048, main_chunks=3, chunk_size=2048, top_level_dir='bench_project'):
+        self.top_level_dir = top_level_dir
+        self.modules = [f"pkg/module_{i}.py" for i in range(modules)]
+        self.module_size = module_size
+        self.chunks = [f"main_{i}.tmp" for i in range(1, main_chunks + 1)]
+        self.chunk_size = chunk_size
+
+    def structure(self):
+        package = {'__init__.py': {}}
+        for path in self.modules:
+            package[os.path.basename(path)] = {}
+        return {self.top_level_dir: {'README.md': {}, 'requirements.txt': {}, 'main.py': {}, 'pkg': package}}
+
+    def sizes(self):
+        sizes = {f"{self.top_level_dir}/{path}": f"{self.module_size / 1024:.1f} KB" for path in self.modules}
+        sizes[f"{self.top_level_dir}/main.py"] = f"{len(self.chunks) * self.chunk_size / 1024:.1f} KB"
+        sizes[f"{self.top_level_dir}/README.md"] = "1 KB"
+        sizes[f"{self.top_level_dir}/requirements.txt"] = "100 bytes"
+        return sizes
+
+    def plan(self, chunked=True):
+        """chunked 为False时（提示词要求不拆分tmp文件）main.py只用一个创建步骤"""
+        tasks = []
+        for i, path in enumerate(self.modules):
+            tasks.append(f"Create a new file '{path}' and write module {i}.\n"
+                         f"     - Implement `func_{i}_0(x: int) -> int` and related helpers.")
+        if not chunked and self.chunks:
+            modules = ', '.join(f"'{path}'" for path in self.modules)
+            tasks.append(f"Create a new file 'main.py' and write the main program.\n"
+                         f"     - Import the helpers from {modules}.")
+        for i, chunk in enumerate(self.chunks if chunked else []):
+            details = "     - This file will be appended to 'main.py'."
+            if i == 0:
+                modules = ', '.join(f"'{path}'" for path in self.modules)
+                details = f"     - Import the helpers from {modules}.\n" + details
+            tasks.append(f"Create a temporary file '{chunk}' and write part {i + 1} of the main program.\n{details}")
+        for chunk in self.chunks if chunked else []:
+            tasks.append(f"Append the content of '{chunk}' to 'main.py'.")
+        for chunk in self.chunks if chunked else []:
+            tasks.append(f"Delete '{chunk}'.")
+        tasks.append("Create a new file 'README.md' and write project documentation.\n"
+                     "     - Include instructions for running the program")
+        tasks.append("Create a new file 'requirements.txt' and write dependencies.")
+        return '\n'.join(f"{i}. {task}" for i, task in enumerate(tasks, 1))
+
+    def _python(self, prefix, size):
+        lines = [f'"""Generated {prefix}."""', '']
+        i = 0
+        while sum(len(line) + 1 for line in lines) < size:
+            lines.append(f"def func_{prefix}_{i}(x: int) -> int:")
+            lines.append(f'    """Return x shifted by {i}."""')
+            lines.append(f"    return x + {i}")
+            lines.append('')
+            i += 1
+        return '\n'.join(lines)
+
+    def file(self, path):
+        path = path.replace('\\', '/')
+        name = os.path.basename(path)
+        if name == 'README.md':
+            return "# Bench project\n\nRun `python main.py`.\n"
+        if name == 'requirements.txt':
+            return "\n"
+        if name == 'main.py' and self.chunks:
+            # 计划的 tmp 分块链被合并为一次写入时，直接返回拼接后的内容
+            return '\n'.join(self.file(chunk) for chunk in self.chunks)
+        match = re.match(r'main_(\d+)\.tmp$', name)
+        if match:
+            return self._python(f"main_{match.group(1)}", self.chunk_size)
+        match = re.match(r'module_(\d+)\.py$', name)
+        if match:
+            return self._python(match.group(1), self.module_size)
+        return "# empty\n"
+
+    def reply(self, kind, messages):
+        if kind == 'project':
+            return json.dumps({'structure': self.structure(), 'sizes': self.sizes()}, indent=4)
+        if kind == 'structure':
+            return '```json\n' + json.dumps(self.structure(), indent=4) + '\n```'
+        if kind == 'sizes':
+            return '```json\n' + json.dumps(self.sizes(), indent=4) + '\n```'
+        if kind == 'plan':
+            return self.plan(chunked='Do not create temporary files' not in messages[0].get('content', ''))
+        match = re.search(r'You are working on the file: "([^"]+)"', messages[-1].get('content', ''))
+        language = 'python'
+        path = match.group(1) if match else ''
+        if not path.endswith(('.py', '.tmp')):
+            language = ''
+        return f"```{language}\n{self.file(path)}\n```"
+
+
+class MockXAIServer(ThreadingHTTPServer):
+    """
+    参数:
+    - scenario: 脚本化场景
+    - replay_cache: 可选的ResponseCache，命中时回放录制的响应
+    - latency / jitter: 每个请求的基础延迟和均匀抖动（秒）
+    - tokens_per_sec: 模拟的生成速度，为0时不按输出长度增加延迟
+    - error_rate: 返回429/503错误的概率
+    - stream_chunk_tokens: 流式响应中每个数据块包含的token数
+    - requests_per_minute: 模拟服务端的每分钟请求数限额（滑动窗口），超出时返回带 retry-after 的429，
+      所有响应都带 x-ratelimit-* 头；为None时不限制
+    - max_output_chars: 模拟模型生成文件内容时的输出长度上限，超出时截断响应并返回 finish_reason 'length'，
+      续写请求从上一段的末尾继续；请求中的 max_tokens 同样生效。为None时不截断
+    - slow_rate / slow_factor: 模拟长尾延迟，以 slow_rate 的概率把一个请求的延迟乘以 slow_factor
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, scenario=None, replay_cache=None, latency=0.0, jitter=0.0,
+                 tokens_per_sec=0.0, error_rate=0.0, stream_chunk_tokens=4, seed=None, requests_per_minute=None,
+                 max_output_chars=None, slow_rate=0.0, slow_factor=5.0):
+        super().__init__(address, MockXAIHandler)
+        self.scenario = scenario or Scenario()
+        self.replay_cache = replay_cache
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.stream_chunk_tokens = stream_chunk_tokens
+        self.requests_per_minute = requests_per_minute
+        self.max_output_chars = max_output_chars
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.window = collections.deque()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'replayed': 0, 'by_kind': {}}
+
+    def snapshot_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def _record(self, kind, error=False, replayed=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['by_kind'][kind] = self.stats['by_kind'].get(kind, 0) + 1
+            if error:
+                self.stats['errors'] += 1
+            if replayed:
+                self.stats['replayed'] += 1
+
+    def _draw(self):
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.random.random() < self.slow_rate:
+                delay *= self.slow_factor
+            fail = self.random.random() < self.error_rate
+            status = self.random.choice([429, 503])
+        return delay, fail, status
+
+    def _admit(self):
+        """按滑动窗口检查每分钟请求数，返回 (是否放行, 响应头)"""
+        if not self.requests_per_minute:
+            return True, {}
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            admitted = len(self.window) < self.requests_per_minute
+            if admitted:
+                self.window.append(now)
+            else:
+                self.stats['rate_limited'] += 1
+            reset = 60 - (now - self.window[0]) if self.window else 0
+            headers = {
+                'x-ratelimit-limit-requests': str(self.requests_per_minute),
+                'x-ratelimit-remaining-requests': str(self.requests_per_minute - len(self.window)),
+                'x-ratelimit-reset-requests': f"{reset:.3f}s",
+            }
+        if not admitted:
+            headers['Retry-After'] = f"{reset:.3f}"
+        return admitted, headers
+
+    def completion(self, data):
+        """返回 (kind, 内容, finish_reason, 是否回放)"""
+        messages = data.get('messages', [])
+        kind = classify_messages(messages)
+        if self.replay_cache is not None:
+            key = self.replay_cache.request_key(data)
+            cached = self.replay_cache.get(key)
+            if cached is not None:
+                choice = cached['choices'][0]
+                return kind, choice['message']['content'], choice.get('finish_reason', 'stop'), True
+        offset = 0
+        if len(messages) > 2 and messages[-1].get('content') == _CONTINUE_PROMPT:
+            # 续写请求：在完整的响应中找到上一段的末尾，从那里继续
+            tail = messages[-2].get('content', '')
+            messages = messages[:-2]
+            content = self.scenario.reply(kind, messages)
+            index = content.find(tail)
+            offset = index + len(tail) if index >= 0 else len(content)
+        else:
+            content = self.scenario.reply(kind, messages)
+        if kind != 'file':
+            return kind, content, 'stop', False
+        content, finish_reason = self._truncate(content[offset:], data.get('max_tokens'))
+        return kind, content, finish_reason, False
+
+    def _truncate(self, content, max_tokens):
+        limits = [limit for limit in (self.max_output_chars, max_tokens and max_tokens * 4) if limit]
+        if limits and len(content) > min(limits):
+            return content[:min(limits)], 'length'
+        return content, 'stop'
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class MockXAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.server.snapshot_stats())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': 'invalid JSON'})
+            return
+
+        kind, content, finish_reason, replayed = server.completion(data)
+        admitted, limit_headers = server._admit()
+        if not admitted:
+            self._send_json(429, {'error': {'message': 'rate limit exceeded'}}, limit_headers)
+            return
+        delay, fail, status = server._draw()
+        time.sleep(delay)
+        if fail:
+            server._record(kind, error=True)
+            self._send_json(status, {'error': {'message': 'injected error'}}, dict(limit_headers, **{'Retry-After': '1'}))
+            return
+        server._record(kind, replayed=replayed)
+
+        prompt_tokens = sum(estimate_tokens(str(m.get('content', ''))) for m in data.get('messages', []))
+        completion_tokens = estimate_tokens(content)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+        model = data.get('model', 'mock')
+
+        if not data.get('stream'):
+            if server.tokens_per_sec:
+                time.sleep(completion_tokens / server.tokens_per_sec)
+            self._send_json(200, {
+                'id': 'mock',
+                'object': 'chat.completion',
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': finish_reason}],
+                'usage': usage
+            }, limit_headers)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for key, value in limit_headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        step = server.stream_chunk_tokens * 4
+        for i in range(0, len(content), step):
+            piece = content[i:i + step]
+            if server.tokens_per_sec:
+                time.sleep(estimate_tokens(piece) / server.tokens_per_sec)
+            event = {'id': 'mock', 'object': 'chat.completion.chunk', 'model': model,
+                     'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}
+            self._send_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+        final = {'id': 'mock', 'object': 'chat.completion.chunk', 'model': model,
+                 'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}], 'usage': usage}
+        self._send_chunk(f"data: {json.dumps(final)}\n\n".encode('utf-8'))
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b'')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the xAI chat completions API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='base latency per request (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='uniform latency jitter (seconds)')
+    parser.add_argument('--tokens-per-sec', type=float, default=0.0, help='simulated generation speed')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 429/503 response')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='probability of a slow (tail latency) request')
+    parser.add_argument('--slow-factor', type=float, default=5.0, help='latency multiplier of slow requests')
+    parser.add_argument('--rate-limit', type=int, help='requests per minute before answering 429')
+    parser.add_argument('--max-output-chars', type=int, help='truncate responses with finish_reason "length"')
+    parser.add_argument('--modules', type=int, default=8, help='modules in the scripted project')
+    parser.add_argument('--module-size', type=int, default=2048, help='bytes per scripted module')
+    parser.add_argument('--main-chunks', type=int, default=3, help='tmp chunks appended to main.py')
+    parser.add_argument('--replay-cache', help='ResponseCache directory with recorded responses')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    scenario = Scenario(args.modules, args.module_size, args.main_chunks)
+    replay_cache = ResponseCache(args.replay_cache, ttl=None) if args.replay_cache else None
+    server = MockXAIServer((args.host, args.port), scenario, replay_cache, args.latency, args.jitter,
+                           args.tokens_per_sec, args.error_rate, seed=args.seed,
+                           requests_per_minute=args.rate_limit, max_output_chars=args.max_output_chars,
+                           slow_rate=args.slow_rate, slow_factor=args.slow_factor)
+    print(f"Mock xAI server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+from xAI_Engineer import (PlanStep, StepOp, compile_step, drop_dead_deletes, fold_append_chains,
+                          merge_duplicate_writes)
+
+TOP = 'proj'
+MAPPING = {'main.py': 'main.py', 'big.py': 'big.py'}
+
+CHAIN = ["Create 'big_1.tmp' with the first half of big.py\n- This part will be appended to big.py",
+         "Create 'big_2.tmp' with the second half of big.py",
+         "Append 'big_1.tmp' to 'big.py'",
+         "Append 'big_2.tmp' to 'big.py'",
+         "Delete 'big_1.tmp'",
+         "Delete 'big_2.tmp'"]
+
+
+def _compile(plan):
+    return [compile_step(step, MAPPING, TOP) for step in plan]
+
+
+def test_fold_small_chain_into_one_create():
+    steps = fold_append_chains(_compile(CHAIN), TOP, {'proj/big.py': '2 KB'}, max_bytes=4096)
+    assert len(steps) == 1
+    step = steps[0]
+    assert (step.op, step.path) == (StepOp.CREATE, 'big.py')
+    assert step.sources == CHAIN
+    assert "- Part 1: Create 'big_1.tmp' with the first half of big.py" in step.details
+    assert not any('appended to' in detail for detail in step.details)
+
+
+def test_fold_keeps_large_or_shared_chains():
+    assert len(fold_append_chains(_compile(CHAIN), TOP, {'proj/big.py': '8 KB'}, max_bytes=4096)) == len(CHAIN)
+    # 分块在追加之后又被其他步骤读取，不能合并
+    plan = CHAIN[:4] + ["Append 'big_1.tmp' to 'main.py'"] + CHAIN[4:]
+    assert len(fold_append_chains(_compile(plan), TOP, {'proj/big.py': '2 KB'}, max_bytes=4096)) == len(plan)
+
+
+def test_drop_deletes_of_files_never_created():
+    plan = ["Delete 'never.txt'", "Create 'notes.txt' with notes", "Delete 'notes.txt'", "Delete 'notes.txt'",
+            "Delete 'main.py'"]
+    steps = drop_dead_deletes(_compile(plan), MAPPING, TOP)
+    assert [(step.op, step.path) for step in steps] == [
+        (StepOp.CREATE, 'notes.txt'), (StepOp.DELETE, 'notes.txt'), (StepOp.DELETE, 'main.py')]
+
+
+def test_merge_writes_with_nothing_in_between():
+    plan = ["Create 'main.py' with the entry point", "Create 'big.py' with helpers",
+            "Create 'main.py' adding argument parsing\n- use argparse"]
+    steps = merge_duplicate_writes(_compile(plan))
+    assert [step.path for step in steps] == ['main.py', 'big.py']
+    assert steps[0].task == "Create 'main.py' adding argument parsing"
+    assert steps[0].details == ["- Create 'main.py' with the entry point", "- use argparse"]
+    assert steps[0].sources == [plan[0], plan[2]]
+
+
+def test_merge_stops_at_a_step_that_reads_the_file():
+    steps = [PlanStep(StepOp.CREATE, "Create 'main.py'", path='main.py'),
+             PlanStep(StepOp.APPEND, "Append 'main.py' to 'big.py'", src='main.py', dst='big.py'),
+             PlanStep(StepOp.CREATE, "Create 'main.py' again", path='main.py')]
+    assert merge_duplicate_writes(steps) == steps
@@ -0,0 +1,21 @@
+import pytest
+
+from xAI_Engineer import ConfirmPolicy
+
+
+def test_request_can_only_narrow_the_default_policy():
+    ceiling = {'max_total_kb': 200, 'max_steps': 40}
+    policy = ConfirmPolicy.from_dict({'max_total_kb': 1000, 'max_steps': 10, 'max_files': 5}, ceiling)
+    assert (policy.max_total_kb, policy.max_steps, policy.max_files) == (200, 10, 5)
+    # 不能用None去掉上限
+    assert ConfirmPolicy.from_dict({'max_total_kb': None}, ceiling).max_total_kb == 200
+
+
+def test_request_cannot_approve_what_the_default_rejects():
+    assert not ConfirmPolicy.from_dict({'approve': True}, {'approve': False}).approve
+    assert not ConfirmPolicy.from_dict({'approve': False}, {}).approve
+
+
+def test_limits_must_be_numbers():
+    with pytest.raises(Exception, match='max_steps'):
+        ConfirmPolicy.from_dict({'max_steps': '40'})
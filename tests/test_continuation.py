@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+from xAI_Engineer import ContinuedGeneration
+
+MESSAGES = [{'role': 'user', 'content': 'write main.py'}]
+
+
+def _generate(*parts):
+    """把 parts 作为依次被截断（最后一段正常结束）的输出交给 ContinuedGeneration，返回写出的文件内容"""
+    out = io.StringIO()
+    generation = ContinuedGeneration(MESSAGES, out)
+    for i, part in enumerate(parts):
+        generation.start_part()
+        generation.feed(part)
+        request = generation.next_request('length' if i < len(parts) - 1 else 'stop')
+        assert (request is None) == (i == len(parts) - 1)
+    generation.close()
+    return out.getvalue()
+
+
+def test_parts_are_joined_inside_one_code_block():
+    assert _generate("```python\ndef a():\n    return 1\n", "```python\ndef b():\n    return 2\n```") == \
+        "def a():\n    return 1\ndef b():\n    return 2\n"
+
+
+def test_repeated_lines_are_removed():
+    first = "```python\nimport os\n\ndef load(path):\n    with open(path) as f:\n        return f.read()\n"
+    again = "def load(path):\n    with open(path) as f:\n        return f.read()\n\ndef save():\n    pass\n```"
+    assert _generate(first, again) == \
+        "import os\n\ndef load(path):\n    with open(path) as f:\n        return f.read()\n\ndef save():\n    pass\n"
+
+
+def test_restarted_line_is_removed():
+    first = "```python\ntotal = compute_total(items, tax_ra"
+    again = "total = compute_total(items, tax_rate)\nprint(total)\n```"
+    assert _generate(first, again) == "total = compute_total(items, tax_rate)\nprint(total)\n"
+
+
+def test_single_repeated_line_is_kept():
+    first = "```python\ndef a(result):\n    return result\n"
+    again = "    return result\n\ndef b():\n    pass\n```"
+    assert _generate(first, again) == "def a(result):\n    return result\n    return result\n\ndef b():\n    pass\n"
+
+
+def test_short_overlap_is_kept():
+    first = "```python\nx = [1, 2,"
+    again = " 2, 3]\n```"
+    assert _generate(first, again) == "x = [1, 2, 2, 3]\n"
+
+
+def test_size_limit():
+    out = io.StringIO()
+    generation = ContinuedGeneration(MESSAGES, out, max_bytes=10)
+    generation.start_part()
+    with pytest.raises(Exception, match='maximum file size'):
+        generation.feed("```python\n" + "x = 1\n" * 10)
@@ -0,0 +1,44 @@
+import asyncio
+
+from xAI_Engineer import (EventLog, RingBufferLogHandler, _current_events, flush_events, log_event,
+                          process_events)
+
+
+def test_flush_waits_for_earlier_events():
+    handler = RingBufferLogHandler()
+    events = EventLog([handler], level='debug')
+    for i in range(100):
+        events.emit(f"event {i}")
+    events.flush()
+    assert [event['message'] for event in handler.events] == [f"event {i}" for i in range(100)]
+
+
+def test_flush_events_does_not_block_the_loop():
+    handler = RingBufferLogHandler()
+    events = EventLog([handler])
+
+    async def run():
+        token = _current_events.set(events)
+        try:
+            log_event("inside the run", step_count=1)
+            ticks = asyncio.ensure_future(asyncio.sleep(0))
+            await flush_events()
+            return ticks.done()
+        finally:
+            _current_events.reset(token)
+
+    assert asyncio.run(run())
+    assert [event['message'] for event in handler.events] == ["inside the run"]
+
+
+def test_process_events_collect_messages_outside_runs():
+    handler = RingBufferLogHandler()
+
+    async def run():
+        async with process_events('batch', [handler]):
+            log_event("[batch] a: failed", 'error', job='a')
+        return _current_events.get()
+
+    assert asyncio.run(run()) is None
+    event, = handler.events
+    assert (event['run'], event['level'], event['job']) == ('batch', 'error', 'a')
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from xAI_Engineer import FenceWriter, parse_content_from_response
+
+RESPONSES = [
+    "Here you go:\n```python\nprint('hi')\n```\nThat's it.",
+    "```\nfirst\n```\ntext\n```js\nsecond\n```",
+    "no code block, just text  \n",
+    "```python\r\nwindows = True\r\n```\r\n",
+    "```python\ntruncated = True\n",
+    "```inline``` and `ticks` ```py\nsecond```",
+]
+
+
+def _stream(response, size):
+    """把 response 按 size 个字符一段写入FenceWriter，返回写出的内容"""
+    out = io.StringIO()
+    writer = FenceWriter(out)
+    for i in range(0, len(response), size):
+        writer.feed(response[i:i + size])
+    assert writer.close() == len(out.getvalue())
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('response', RESPONSES)
+def test_matches_the_non_streaming_parser(response):
+    expected = _stream(response, len(response))
+    # 没有结束标记的代码块是被截断的输出，非流式的解析会忽略它
+    if response.count('```') % 2 == 0:
+        assert expected == parse_content_from_response(response.replace('\r\n', '\n'))
+    for size in (1, 2, 3, 5):
+        assert _stream(response, size) == expected
+
+
+def test_truncated_block_keeps_the_received_code():
+    assert _stream("```python\ntruncated = True\n", 4) == "truncated = True\n"
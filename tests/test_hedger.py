@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from xAI_Engineer import Hedger, routing_hints
+
+STAGE = 'get_content_from_ai'
+
+
+def _hedger():
+    hedger = Hedger(percentile=0.5, budget=5, min_samples=1, stages=[STAGE])
+    hedger.observe(STAGE, 0.01)
+    return hedger
+
+
+def _call(hedger, *behaviours):
+    """依次用 behaviours 中的协程函数处理第1次、第2次……请求"""
+    calls = []
+
+    def request():
+        calls.append(len(calls))
+        return behaviours[len(calls) - 1]()
+
+    async def run():
+        with routing_hints(stage=STAGE):
+            return await hedger.call(request)
+
+    return asyncio.run(run()), len(calls)
+
+
+def test_fast_request_is_not_hedged():
+    async def fast():
+        return 'fast'
+
+    hedger = _hedger()
+    assert _call(hedger, fast) == ('fast', 1)
+    assert hedger.hedges == 0
+
+
+def test_slow_request_is_hedged_and_hedge_wins():
+    async def slow():
+        await asyncio.sleep(1)
+        return 'slow'
+
+    async def fast():
+        return 'hedge'
+
+    hedger = _hedger()
+    assert _call(hedger, slow, fast) == ('hedge', 2)
+    assert (hedger.hedges, hedger.wins) == (1, 1)
+
+
+def test_success_wins_when_both_finish_together():
+    for _ in range(20):
+        release = None
+
+        async def failing():
+            nonlocal release
+            release = asyncio.Event()
+            await release.wait()
+            raise RuntimeError('primary failed')
+
+        async def succeeding():
+            release.set()
+            return 'hedge'
+
+        assert _call(_hedger(), failing, succeeding) == ('hedge', 2)
+
+
+def test_cancelled_primary_does_not_hide_the_hedge():
+    async def cancelled():
+        await asyncio.sleep(0.05)
+        raise asyncio.CancelledError()
+
+    async def succeeding():
+        await asyncio.sleep(0.05)
+        return 'hedge'
+
+    assert _call(_hedger(), cancelled, succeeding) == ('hedge', 2)
+
+
+def test_error_is_raised_when_both_fail():
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError, match='failed'):
+        _call(_hedger(), failing, failing)
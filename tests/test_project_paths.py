@@ -0,0 +1,42 @@
+import io
+import os
+
+import pytest
+
+import xAI_Engineer
+from xAI_Engineer import ArchiveSink, create_project_folder, escapes_project
+
+
+def test_paths_outside_the_project():
+    assert not escapes_project('pkg/module.py')
+    assert not escapes_project('notes..txt')
+    for path in ('../evil.py', 'pkg/../../evil.py', '/etc/passwd', '..', 'pkg\\..\\..\\evil.py'):
+        assert escapes_project(path)
+
+
+def test_top_level_directory_must_stay_in_the_output_root(tmp_path):
+    for name in ('..', '../outside', '/tmp/x', '.'):
+        with pytest.raises(Exception, match='top-level directory'):
+            create_project_folder({name: {'main.py': {}}}, str(tmp_path), create=False)
+
+
+def test_steps_outside_the_project_fail(tmp_path, monkeypatch):
+    structure = {'proj': {'main.py': {}, '../escaped.py': {}}}
+    folder, adjusted, top_level_dir = create_project_folder(structure, str(tmp_path / 'out'))
+    xAI_Engineer.create_directories(folder, adjusted)
+    filename_to_path = xAI_Engineer.build_filename_to_path_mapping(adjusted)
+    monkeypatch.setattr(xAI_Engineer, 'get_content_from_ai', lambda step, filename, path, *args, **kwargs: 'ok\n')
+    plan = ["1. Create a new file 'main.py' and write the main program.",
+            "2. Create a new file '../../evil.py' and write anything.",
+            "3. Append the content of 'main.py' to '../../evil.py'."]
+    summary = xAI_Engineer.execute_plan(plan, folder, adjusted, filename_to_path, 'goal', top_level_dir, staged=True)
+    assert (summary['ok'], summary['failed']) == (1, 2)
+    assert sorted(os.listdir(tmp_path)) == ['out']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['proj']
+
+
+def test_archive_rejects_entries_outside():
+    sink = ArchiveSink(io.BytesIO(), 'zip')
+    with pytest.raises(Exception, match='outside'):
+        sink.add('proj/../../evil.py', 'x')
+    sink.abort()
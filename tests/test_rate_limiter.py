@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from mock_xai_server import MockXAIServer, Scenario
+from xAI_Engineer import AsyncGrokClient, GrokClient, RateLimiter
+
+FILE_REQUEST = [{'role': 'system', 'content': 'You are a coder.'},
+                {'role': 'user', 'content': "Create a new file 'pkg/module_0.py' and write module 0."}]
+
+
+@pytest.fixture
+def server():
+    server = MockXAIServer(('127.0.0.1', 0), Scenario(2, 4096)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_release_with_hold_keeps_the_slot():
+    limiter = RateLimiter(initial_concurrency=4)
+    limiter.acquire()
+    limiter.release(200, {}, hold=True)
+    assert limiter.in_flight == 1
+    limiter.finish()
+    assert limiter.in_flight == 0
+
+
+def test_stream_holds_slot_until_closed(server):
+    limiter = RateLimiter(initial_concurrency=4)
+    client = GrokClient(url=server.url, rate_limiter=limiter)
+    chunks = client.stream_chat(FILE_REQUEST)
+    next(chunks)
+    assert limiter.in_flight == 1
+    for _ in chunks:
+        pass
+    assert limiter.in_flight == 0
+    client.chat(FILE_REQUEST)
+    assert limiter.in_flight == 0
+    client.close()
+
+
+def test_async_stream_holds_slot_until_closed(server):
+    limiter = RateLimiter(initial_concurrency=4)
+
+    async def run():
+        client = AsyncGrokClient(url=server.url, rate_limiter=limiter)
+        seen = []
+        async for _ in client.stream_chat(FILE_REQUEST):
+            seen.append(limiter.in_flight)
+        await client.chat(FILE_REQUEST, bypass_cache=True)
+        await client.close()
+        return seen
+
+    seen = asyncio.run(run())
+    assert seen and max(seen) == 1
+    assert limiter.in_flight == 0
+
+
+def test_no_local_limit_takes_the_server_limit_without_debt():
+    limiter = RateLimiter(requests_per_minute=None, tokens_per_minute=None, initial_concurrency=4)
+    for _ in range(3):
+        limiter.acquire(100)
+        limiter.release(200, {})
+    assert limiter.request_budget is None and limiter.token_budget is None
+    limiter.acquire()
+    limiter.release(200, {'x-ratelimit-limit-requests': '60', 'x-ratelimit-limit-tokens': '1000'})
+    assert (limiter.request_budget, limiter.token_budget) == (60, 1000)
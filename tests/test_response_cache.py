@@ -0,0 +1,42 @@
+from xAI_Engineer import ResponseCache, _cache_key
+
+MESSAGES = [{'role': 'system', 'content': 'You are a helper.'}, {'role': 'user', 'content': 'Write main.py'}]
+
+
+def _request(**options):
+    data = {'model': 'grok', 'temperature': 0, 'messages': MESSAGES, 'stream': False}
+    data.update(options)
+    return data
+
+
+def test_key_ignores_whitespace_and_stream():
+    spaced = [dict(message, content=message['content'] + '  \r\n') for message in MESSAGES]
+    assert ResponseCache.request_key(_request()) == ResponseCache.request_key(_request(messages=spaced))
+    assert ResponseCache.request_key(_request()) == ResponseCache.request_key(_request(stream=True))
+
+
+def test_key_covers_request_options():
+    keys = {
+        ResponseCache.request_key(_request()),
+        ResponseCache.request_key(_request(max_tokens=256)),
+        ResponseCache.request_key(_request(max_tokens=512)),
+        ResponseCache.request_key(_request(response_format={'type': 'json_object'})),
+    }
+    assert len(keys) == 4
+
+
+def test_only_deterministic_requests_are_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    assert _cache_key(cache, _request()) == ResponseCache.request_key(_request())
+    assert _cache_key(cache, _request(temperature=0.7)) is None
+    assert _cache_key(cache, _request(stream=True)) is None
+    assert _cache_key(None, _request()) is None
+
+
+def test_put_and_get(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    key = ResponseCache.request_key(_request(max_tokens=10))
+    assert cache.get(key) is None
+    cache.put(key, {'choices': [{'message': {'content': 'ok'}}]})
+    assert cache.get(key)['choices'][0]['message']['content'] == 'ok'
+    assert cache.get(ResponseCache.request_key(_request())) is None
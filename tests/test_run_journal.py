@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import xAI_Engineer
+from xAI_Engineer import PlanStep, RunJournal, StagingArea, StepOp
+
+STRUCTURE = {'proj': {'main.py': {}, 'main_1.tmp': {}}}
+
+
+def _journal(tmp_path):
+    folder = str(tmp_path / 'proj')
+    os.makedirs(folder)
+    return folder, RunJournal.create(folder, 'goal', STRUCTURE, {'main.py': 1024})
+
+
+def _append_step():
+    return PlanStep(StepOp.APPEND, "Append the content of 'main_1.tmp' to 'main.py'.", src='main_1.tmp', dst='main.py')
+
+
+def test_prepare_resume_truncates_through_staging(tmp_path):
+    folder, journal = _journal(tmp_path)
+    main = os.path.join(folder, 'main.py')
+    with open(main, 'w', encoding='utf-8') as f:
+        f.write('appended before the crash\n')
+    staging = StagingArea(folder)
+    journal.prepare_resume([_append_step()], folder, staging)
+    assert staging.read(main) == ''
+    staging.discard()
+    assert open(main, encoding='utf-8').read() == 'appended before the crash\n'
+    journal.prepare_resume([_append_step()], folder)
+    assert open(main, encoding='utf-8').read() == ''
+    journal.close()
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    folder, journal = _journal(tmp_path)
+    step = PlanStep(StepOp.CREATE, "1. Create a new file 'main.py'.", path='main.py', filename='main.py')
+    journal.record_content(step, 'main.py', 'print(1)\n')
+    journal.close()
+    with open(journal.journal_path, 'a', encoding='utf-8') as f:
+        f.write('{"event": "step", "step": "abc", "sta')
+    loaded = RunJournal.load(folder)
+    assert loaded.content(step) == 'print(1)\n'
+    assert list(loaded.steps) == [RunJournal.step_key(step)]
+    loaded.invalidate(step)
+    loaded.close()
+    lines = open(journal.journal_path, encoding='utf-8').read().splitlines()
+    assert all(line.endswith('}') for line in lines)
+    assert RunJournal.load(folder).content(step) is None
+
+
+def test_step_key_ignores_numbering():
+    a = PlanStep(StepOp.CREATE, "3. Create a new file 'main.py'.", path='main.py')
+    b = PlanStep(StepOp.CREATE, "7. Create a new file 'main.py'.", path='main.py')
+    assert RunJournal.step_key(a) == RunJournal.step_key(b)
+
+
+def test_stale_files_with_crlf_line_endings_are_removed(tmp_path):
+    folder, journal = _journal(tmp_path)
+    step = PlanStep(StepOp.CREATE, "1. Create a new file 'old.py'.", path='old.py', filename='old.py')
+    journal.record_content(step, 'old.py', 'a = 1\nb = 2\n')
+    with open(os.path.join(folder, 'old.py'), 'w', encoding='utf-8', newline='\r\n') as f:
+        f.write('a = 1\nb = 2\n')
+    with open(os.path.join(folder, 'edited.py'), 'w', encoding='utf-8') as f:
+        f.write('edited\n')
+    other = PlanStep(StepOp.CREATE, "2. Create a new file 'edited.py'.", path='edited.py', filename='edited.py')
+    journal.record_content(other, 'edited.py', 'original\n')
+    assert xAI_Engineer._remove_stale_files(['old.py', 'edited.py'], folder, journal) == {'deleted': 1, 'kept': 1}
+    assert not os.path.exists(os.path.join(folder, 'old.py'))
+    journal.close()
+
+
+def test_pipelined_plan_is_journaled_before_steps_finish(tmp_path, monkeypatch):
+    folder, journal = _journal(tmp_path)
+    plan_text = ["Create a new file 'main.py' with the entry point.", "Create a new file 'util.py' with helpers."]
+    seen = []
+
+    async def steps():
+        for step in plan_text:
+            yield step
+
+    async def hanging_step(step, *args, **kwargs):
+        # 运行日志中在执行之前已经有这个步骤；第二个步骤一直不结束，模拟运行中途崩溃
+        seen.append(list(journal.partial_plan or journal.plan))
+        if 'util.py' in step.text:
+            await asyncio.sleep(3600)
+        return 'ok'
+
+    monkeypatch.setattr(xAI_Engineer, 'async_execute_step', hanging_step)
+    run = xAI_Engineer.async_execute_plan_stream(
+        steps(), [], folder, STRUCTURE['proj'], {'main.py': 'main.py'}, 'goal', 'proj', None,
+        index=xAI_Engineer.ProjectIndex(folder), staged=False, journal=journal)
+
+    async def crash():
+        try:
+            await asyncio.wait_for(run, 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(crash())
+    journal.close()
+    assert seen[0][:1] == plan_text[:1]
+    resumed = RunJournal.load(folder)
+    assert resumed.plan == plan_text and not resumed.optimized
+    resumed.close()
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+import xAI_Engineer
+from xAI_Engineer import StagingArea
+
+
+def _project(tmp_path):
+    folder = tmp_path / 'proj'
+    (folder / 'levels').mkdir(parents=True)
+    (folder / 'main.py').write_text('', encoding='utf-8')
+    return str(folder)
+
+
+def test_commit_writes_staged_files(tmp_path):
+    folder = _project(tmp_path)
+    staging = StagingArea(folder)
+    staging.write(os.path.join(folder, 'main.py'), 'print(1)\n')
+    staging.write(os.path.join(folder, 'pkg', 'util.py'), 'X = 1\n')
+    assert staging.commit() == (2, 0)
+    assert open(os.path.join(folder, 'pkg', 'util.py'), encoding='utf-8').read() == 'X = 1\n'
+
+
+def test_directory_target_is_rejected_when_staged(tmp_path):
+    folder = _project(tmp_path)
+    staging = StagingArea(folder)
+    with pytest.raises(Exception, match='is a directory'):
+        staging.write(os.path.join(folder, 'levels'), '{}')
+    staging.write(os.path.join(folder, 'pkg', 'util.py'), 'X = 1\n')
+    with pytest.raises(Exception, match='is a file'):
+        staging.write(os.path.join(folder, 'pkg', 'util.py', 'inner.py'), '')
+    with pytest.raises(Exception, match='is a directory'):
+        staging.write(os.path.join(folder, 'pkg'), '')
+
+
+def test_commit_skips_targets_that_became_directories(tmp_path):
+    folder = _project(tmp_path)
+    staging = StagingArea(folder)
+    staging.write(os.path.join(folder, 'main.py'), 'print(1)\n')
+    staging.write(os.path.join(folder, 'data'), 'x')
+    os.mkdir(os.path.join(folder, 'data'))
+    assert staging.commit() == (1, 0)
+    assert open(os.path.join(folder, 'main.py'), encoding='utf-8').read() == 'print(1)\n'
+
+
+def test_directory_step_fails_alone(tmp_path, monkeypatch):
+    structure = {'proj': {'main.py': {}, 'levels': {'level1.json': {}}}}
+    folder, adjusted, top_level_dir = xAI_Engineer.create_project_folder(structure, str(tmp_path))
+    xAI_Engineer.create_directories(folder, adjusted)
+    filename_to_path = xAI_Engineer.build_filename_to_path_mapping(adjusted)
+    monkeypatch.setattr(xAI_Engineer, 'get_content_from_ai', lambda step, filename, path, *args, **kwargs: 'ok\n')
+    plan = ["1. Create a new file 'main.py' and write the main program.",
+            "2. Create JSON configuration files in 'levels' folder."]
+    summary = xAI_Engineer.execute_plan(plan, folder, adjusted, filename_to_path, 'goal', top_level_dir, staged=True)
+    assert (summary['ok'], summary['failed']) == (1, 1)
+    assert open(os.path.join(folder, 'main.py'), encoding='utf-8').read() == 'ok\n'
+
+
+def test_stream_spools_to_disk_until_commit(tmp_path):
+    folder = _project(tmp_path)
+    target = os.path.join(folder, 'main.py')
+    staging = StagingArea(folder)
+    with staging.stream(target) as f:
+        f.write('print(1)\n')
+        f.flush()
+        spooled = [name for name in os.listdir(folder) if name.endswith('.staged')]
+        assert len(spooled) == 1
+    assert staging.files == {}
+    assert staging.read(target) == 'print(1)\n'
+    assert open(target, encoding='utf-8').read() == ''
+    assert staging.commit() == (1, 0)
+    assert open(target, encoding='utf-8').read() == 'print(1)\n'
+    assert not [name for name in os.listdir(folder) if name.endswith('.staged')]
+
+
+def test_failed_or_discarded_streams_leave_no_files(tmp_path):
+    folder = _project(tmp_path)
+    staging = StagingArea(folder)
+    with pytest.raises(RuntimeError):
+        with staging.stream(os.path.join(folder, 'a.py')) as f:
+            f.write('partial')
+            raise RuntimeError('connection lost')
+    with staging.stream(os.path.join(folder, 'b.py')) as f:
+        f.write('x')
+    staging.discard()
+    assert sorted(os.listdir(folder)) == ['levels', 'main.py']
+
+
+def test_stream_without_spool_stays_in_memory(tmp_path):
+    folder = str(tmp_path / 'not_created')
+    staging = StagingArea(folder, spool=False)
+    with staging.stream(os.path.join(folder, 'main.py')) as f:
+        f.write('print(1)\n')
+    assert staging.snapshot() == {'main.py': 'print(1)\n'}
+    assert not os.path.exists(folder)
+
+
+def test_diskless_staging_ignores_files_on_disk(tmp_path):
+    folder = str(tmp_path / 'proj')
+    os.makedirs(os.path.join(folder, 'levels'))
+    with open(os.path.join(folder, 'main.py'), 'w', encoding='utf-8') as f:
+        f.write('unrelated\n')
+    staging = StagingArea(folder, disk=False)
+    main = os.path.join(folder, 'main.py')
+    assert not staging.exists(main) and staging.read(main) is None
+    staging.append(main, 'print(1)\n')
+    staging.append(main, 'print(2)\n')
+    staging.write(os.path.join(folder, 'levels'), 'a file here\n')
+    assert staging.read(main) == 'print(1)\nprint(2)\n'
+    # 内容在私有的临时目录中，不在内存里，也不在项目目录下
+    assert not staging.files
+    spool_dirs = {os.path.dirname(path) for path in staging.spooled.values()}
+    assert len(spool_dirs) == 1 and not spool_dirs.pop().startswith(folder)
+    tmp_dir = os.path.dirname(staging.spooled[main])
+    staging.discard()
+    assert not os.path.exists(tmp_dir)
+    assert open(main, encoding='utf-8').read() == 'unrelated\n'
+
+
+def test_export_writes_only_the_given_paths_in_order(tmp_path):
+    folder = str(tmp_path / 'proj')
+    staging = StagingArea(folder, disk=False)
+    for name in ('b.py', 'a.py', 'gone.py'):
+        staging.write(os.path.join(folder, name), name)
+    staging.delete(os.path.join(folder, 'gone.py'))
+    entries = []
+
+    class Sink:
+        def add(self, name, content):
+            entries.append((name, content))
+
+    assert staging.export(Sink(), 'proj', ['b.py', 'gone.py', 'a.py', 'b.py', 'never.py']) == 2
+    assert entries == [('proj/b.py', 'b.py'), ('proj/a.py', 'a.py')]
+    staging.discard()
+
+
+def test_archive_placeholders_skip_replacement_files(tmp_path):
+    structure = {'main.py': {}, 'assets': {'logo.png': {}}}
+    files = xAI_Engineer.placeholder_files(str(tmp_path), structure, replacements=False)
+    assert files == {os.path.join(str(tmp_path), 'main.py'): ''}
+    assert os.path.join(str(tmp_path), 'assets', 'logo.png.replacement') in xAI_Engineer.placeholder_files(
+        str(tmp_path), structure)
@@ -0,0 +1,48 @@
+from xAI_Engineer import SubtaskParser, format_plan, parse_subtasks
+
+PLAN = """Here is the plan:
+1. Create 'main.py' with the entry point
+   - Parse the arguments
+   Use argparse
+2. Create 'utils.py'
+
+3. Append 'part_1.tmp' to 'big.py'
+"""
+
+
+def _feed(text, size):
+    """把 text 按 size 个字符一段喂给解析器，返回每次得到的步骤和 close 的结果"""
+    parser = SubtaskParser()
+    steps = []
+    for i in range(0, len(text), size):
+        steps.append(parser.feed(text[i:i + size]))
+    return steps, parser.close()
+
+
+def test_chunk_boundaries_do_not_change_the_steps():
+    expected = ["Create 'main.py' with the entry point\n- Parse the arguments\n- Use argparse",
+                "Create 'utils.py'",
+                "Append 'part_1.tmp' to 'big.py'"]
+    assert parse_subtasks(PLAN) == expected
+    for size in (1, 2, 7, len(PLAN)):
+        fed, closed = _feed(PLAN, size)
+        assert [step for steps in fed for step in steps] + closed == expected
+
+
+def test_step_is_returned_when_the_next_one_starts():
+    parser = SubtaskParser()
+    assert parser.feed("1. Create 'a.py'\n   - details\n") == []
+    # 下一行还不完整时不能确定它是新的步骤
+    assert parser.feed("2. Create") == []
+    assert parser.feed(" 'b.py'\n") == ["Create 'a.py'\n- details"]
+    assert parser.close() == ["Create 'b.py'"]
+
+
+def test_unnumbered_operation_starts_only_the_first_step():
+    assert parse_subtasks("Create 'a.py'\nDelete 'b.tmp'") == ["Create 'a.py'\nDelete 'b.tmp'"]
+    assert parse_subtasks("1. Create 'a.py'\n2. Delete 'b.tmp'") == ["Create 'a.py'", "Delete 'b.tmp'"]
+
+
+def test_formatted_plan_parses_back():
+    plan = parse_subtasks(PLAN)
+    assert parse_subtasks(format_plan(plan)) == plan
@@ -0,0 +1,79 @@
+import asyncio
+import os
+
+import xAI_Engineer
+from xAI_Engineer import PlanStep, RunJournal, StepOp, validate_project
+
+
+def test_valid_project_has_no_errors(tmp_path):
+    sources = {
+        'main.py': 'from pkg.util import helper\nimport os\n\nprint(helper(os.sep))\n',
+        'pkg/__init__.py': '',
+        'pkg/util.py': 'def helper(x):\n    return x\n',
+    }
+    assert validate_project(str(tmp_path), sources=sources) == {}
+
+
+def test_syntax_and_import_errors(tmp_path):
+    sources = {
+        'main.py': 'from pkg.util import missing\nimport pkg.absent\n',
+        'pkg/__init__.py': '',
+        'pkg/util.py': 'def helper(x):\n    return x\n',
+        'broken.py': 'def f(:\n    pass\n',
+    }
+    errors = validate_project(str(tmp_path), sources=sources)
+    assert sorted(errors) == ['broken.py', 'main.py']
+    assert any('missing' in problem for problem in errors['main.py'])
+    assert any('pkg.absent' in problem for problem in errors['main.py'])
+
+
+def test_reads_files_from_disk(tmp_path):
+    (tmp_path / 'ok.py').write_text('x = 1\n', encoding='utf-8')
+    (tmp_path / 'bad.py').write_text('x = (\n', encoding='utf-8')
+    assert list(validate_project(str(tmp_path))) == ['bad.py']
+
+
+def _regenerate(tmp_path, monkeypatch, outcome):
+    folder = str(tmp_path)
+    (tmp_path / 'main.py').write_text('broken(\n', encoding='utf-8')
+    journal = RunJournal.create(folder, 'goal', {'proj': {'main.py': {}}}, {})
+    step = PlanStep(StepOp.CREATE, "1. Create a new file 'main.py'.", path='main.py', filename='main.py')
+
+    async def fake_execute_step(repair, *args, **kwargs):
+        if outcome == 'ok':
+            (tmp_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+        return outcome
+
+    monkeypatch.setattr(xAI_Engineer, 'async_execute_step', fake_execute_step)
+    result = asyncio.run(xAI_Engineer._async_regenerate_step(
+        step, ['main.py:1: invalid syntax'], folder, {}, {}, 'goal', 'proj', None, False, journal))
+    content = journal.content(step)
+    journal.close()
+    return result, content
+
+
+def test_successful_repair_is_journaled(tmp_path, monkeypatch):
+    assert _regenerate(tmp_path, monkeypatch, 'ok') == ('ok', 'print(1)\n')
+
+
+def test_failed_repair_is_not_journaled(tmp_path, monkeypatch):
+    assert _regenerate(tmp_path, monkeypatch, 'failed') == ('failed', None)
+    assert os.path.exists(tmp_path / 'main.py')
+
+
+def test_failed_sync_stream_is_journaled(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    (tmp_path / 'main.py').write_text('', encoding='utf-8')
+    journal = RunJournal.create(folder, 'goal', {'proj': {'main.py': {}}}, {})
+    step = PlanStep(StepOp.CREATE, "1. Create a new file 'main.py'.", path='main.py', filename='main.py')
+
+    def failing_stream(*args, **kwargs):
+        raise Exception("Error: the stream was interrupted")
+
+    monkeypatch.setattr(xAI_Engineer, 'stream_content_to_file', failing_stream)
+    outcome = xAI_Engineer.execute_step(step, folder, {'main.py': {}}, {'main.py': 'main.py'}, 'goal', 'proj',
+                                        stream=True, journal=journal)
+    journal.close()
+    assert outcome == 'failed'
+    record = RunJournal.load(folder).steps[journal.step_key(step)]
+    assert record['status'] == 'failed' and 'interrupted' in record['error']
@@ -3,28 +3,1752 @@ import requests
 import json
 import time
 import re
+import random
+import threading
+import heapq
+import asyncio
+import hashlib
+import tempfile
+import shutil
+import io
+import contextlib
+import ast
+import contextvars
+import functools
+import itertools
+import argparse
+import enum
+import collections
+import queue
+import gzip
+import posixpath
+import tarfile
+import zipfile
+import signal
+import sys
+import uuid
+import urllib.parse
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp是可选依赖，没有安装时异步接口改为在线程池中调用GrokClient
+    aiohttp = None
+
+API_KEY = 'YOUR_XAI_API_KEY'  # Replace with your actual API key
+API_URL = 'https://api.x.ai/v1/chat/completions'
+MODEL = 'grok-beta'
+
+# 模型端点注册表：名字 -> {'url', 'model', 'api_key', 'backend'}。backend 为 BACKENDS 中注册的名字，
+# 默认 'openai'，即任何兼容OpenAI chat completions接口的服务（包括本地服务器）
+MODEL_ENDPOINTS = {
+    'grok': {'url': API_URL, 'model': MODEL, 'api_key': API_KEY},
+}
+DEFAULT_ENDPOINT = 'grok'
+# 主模型出错或超时时改用的端点，None表示不回退
+FALLBACK_ENDPOINT = None
+
+# 按阶段和步骤路由模型，按顺序使用第一条匹配的规则，都不匹配时使用 DEFAULT_ENDPOINT。
+# 条件: stage（阶段名，与追踪的span名相同）、extensions（文件扩展名）、min_size / max_size（估算的字节数）；
+# 目标: endpoint，可选 fallback 和 timeout（秒，主模型超时后改用fallback）。例如:
+# MODEL_ROUTES = [
+#     {'stage': 'estimate_file_sizes', 'endpoint': 'fast'},
+#     {'stage': 'get_content_from_ai', 'extensions': ['.md', '.txt'], 'endpoint': 'fast'},
+#     {'stage': 'get_content_from_ai', 'max_size': 1024, 'endpoint': 'fast', 'fallback': 'grok'},
+#     {'stage': 'get_content_from_ai', 'endpoint': 'grok', 'fallback': 'fast', 'timeout': 120},
+# ]
+MODEL_ROUTES = []
+
+# 429和5xx视为可重试的状态码
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# execute_plan 同时执行的步骤数上限
+MAX_WORKERS = 4
+
+# 为True时以流式方式生成文件内容，边接收边写入磁盘
+STREAM_GENERATION = False
+
+# 生成文件时附带的上下文（步骤中引用的已有文件）的token预算，0表示不附带上下文
+CONTEXT_TOKEN_BUDGET = 3000
+
+# 为True时创建、追加和删除文件的操作先在内存中暂存，计划执行完成后再一次性原子地写入项目目录。
+# 流式生成的文件仍然边生成边写入磁盘（目标旁边的临时文件），提交时改名为目标文件
+STAGED_WRITES = True
+
+# 设置为一个目录即可在每次运行结束时导出追踪数据（JSONL、Chrome trace）和OpenMetrics指标，None表示不追踪
+TRACE_DIR = None
+
+# 结构化事件日志：LOG_FILE 为路径时把每次运行的事件（级别、运行ID、步骤ID、消息）以JSON行异步追加到该文件，
+# 超过 LOG_FILE_MAX_BYTES 时轮转，保留 LOG_FILE_BACKUPS 个旧文件；None表示只输出到控制台。
+# 低于 LOG_LEVEL（debug/info/warning/error）的事件被忽略
+LOG_FILE = None
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LOG_LEVEL = 'info'
+# 等待后台线程写入的事件数上限，超出时丢弃新事件（包括控制台输出），丢弃的数量会输出到stderr
+LOG_QUEUE_SIZE = 10000
+
+# 为True时用一次结构化输出（JSON schema）调用同时得到目录结构和文件大小估算，
+# 校验失败时再回退到分别调用 determine_project_structure 和 estimate_file_sizes。
+# 默认关闭：不是所有后端都支持 response_format 的 json_schema，可以用 --combined-planning 打开
+COMBINED_PLANNING = False
+
+# 为True时在项目目录下维护崩溃安全的运行日志（.xai_journal），中断后可以用 --resume 继续而不重复调用API
+RUN_JOURNAL = True
+
+# 编译计划时，把 tmp分块 -> append -> delete 的链合并为一次直接写入的目标文件估算大小上限（字节），0表示不合并
+FOLD_MAX_BYTES = 4096
+
+# 为True时计划中的大文件也只用一个步骤生成，不再拆分为tmp分块再追加；
+# 生成的输出被截断（finish_reason == 'length'）时自动发送续写请求
+CONTINUATION_GENERATION = True
+
+# 一个文件最多发送的续写请求数，以及续写请求中附带的已生成内容末尾的字符数
+MAX_CONTINUATIONS = 8
+CONTINUATION_TAIL_CHARS = 2000
+
+# 一个文件生成内容的大小上限（字符），超出时该步骤失败
+MAX_FILE_BYTES = 256 * 1024
+
+# 生成文件内容时请求的 max_tokens，None表示使用服务端的默认上限
+MAX_OUTPUT_TOKENS = None
+
+# 为True时在计划执行完成后检查生成的Python文件（语法、项目内模块之间的导入），
+# 只重新生成出错的文件，最多 VALIDATION_RETRIES 轮
+VALIDATE_OUTPUT = True
+VALIDATION_RETRIES = 2
+
+# 为True时以流式方式生成计划，每解析出一个完整的步骤就开始执行，不再等待完整的计划和y/n确认
+PIPELINED_PLANNING = False
+
+# 所有API调用共享的限流：每分钟请求数和token数（None表示不限制，直到响应头给出服务端的限额）
+REQUESTS_PER_MINUTE = None
+TOKENS_PER_MINUTE = None
+
+# 同时在途的API请求数的初始值和上限，限流器在这个范围内按AIMD调整
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 32
+
+# 对冲请求：生成文件内容的调用超过最近延迟的 HEDGE_PERCENTILE 分位数（例如 0.95）仍未返回时，
+# 再发送一次相同的请求，先成功的生效，另一个被取消。None表示不对冲
+HEDGE_PERCENTILE = None
+# 每次运行最多对冲的次数
+HEDGE_BUDGET = 10
+# 每个阶段至少观察到这么多次延迟后才开始对冲
+HEDGE_MIN_SAMPLES = 5
+# 对冲的阶段（流式调用不对冲）
+HEDGE_STAGES = ('get_content_from_ai',)
+
+# 设置为一个目录（例如 '.xai_cache'）即可缓存 temperature 为0的API响应，None表示不缓存
+CACHE_DIR = None
+
+# 设置为一个目录（例如 '.xai_plans'）即可记录确认过的目录结构和计划：新的目标与某个旧目标足够相似时
+# （规范化后的词集合的Jaccard相似度不低于 PLAN_CACHE_THRESHOLD）直接复用它们，只重新生成文件内容
+PLAN_CACHE_DIR = None
+PLAN_CACHE_THRESHOLD = 0.75
+# 超过这个条目数时淘汰最久未使用的条目
+PLAN_CACHE_MAX_ENTRIES = 20000
+
+# 生成服务（--serve）：最多排队的任务数、每个客户端最多同时排队或运行的任务数、
+# 关闭时等待运行中任务的秒数、每个任务保留的输出行数和保留的已结束任务数
+SERVICE_QUEUE_SIZE = 100
+SERVICE_CLIENT_LIMIT = 4
+SERVICE_DRAIN_TIMEOUT = 300
+SERVICE_LOG_LINES = 5000
+SERVICE_KEEP_FINISHED = 1000
+
+
+def _atomic_write(path, text, suffix='.partial'):
+    """先写入同目录下的临时文件并fsync，再用 os.replace 原子地替换目标文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix=suffix)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _backoff_delay(attempt, base, cap):
+    # Full jitter: sleep a random time in [0, base * 2^attempt]
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+_current_tracer = contextvars.ContextVar('xai_tracer', default=None)
+_current_span = contextvars.ContextVar('xai_span', default=None)
+
+# API延迟和阶段耗时直方图的桶边界（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Tracer:
+    """
+    记录一次运行中各阶段和每次API调用的span。
+
+    每个span包含名称、父span、开始/结束时间、耗时和属性（重试次数、HTTP状态码、
+    usage中的prompt/completion token数等）。通过 use_tracer() 设置为当前的tracer后，
+    trace_span() 和 @traced 才会记录数据；没有tracer时它们不做任何事。
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._wall_origin = time.time()
+        self._perf_origin = time.perf_counter()
+
+    def start_span(self, name, parent, attrs):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        span = {
+            'name': name,
+            'span_id': next(self._ids),
+            'parent_id': parent['span_id'] if parent else None,
+            'start': time.perf_counter() - self._perf_origin,
+            'end': None,
+            'duration': None,
+            'tid': id(task) if task is not None else threading.get_ident(),
+            'attrs': dict(attrs)
+        }
+        if parent is not None:
+            span['attrs'].setdefault('stage', parent['name'])
+        return span
+
+    def end_span(self, span):
+        span['end'] = time.perf_counter() - self._perf_origin
+        span['duration'] = span['end'] - span['start']
+        with self._lock:
+            self.spans.append(span)
+
+    def export_jsonl(self, path):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        with open(path, 'w', encoding='utf-8') as f:
+            for span in spans:
+                record = dict(span, start=self._wall_origin + span['start'], end=self._wall_origin + span['end'])
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def export_chrome_trace(self, path):
+        """导出为Chrome trace event格式，可以在 chrome://tracing 或 Perfetto 中打开"""
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            'name': span['name'],
+            'ph': 'X',
+            'ts': span['start'] * 1e6,
+            'dur': span['duration'] * 1e6,
+            'pid': os.getpid(),
+            'tid': span['tid'],
+            'args': span['attrs']
+        } for span in spans]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, default=str)
+
+    def openmetrics(self):
+        """返回OpenMetrics文本格式的计数器和延迟直方图"""
+        with self._lock:
+            spans = list(self.spans)
+        counters = {}
+        histograms = {}
+
+        def count(name, labels, value=1):
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+
+        def observe(name, labels, value):
+            key = (name, tuple(sorted(labels.items())))
+            buckets, total = histograms.get(key, ([0] * len(LATENCY_BUCKETS), [0, 0.0]))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            total[0] += 1
+            total[1] += value
+            histograms[key] = (buckets, total)
+
+        for span in spans:
+            attrs = span['attrs']
+            if span['name'] == 'api_call':
+                labels = {'stage': attrs.get('stage', ''), 'status': str(attrs.get('http_status', 'error'))}
+                count('xai_api_requests', labels)
+                count('xai_api_retries', {'stage': labels['stage']}, attrs.get('retries', 0))
+                count('xai_prompt_tokens', {'stage': labels['stage']}, attrs.get('prompt_tokens', 0))
+                count('xai_completion_tokens', {'stage': labels['stage']}, attrs.get('completion_tokens', 0))
+                if attrs.get('cached'):
+                    count('xai_cache_hits', {'stage': labels['stage']})
+                observe('xai_api_latency_seconds', {'stage': labels['stage']}, span['duration'])
+            else:
+                observe('xai_stage_duration_seconds', {'stage': span['name']}, span['duration'])
+
+        def format_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}_total{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), (buckets, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, value in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {value}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {total[0]}")
+                lines.append(f"{name}_count{format_labels(labels)} {total[0]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total[1]}")
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, trace_dir):
+        """把 trace.jsonl、trace.json（Chrome格式）和 metrics.txt（OpenMetrics）写入trace_dir"""
+        os.makedirs(trace_dir, exist_ok=True)
+        self.export_jsonl(os.path.join(trace_dir, 'trace.jsonl'))
+        self.export_chrome_trace(os.path.join(trace_dir, 'trace.json'))
+        with open(os.path.join(trace_dir, 'metrics.txt'), 'w', encoding='utf-8') as f:
+            f.write(self.openmetrics())
+
+    def stage_summary(self):
+        """返回 {阶段名: (次数, 总耗时)}"""
+        summary = {}
+        with self._lock:
+            for span in self.spans:
+                count, total = summary.get(span['name'], (0, 0.0))
+                summary[span['name']] = (count + 1, total + span['duration'])
+        return summary
+
+
+@contextlib.contextmanager
+def use_tracer(tracer):
+    """在当前上下文（以及其中创建的任务）中使用tracer"""
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+
+@contextlib.contextmanager
+def trace_span(name, **attrs):
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield None
+        return
+    span = tracer.start_span(name, _current_span.get(), attrs)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span['attrs']['error'] = str(e) or type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        tracer.end_span(span)
+
+
+def annotate_span(**attrs):
+    """给当前span添加属性"""
+    span = _current_span.get()
+    if span is not None:
+        span['attrs'].update(attrs)
+
+
+def _count_retry(status):
+    span = _current_span.get()
+    if span is not None:
+        span['attrs']['retries'] = span['attrs'].get('retries', 0) + 1
+        span['attrs'].setdefault('retry_statuses', []).append(status)
+
+
+def _record_usage(result):
+    usage = result.get('usage') or {}
+    annotate_span(prompt_tokens=usage.get('prompt_tokens', 0),
+                  completion_tokens=usage.get('completion_tokens', 0))
+
+
+_routing_hints = contextvars.ContextVar('routing_hints', default={})
+
+
+@contextlib.contextmanager
+def routing_hints(**hints):
+    """在当前上下文中设置ModelRouter选择模型的依据（stage、path、size）"""
+    token = _routing_hints.set(dict(_routing_hints.get(), **hints))
+    try:
+        yield
+    finally:
+        _routing_hints.reset(token)
+
+
+class Hedger:
+    """
+    一次运行的对冲策略：记录每个阶段最近的调用延迟，调用超过 percentile 分位数仍未返回时
+    再发送一次相同的请求，先成功的结果生效，另一个被取消。
+
+    参数:
+    - percentile: 触发对冲的延迟分位数（0~1）
+    - budget: 这次运行最多对冲的次数
+    - min_samples: 一个阶段至少有这么多次延迟记录后才对冲
+    - stages: 对冲的阶段名
+    - window: 每个阶段保留的最近延迟数
+    """
+
+    def __init__(self, percentile=None, budget=None, min_samples=None, stages=None, window=50):
+        self.percentile = HEDGE_PERCENTILE if percentile is None else percentile
+        self.budget = HEDGE_BUDGET if budget is None else budget
+        self.min_samples = HEDGE_MIN_SAMPLES if min_samples is None else min_samples
+        self.stages = set(HEDGE_STAGES if stages is None else stages)
+        self.window = window
+        self.latencies = {}
+        self.hedges = 0
+        self.wins = 0
+
+    def observe(self, stage, latency):
+        self.latencies.setdefault(stage, collections.deque(maxlen=self.window)).append(latency)
+
+    def delay(self, stage):
+        """返回对冲前等待的秒数，不对冲时返回None"""
+        samples = self.latencies.get(stage, ())
+        if stage not in self.stages or self.hedges >= self.budget or len(samples) < max(self.min_samples, 1):
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+
+    async def call(self, request):
+        """调用 request()（返回协程的函数），必要时对冲"""
+        stage = _routing_hints.get().get('stage')
+        delay = self.delay(stage)
+        start = time.monotonic()
+        first = asyncio.ensure_future(request())
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+        except BaseException:
+            first.cancel()
+            raise
+        if done or self.hedges >= self.budget:
+            result = await first
+            self.observe(stage, time.monotonic() - start)
+            return result
+
+        self.hedges += 1
+        annotate_span(hedged=True)
+        hedge_start = time.monotonic()
+        hedge = asyncio.ensure_future(request())
+        pending = {first, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 两个请求可能在同一轮中结束：只要有一个成功就用它的结果，都失败时才抛出异常
+                winner = next((task for task in done if not task.cancelled() and task.exception() is None), None)
+                if winner is not None:
+                    if winner is hedge:
+                        self.wins += 1
+                        annotate_span(hedge_won=True)
+                        self.observe(stage, time.monotonic() - hedge_start)
+                    else:
+                        self.observe(stage, time.monotonic() - start)
+                    return winner.result()
+                for task in done:
+                    if not task.cancelled():
+                        error = task.exception()
+            raise error if error is not None else asyncio.CancelledError()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def summary(self):
+        return f"{self.hedges} hedged requests (budget {self.budget}), {self.wins} won by the hedge"
+
+
+_current_hedger = contextvars.ContextVar('xai_hedger', default=None)
+
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class ConsoleLogHandler:
+    """把事件的消息输出到stdout，和其他处理器一样由后台线程调用。运行中的输出都经过 log_event，顺序不变"""
+
+    synchronous = False
+
+    def handle(self, event):
+        print(event['message'])
+
+    def flush(self):
+        pass
+
+
+class JsonlLogHandler:
+    """把事件以JSON行追加到 path，文件超过 max_bytes 时轮转为 path.1 … path.<backups>"""
+
+    synchronous = False
+
+    def __init__(self, path, max_bytes=None, backups=None):
+        self.path = path
+        self.max_bytes = LOG_FILE_MAX_BYTES if max_bytes is None else max_bytes
+        self.backups = LOG_FILE_BACKUPS if backups is None else backups
+        self._file = None
+        self._size = 0
+
+    def handle(self, event):
+        line = json.dumps(event, ensure_ascii=False, default=str) + '\n'
+        size = len(line.encode('utf-8'))
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._size = self._file.tell()
+        if self._size and self._size + size > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += size
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._size = 0
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+class RingBufferLogHandler:
+    """在内存中保留最近 capacity 个事件，例如供服务或测试查看一次运行的日志"""
+
+    synchronous = False
+
+    def __init__(self, capacity=1000):
+        self.events = collections.deque(maxlen=capacity)
+
+    def handle(self, event):
+        self.events.append(event)
+
+    def flush(self):
+        pass
+
+
+class _LogWriter:
+    """所有EventLog共享的后台线程，按顺序调用异步的处理器。队列已满时丢弃事件并计数"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self._reported = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='xai-log-writer', daemon=True)
+                self._thread.start()
+
+    def put(self, handler, event):
+        self._start()
+        try:
+            self.queue.put_nowait((handler, event))
+        except queue.Full:
+            self.dropped += 1
+
+    def mark(self):
+        """
+        在队列中放入一个标记，返回标记被处理时设置的threading.Event：此时之前提交的事件都已写出并flush。
+        只等待调用之前的事件，不等待其他运行之后提交的事件。队列已满时阻塞，不要在事件循环中调用
+        """
+        self._start()
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done
+
+    def _run(self):
+        pending = set()
+        while True:
+            handler, event = self.queue.get()
+            try:
+                if handler is not None:
+                    handler.handle(event)
+                    pending.add(handler)
+                if handler is None or self.queue.empty():
+                    for waiting in pending:
+                        waiting.flush()
+                    pending.clear()
+                    self._report_dropped()
+            except Exception as e:
+                sys.__stderr__.write(f"Failed to write log event: {e}\n")
+            finally:
+                if handler is None:
+                    event.set()
+
+    def _report_dropped(self):
+        # 丢弃的事件可能包括控制台输出，不能悄悄丢掉
+        dropped = self.dropped
+        if dropped > self._reported:
+            sys.__stderr__.write(f"Dropped {dropped - self._reported} log events, the log queue was full\n")
+            self._reported = dropped
+
+
+_log_writer = _LogWriter()
+_log_files = {}
+_log_files_lock = threading.Lock()
+
+
+def default_log_handlers(console=True):
+    """控制台（console 为False时不输出到控制台），加上 LOG_FILE 设置的JSONL文件（同一路径在进程内共享一个处理器）"""
+    handlers = [ConsoleLogHandler()] if console else []
+    if LOG_FILE:
+        with _log_files_lock:
+            if LOG_FILE not in _log_files:
+                _log_files[LOG_FILE] = JsonlLogHandler(LOG_FILE)
+            handlers.append(_log_files[LOG_FILE])
+    return handlers
+
+
+class EventLog:
+    """
+    一次运行的结构化事件日志。每个事件是一个字典：time、level、run（运行ID）、step（步骤ID，步骤之外为None）、
+    message 以及附加字段。处理器（控制台、JSONL文件、环形缓冲）由共享的后台线程异步调用，输出不会阻塞执行；
+    synchronous 为True的处理器在产生事件的线程中调用。EventLog 自己只保留各级别的计数和最近的几条错误。
+    """
+
+    def __init__(self, handlers=None, run_id=None, level=None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.handlers = default_log_handlers() if handlers is None else list(handlers)
+        self.level = LOG_LEVELS[level or LOG_LEVEL]
+        self.counts = {}
+        self.errors = collections.deque(maxlen=10)
+        self._lock = threading.Lock()
+
+    def emit(self, message, level='info', **fields):
+        if LOG_LEVELS[level] < self.level:
+            return
+        scope = _current_step.get()
+        event = {'time': time.time(), 'level': level, 'run': self.run_id,
+                 'step': scope['id'] if scope is not None else None, 'message': message}
+        event.update(fields)
+        with self._lock:
+            self.counts[level] = self.counts.get(level, 0) + 1
+            if level == 'error':
+                self.errors.append(message)
+        for handler in self.handlers:
+            if handler.synchronous:
+                handler.handle(event)
+            else:
+                _log_writer.put(handler, event)
+
+    def flush(self):
+        """等待这次运行已经产生的事件写出（会阻塞，在事件循环中使用 flush_events()）"""
+        if not all(handler.synchronous for handler in self.handlers):
+            _log_writer.mark().wait()
+
+
+_current_events = contextvars.ContextVar('xai_events', default=None)
+_current_step = contextvars.ContextVar('xai_step', default=None)
+
+
+def log_event(message, level='info', **fields):
+    """记录一个事件到当前运行的EventLog；在运行之外直接输出到stdout"""
+    scope = _current_step.get()
+    if scope is not None and level == 'error':
+        scope['errors'] += 1
+    events = _current_events.get()
+    if events is not None:
+        events.emit(message, level, **fields)
+    elif LOG_LEVELS[level] >= LOG_LEVELS[LOG_LEVEL]:
+        print(message)
+
+
+async def flush_events():
+    """在线程池中等待当前运行已经产生的事件写出，例如在读取标准输入之前"""
+    events = _current_events.get()
+    if events is not None:
+        await asyncio.get_running_loop().run_in_executor(None, events.flush)
+
+
+@contextlib.asynccontextmanager
+async def process_events(run_id, handlers=None):
+    """批处理或服务进程自身的EventLog（进度和任务状态），退出时在线程池中等待事件写出"""
+    events = EventLog(handlers, run_id=run_id)
+    token = _current_events.set(events)
+    try:
+        yield events
+    finally:
+        _current_events.reset(token)
+        await asyncio.get_running_loop().run_in_executor(None, events.flush)
+
+
+def _job_level(status):
+    return 'info' if status == 'ok' else 'error' if status == 'failed' else 'warning'
+
+
+@contextlib.contextmanager
+def step_events(step):
+    """执行步骤期间的事件带上步骤ID（步骤的目标路径，append为目标文件，没有路径时为任务的第一行），并统计其中的错误"""
+    scope = {'id': step.path or step.dst or step.task, 'errors': 0}
+    token = _current_step.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_step.reset(token)
+
+
+def traced(name):
+    """用span包裹一个同步或异步函数，并把 name 作为路由模型时的阶段"""
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(name), routing_hints(stage=name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with trace_span(name), routing_hints(stage=name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ResponseCache:
+    """
+    按内容寻址的磁盘缓存，用于缓存 temperature 为0（确定性）的API响应。
+
+    键是模型、temperature、规范化后的消息列表和其余请求参数（response_format、max_tokens等，stream除外）的sha256。
+    每个条目是一个JSON文件，
+    通过临时文件加 os.replace 原子写入；超过 max_bytes 时按最近使用时间淘汰，
+    超过 ttl 秒的条目视为过期。bypass 为True时跳过读取，但仍会写入新的响应。
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, ttl=7 * 24 * 3600, bypass=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model, temperature, messages, options=None):
+        normalized = []
+        for message in messages:
+            content = str(message.get('content', '')).replace('\r\n', '\n')
+            content = re.sub(r'[ \t]+\n', '\n', content).strip()
+            normalized.append({'role': message.get('role'), 'content': content})
+        payload = json.dumps([model, temperature, normalized, options or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def request_key(cls, data):
+        """请求负载的键：除 stream 外的所有字段都参与计算，不同 response_format 或 max_tokens 的请求不会共用条目"""
+        options = {key: value for key, value in data.items()
+                   if key not in ('model', 'temperature', 'messages', 'stream')}
+        return cls.make_key(data.get('model'), data.get('temperature', 0), data.get('messages', []), options)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """返回缓存的响应，未命中、已过期或设置了bypass时返回None"""
+        if self.bypass:
+            with self._lock:
+                self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and self.ttl is not None and time.time() - entry.get('created', 0) > self.ttl:
+            self._remove(path)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            # 更新mtime，作为LRU淘汰的依据
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry['result']
+
+    def put(self, key, result):
+        entry = json.dumps({'created': time.time(), 'result': result}, ensure_ascii=False)
+        try:
+            _atomic_write(self._path(key), entry, suffix='.tmp')
+        except OSError as e:
+            log_event(f"Failed to write cache entry: {e}", 'warning')
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(entry.encode('utf-8'))
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+                return
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(os.path.join(self.cache_dir, name))
+                total -= size
+            self._total_bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json'):
+                    self._remove(os.path.join(self.cache_dir, name))
+            self._total_bytes = 0
+
+
+_SSE_DONE = object()
+
+
+def _parse_sse_line(line):
+    """
+    解析一行server-sent events：返回JSON数据块，流结束时返回 _SSE_DONE，其他行返回None
+    """
+    line = line.strip()
+    if not line.startswith('data:'):
+        return None
+    payload = line[len('data:'):].strip()
+    if payload == '[DONE]':
+        return _SSE_DONE
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _cache_key(cache, data):
+    # 只缓存确定性（temperature为0）的非流式请求
+    if cache is None or data.get('stream') or data.get('temperature') != 0:
+        return None
+    return cache.request_key(data)
+
+
+def _parse_duration(value):
+    """解析 retry-after / x-ratelimit-reset-* 的值：秒数、HTTP日期或 '1m30s'、'250ms' 这样的时长"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if parts and ''.join(number + unit for number, unit in parts) == value:
+        scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_int(headers, name):
+    try:
+        return int(float(headers.get(name)))
+    except (TypeError, ValueError):
+        return None
+
+
+def _request_tokens(data):
+    # 请求预计消耗的token数：提示词估算值加上 max_tokens（如果指定了）
+    prompt = sum(estimate_tokens(str(message.get('content', ''))) for message in data.get('messages', []))
+    return prompt + (data.get('max_tokens') or 0)
+
+
+class RateLimiter:
+    """
+    进程内所有API调用（各个阶段、并行的步骤、同步和异步客户端）共享的自适应限流器。
+
+    - 每分钟请求数和每分钟token数两个令牌桶，并按 x-ratelimit-* 响应头与服务端的剩余额度同步
+    - 在途请求数的上限按AIMD调整：请求正常完成时缓慢增加，遇到429、5xx、连接错误或延迟突增时减半
+    - 收到 retry-after 时，在服务端要求的时间之前暂停所有请求
+
+    参数:
+    - requests_per_minute / tokens_per_minute: 本地限额，None表示只遵守服务端给出的限额
+    - initial_concurrency / min_concurrency / max_concurrency: 在途请求数上限的初始值和范围
+    - latency_spike: 每个输出token的耗时超过平均值的这个倍数时视为延迟突增
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 initial_concurrency=INITIAL_CONCURRENCY, min_concurrency=1, max_concurrency=MAX_CONCURRENCY,
+                 latency_spike=3.0):
+        self.lock = threading.Lock()
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        # 没有限额时预算为None，不扣减
+        self.request_budget = float(requests_per_minute) if requests_per_minute else None
+        self.token_budget = float(tokens_per_minute) if tokens_per_minute else None
+        self.refilled = time.monotonic()
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.latency_spike = latency_spike
+        self.latency_per_token = None
+        self.latency_samples = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.stats = {'requests': 0, 'waits': 0, 'wait_time': 0.0, 'rate_limited': 0, 'decreases': 0}
+
+    def _refill(self, now):
+        elapsed = now - self.refilled
+        self.refilled = now
+        if self.rpm:
+            self.request_budget = min(self.rpm, self.request_budget + self.rpm * elapsed / 60)
+        if self.tpm:
+            self.token_budget = min(self.tpm, self.token_budget + self.tpm * elapsed / 60)
+
+    def _try_acquire(self, tokens):
+        # 返回需要等待的秒数，0表示已获得许可
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            if self.rpm and self.request_budget < 1:
+                return (1 - self.request_budget) * 60 / self.rpm
+            # 超过整个桶容量的请求只需等桶装满，否则永远无法发出
+            tokens = min(tokens, self.tpm) if self.tpm else 0
+            if tokens and self.token_budget < tokens:
+                return (tokens - self.token_budget) * 60 / self.tpm
+            if self.rpm:
+                self.request_budget -= 1
+            if tokens:
+                self.token_budget -= tokens
+            self.in_flight += 1
+            self.stats['requests'] += 1
+            return 0.0
+
+    def _record_wait(self, waited):
+        if waited:
+            with self.lock:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += waited
+            annotate_span(rate_limit_wait=round(waited, 3))
+
+    def acquire(self, tokens=0):
+        """阻塞直到可以发出一个预计消耗 tokens 个token的请求，之后必须调用 release"""
+        waited = 0.0
+        while True:
+            delay = self._try_acquire(tokens)
+            if not delay:
+                break
+            time.sleep(delay)
+            waited += delay
+        self._record_wait(waited)
+
+    async def acquire_async(self, tokens=0):
+        """acquire 的异步版本"""
+        waited = 0.0
+        while True:
+            delay = self._try_acquire(tokens)
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+            waited += delay
+        self._record_wait(waited)
+
+    def release(self, status, headers=None, hold=False):
+        """
+        收到响应头（或连接失败，status为'connection'）时调用。
+        hold 为True时（响应的正文还要继续读取，例如流式响应）请求仍然占用在途名额，正文读完或连接关闭后调用 finish()。
+        返回服务端要求的重试等待时间（秒），没有要求时返回None。
+        """
+        headers = headers or {}
+        retry_after = _parse_duration(headers.get('retry-after'))
+        with self.lock:
+            now = time.monotonic()
+            if not hold:
+                self.in_flight -= 1
+            self._apply_headers(headers, now)
+            if status == 429:
+                self.stats['rate_limited'] += 1
+                self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else 1.0))
+                self._decrease(now)
+            elif status == 'connection' or status in RETRY_STATUS_CODES:
+                self._decrease(now)
+            elif status == 200:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        return retry_after
+
+    def finish(self):
+        """释放 release(..., hold=True) 保留的在途名额"""
+        with self.lock:
+            self.in_flight -= 1
+
+    def _apply_headers(self, headers, now):
+        for kind in ('requests', 'tokens'):
+            limit = _header_int(headers, f'x-ratelimit-limit-{kind}')
+            remaining = _header_int(headers, f'x-ratelimit-remaining-{kind}')
+            reset = _parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+            if limit:
+                if kind == 'requests' and (self.rpm is None or limit < self.rpm):
+                    self.rpm = limit
+                    self.request_budget = limit if self.request_budget is None else min(self.request_budget, limit)
+                elif kind == 'tokens' and (self.tpm is None or limit < self.tpm):
+                    self.tpm = limit
+                    self.token_budget = limit if self.token_budget is None else min(self.token_budget, limit)
+            if remaining is not None:
+                if kind == 'requests' and self.request_budget is not None:
+                    self.request_budget = min(self.request_budget, remaining)
+                elif kind == 'tokens' and self.token_budget is not None:
+                    self.token_budget = min(self.token_budget, remaining)
+                if remaining == 0 and reset:
+                    self.paused_until = max(self.paused_until, now + reset)
+
+    def _decrease(self, now):
+        # 同一批失败的在途请求只减半一次
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        self.stats['decreases'] += 1
+
+    def record_usage(self, estimated_tokens, usage, latency):
+        """用响应中的实际token用量校正令牌桶，并检测每个输出token的耗时是否突增"""
+        usage = usage or {}
+        completion_tokens = usage.get('completion_tokens') or 0
+        with self.lock:
+            if self.tpm and usage.get('total_tokens'):
+                self.token_budget -= usage['total_tokens'] - min(estimated_tokens, self.tpm)
+            # 输出太短时耗时主要是固定开销，不作为延迟样本
+            if completion_tokens < 32:
+                return
+            per_token = latency / completion_tokens
+            if self.latency_per_token is None:
+                self.latency_per_token = per_token
+            elif self.latency_samples >= 5 and per_token > self.latency_spike * self.latency_per_token:
+                self._decrease(time.monotonic())
+            self.latency_per_token = 0.8 * self.latency_per_token + 0.2 * per_token
+            self.latency_samples += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, concurrency=int(self.limit), in_flight=self.in_flight,
+                        requests_per_minute=self.rpm, tokens_per_minute=self.tpm)
+
+
+_default_client_lock = threading.Lock()
+_default_rate_limiter = None
+
+
+def get_rate_limiter():
+    """返回进程内共享的RateLimiter（首次调用时创建）"""
+    global _default_rate_limiter
+    with _default_client_lock:
+        if _default_rate_limiter is None:
+            _default_rate_limiter = RateLimiter()
+        return _default_rate_limiter
+
+
+class GrokClient:
+    """
+    共享的xAI API客户端：复用连接池、固定请求头，并带有超时和重试。
+
+    参数:
+    - pool_size: 连接池大小（并发请求数上限）
+    - connect_timeout / read_timeout: 连接和读取超时（秒）
+    - max_retries: 429/5xx/连接错误时的最大重试次数
+    - backoff_base / backoff_max: 指数退避的基数和上限（秒）
+    - cache: 可选的ResponseCache
+    - rate_limiter: 限流器，默认使用进程内共享的RateLimiter
+    """
+
+    def __init__(self, api_key=API_KEY, url=API_URL, model=MODEL, pool_size=10,
+                 connect_timeout=10, read_timeout=300, max_retries=4,
+                 backoff_base=1.0, backoff_max=30.0, cache=None, rate_limiter=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.url = url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        })
+
+    def post(self, data, stream=False):
+        """
+        经过限流器发送请求，在429/5xx/连接错误时重试：
+        服务端给出 retry-after 时按它等待，否则按带抖动的指数退避等待。
+        stream 为True时返回的响应在正文读完之前占用限流器的在途名额，调用方关闭响应后调用 rate_limiter.finish()
+        """
+        tokens = _request_tokens(data)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(tokens)
+            try:
+                response = self.session.post(self.url, json=data, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.rate_limiter.release('connection')
+                if attempt >= self.max_retries:
+                    raise Exception(f"Error: request failed after {attempt + 1} attempts - {e}")
+                log_event(f"API connection error ({e}), retrying...", 'warning')
+                _count_retry('connection')
+                retry_after = None
+            except BaseException:
+                self.rate_limiter.release(None)
+                raise
+            else:
+                held = stream and response.status_code == 200
+                retry_after = self.rate_limiter.release(response.status_code, response.headers, hold=held)
+                annotate_span(http_status=response.status_code)
+                if response.status_code == 200:
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise Exception(f"Error: {response.status_code} - {response.text}")
+                log_event(f"API returned {response.status_code}, retrying...", 'warning')
+                _count_retry(response.status_code)
+                response.close()
+            # 有 retry-after 时由限流器在下一次 acquire 中等待
+            if retry_after is None:
+                time.sleep(_backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+
+    def chat(self, messages, bypass_cache=False, **options):
+        """调用chat completions接口，返回完整的JSON结果"""
+        data = {
+            'messages': messages,
+            'model': self.model,
+            'stream': False,
+            'temperature': 0
+        }
+        data.update(options)
+        with trace_span('api_call', model=data['model']):
+            cache_key = _cache_key(self.cache, data)
+            if cache_key and not bypass_cache:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    annotate_span(cached=True)
+                    return cached
+            start = time.monotonic()
+            result = self.post(data).json()
+            self.rate_limiter.record_usage(_request_tokens(data), result.get('usage'), time.monotonic() - start)
+            _record_usage(result)
+            if cache_key:
+                self.cache.put(cache_key, result)
+            return result
+
+    def stream_chat(self, messages, **options):
+        """以流式方式调用chat completions接口，逐个产出服务端发送的JSON数据块"""
+        data = {
+            'messages': messages,
+            'model': self.model,
+            'stream': True,
+            'temperature': 0
+        }
+        data.update(options)
+        response = self.post(data, stream=True)
+        try:
+            for line in response.iter_lines():
+                chunk = _parse_sse_line(line.decode('utf-8'))
+                if chunk is _SSE_DONE:
+                    break
+                if chunk is not None:
+                    yield chunk
+        finally:
+            response.close()
+            self.rate_limiter.finish()
+
+    def close(self):
+        self.session.close()
+
+
+_GOAL_STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'of', 'in', 'on', 'to', 'for', 'with', 'using', 'use', 'that', 'which',
+    'is', 'it', 'its', 'by', 'from', 'as', 'i', 'me', 'my', 'we', 'want', 'need', 'please', 'can', 'should',
+    'build', 'create', 'make', 'write', 'implement', 'develop', 'simple', 'basic',
+}
+
+# MinHash的哈希函数 (a * x + b) mod p，固定种子使签名在不同进程之间一致
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PERMUTATIONS = [(rng.randrange(1, _MINHASH_PRIME), rng.randrange(_MINHASH_PRIME))
+                         for rng in [random.Random(20241)] for _ in range(64)]
+
+
+def goal_tokens(goal):
+    """规范化目标文本：小写、去掉标点和常见虚词、简单去掉复数s；中文按相邻两个字切分"""
+    tokens = set()
+    for word in re.findall(r'[a-z0-9]+|[\u4e00-\u9fff]+', goal.lower()):
+        if '\u4e00' <= word[0] <= '\u9fff':
+            tokens.update(word[i:i + 2] for i in range(max(len(word) - 1, 1)))
+            continue
+        if word in _GOAL_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.add(word)
+    return tokens
+
+
+class PlanIndex:
+    """
+    相似目标的计划缓存：记录确认过的目标、目录结构、文件大小估算和计划，新目标与旧目标足够相似时复用它们。
+
+    每个目标的词集合计算64个哈希的MinHash签名，按每4行一段分成16段做LSH分桶，查找时只比较
+    至少有一段相同的候选条目（Jaccard相似度0.75时漏检的概率约0.2%，低于0.5时明显变高），
+    再用精确的Jaccard相似度选出最相似的一个。
+
+    index_dir 下的 index.jsonl 是只追加的索引日志（新增、使用、删除），日志过长时压缩重写；
+    每个条目的内容保存在 entries/<id>.json。条目数超过 max_entries 时按最近使用时间淘汰。
+    """
+
+    BAND_ROWS = 4
+
+    def __init__(self, index_dir, threshold=None, max_entries=None):
+        self.index_dir = index_dir
+        self.threshold = PLAN_CACHE_THRESHOLD if threshold is None else threshold
+        self.max_entries = PLAN_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.entries = {}
+        self.buckets = {}
+        self.hits = 0
+        self.misses = 0
+        self._log_records = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(index_dir, 'entries'), exist_ok=True)
+        self._load()
+
+    @classmethod
+    def band_keys(cls, tokens):
+        hashes = [int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+                  for token in tokens]
+        signature = [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PERMUTATIONS]
+        keys = []
+        for i in range(0, len(signature), cls.BAND_ROWS):
+            band = ','.join(map(str, signature[i:i + cls.BAND_ROWS]))
+            keys.append(hashlib.blake2b(f"{i}:{band}".encode('ascii'), digest_size=8).hexdigest())
+        return keys
+
+    def _index_path(self):
+        return os.path.join(self.index_dir, 'index.jsonl')
+
+    def _entry_path(self, entry_id):
+        return os.path.join(self.index_dir, 'entries', f"{entry_id}.json")
+
+    def _load(self):
+        try:
+            with open(self._index_path(), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(record)
+                    self._log_records += 1
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, record):
+        entry_id = record.get('id')
+        if record.get('op') == 'put':
+            self._discard(entry_id)
+            entry = {'goal': record['goal'], 'tokens': frozenset(record['tokens']), 'bands': record['bands'],
+                     'used': record['used']}
+            self.entries[entry_id] = entry
+            for key in entry['bands']:
+                self.buckets.setdefault(key, set()).add(entry_id)
+        elif record.get('op') == 'use' and entry_id in self.entries:
+            self.entries[entry_id]['used'] = record['used']
+        elif record.get('op') == 'delete':
+            self._discard(entry_id)
+
+    def _discard(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in entry['bands']:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    def _log(self, *records):
+        for record in records:
+            self._apply(record)
+        with open(self._index_path(), 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        self._log_records += len(records)
+        if self._log_records > 2 * len(self.entries) + 1000:
+            self._compact()
+
+    def _compact(self):
+        lines = [json.dumps({'op': 'put', 'id': entry_id, 'goal': entry['goal'], 'tokens': sorted(entry['tokens']),
+                             'bands': entry['bands'], 'used': entry['used']}, ensure_ascii=False) + '\n'
+                 for entry_id, entry in self.entries.items()]
+        _atomic_write(self._index_path(), ''.join(lines), suffix='.tmp')
+        self._log_records = len(lines)
+
+    def lookup(self, goal):
+        """返回 (条目, 相似度)，条目包含 goal、structure、sizes 和 plan；没有足够相似的目标时返回 (None, 0)"""
+        tokens = goal_tokens(goal)
+        best_id, best = None, 0.0
+        if tokens:
+            with self._lock:
+                candidates = set()
+                for key in self.band_keys(tokens):
+                    candidates.update(self.buckets.get(key, ()))
+                for entry_id in candidates:
+                    other = self.entries[entry_id]['tokens']
+                    similarity = len(tokens & other) / len(tokens | other)
+                    if similarity > best:
+                        best_id, best = entry_id, similarity
+        entry = None
+        if best_id is not None and best >= self.threshold:
+            try:
+                with open(self._entry_path(best_id), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                with self._lock:
+                    self._log({'op': 'delete', 'id': best_id})
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None, 0.0
+            self.hits += 1
+            self._log({'op': 'use', 'id': best_id, 'used': time.time()})
+        return entry, best
+
+    def add(self, goal, structure, sizes, plan):
+        """记录一个确认过的目标；词集合相同的旧条目被替换"""
+        tokens = goal_tokens(goal)
+        if not tokens:
+            return
+        entry_id = hashlib.sha256(' '.join(sorted(tokens)).encode('utf-8')).hexdigest()[:24]
+        entry = {'goal': goal, 'structure': structure, 'sizes': sizes, 'plan': plan}
+        try:
+            _atomic_write(self._entry_path(entry_id), json.dumps(entry, ensure_ascii=False), suffix='.tmp')
+            with self._lock:
+                self._log({'op': 'put', 'id': entry_id, 'goal': goal, 'tokens': sorted(tokens),
+                           'bands': self.band_keys(tokens), 'used': time.time()})
+                self._evict()
+        except OSError as e:
+            log_event(f"Failed to write plan cache entry: {e}", 'warning')
+
+    def _evict(self):
+        excess = len(self.entries) - self.max_entries
+        if excess <= 0:
+            return
+        oldest = sorted(self.entries, key=lambda entry_id: self.entries[entry_id]['used'])[:excess]
+        for entry_id in oldest:
+            try:
+                os.remove(self._entry_path(entry_id))
+            except OSError:
+                pass
+        self._log(*({'op': 'delete', 'id': entry_id} for entry_id in oldest))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+_default_client = None
+_default_plan_index = None
+
+
+def get_plan_index():
+    """返回进程内共享的PlanIndex，没有设置 PLAN_CACHE_DIR 时返回None"""
+    global _default_plan_index
+    if not PLAN_CACHE_DIR:
+        return None
+    with _default_client_lock:
+        if _default_plan_index is None or _default_plan_index.index_dir != PLAN_CACHE_DIR:
+            _default_plan_index = PlanIndex(PLAN_CACHE_DIR)
+        return _default_plan_index
+
+
+def _default_cache():
+    return ResponseCache(CACHE_DIR) if CACHE_DIR else None
+
+
+def get_client():
+    """返回进程内共享的GrokClient（首次调用时创建）"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = GrokClient(cache=_default_cache())
+        return _default_client
+
+
+def set_client(client):
+    """替换共享的GrokClient，例如使用自定义的连接池大小或超时"""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+
+def call_grok_api(messages, client=None, **options):
+    client = client or get_client()
+    result = client.chat(messages, **options)
+    return result['choices'][0]['message']['content']
+
+
+class AsyncGrokClient:
+    """
+    GrokClient的异步版本，参数和重试策略与GrokClient相同。
+
+    安装了aiohttp时使用aiohttp的连接池；否则在自己的线程池中调用一个内部的GrokClient
+    （被取消的请求无法中断，close() 不等待它们结束）。
+    """
+
+    def __init__(self, api_key=API_KEY, url=API_URL, model=MODEL, pool_size=100,
+                 connect_timeout=10, read_timeout=300, max_retries=4,
+                 backoff_base=1.0, backoff_max=30.0, cache=None, rate_limiter=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.url = url
+        self.model = model
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+        self._loop = None
+        self._fallback = None
+        self._executor = None
+        if aiohttp is None:
+            self._fallback = GrokClient(api_key, url, model, pool_size, connect_timeout, read_timeout,
+                                        max_retries, backoff_base, backoff_max, rate_limiter=self.rate_limiter)
+            self._executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def _get_session(self):
+        # aiohttp的session绑定在创建它的事件循环上，换了事件循环就重新创建
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': f'Bearer {self.api_key}'
+                },
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+            self._loop = loop
+        return self._session
+
+    async def _request(self, data):
+        # 返回状态码为200的响应，正文读完之前占用在途名额：调用方负责 response.release() 和 rate_limiter.finish()
+        session = self._get_session()
+        tokens = _request_tokens(data)
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_async(tokens)
+            try:
+                response = await session.post(self.url, json=data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.rate_limiter.release('connection')
+                if attempt >= self.max_retries:
+                    raise Exception(f"Error: request failed after {attempt + 1} attempts - {e}")
+                log_event(f"API connection error ({e}), retrying...", 'warning')
+                _count_retry('connection')
+                retry_after = None
+            except BaseException:
+                self.rate_limiter.release(None)
+                raise
+            else:
+                retry_after = self.rate_limiter.release(response.status, response.headers,
+                                                        hold=response.status == 200)
+                annotate_span(http_status=response.status)
+                if response.status == 200:
+                    return response
+                text = await response.text()
+                response.release()
+                if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise Exception(f"Error: {response.status} - {text}")
+                log_event(f"API returned {response.status}, retrying...", 'warning')
+                _count_retry(response.status)
+            if retry_after is None:
+                await asyncio.sleep(_backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+
+    async def post(self, data):
+        """发送请求并返回JSON结果，在429/5xx/连接错误时按带抖动的指数退避重试"""
+        if self._fallback is not None:
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, context.run, lambda: self._fallback.post(data).json())
+
+        response = await self._request(data)
+        try:
+            return await response.json(content_type=None)
+        finally:
+            response.release()
+            self.rate_limiter.finish()
+
+    async def stream_chat(self, messages, **options):
+        """以流式方式调用chat completions接口，逐个产出服务端发送的JSON数据块"""
+        if self._fallback is not None:
+            loop = asyncio.get_running_loop()
+            iterator = self._fallback.stream_chat(messages, **options)
+            while True:
+                chunk = await loop.run_in_executor(self._executor, next, iterator, _SSE_DONE)
+                if chunk is _SSE_DONE:
+                    return
+                yield chunk
+
+        data = {
+            'messages': messages,
+            'model': self.model,
+            'stream': True,
+            'temperature': 0
+        }
+        data.update(options)
+        response = await self._request(data)
+        try:
+            async for line in response.content:
+                chunk = _parse_sse_line(line.decode('utf-8'))
+                if chunk is _SSE_DONE:
+                    break
+                if chunk is not None:
+                    yield chunk
+        finally:
+            response.release()
+            self.rate_limiter.finish()
+
+    async def chat(self, messages, bypass_cache=False, **options):
+        """调用chat completions接口，返回完整的JSON结果"""
+        data = {
+            'messages': messages,
+            'model': self.model,
+            'stream': False,
+            'temperature': 0
+        }
+        data.update(options)
+        with trace_span('api_call', model=data['model']):
+            cache_key = _cache_key(self.cache, data)
+            if cache_key and not bypass_cache:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    annotate_span(cached=True)
+                    return cached
+            start = time.monotonic()
+            hedger = _current_hedger.get()
+            if hedger is not None:
+                result = await hedger.call(lambda: self.post(data))
+            else:
+                result = await self.post(data)
+            self.rate_limiter.record_usage(_request_tokens(data), result.get('usage'), time.monotonic() - start)
+            _record_usage(result)
+            if cache_key:
+                self.cache.put(cache_key, result)
+            return result
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._fallback is not None:
+            self._executor.shutdown(wait=False)
+            self._fallback.close()
+
+
+async def async_call_grok_api(messages, client, **options):
+    result = await client.chat(messages, **options)
+    return result['choices'][0]['message']['content']
+
+
+# 模型端点的后端：名字 -> 工厂 factory(url=, api_key=, model=, pool_size=, cache=, rate_limiter=)，
+# 返回的对象需要提供与AsyncGrokClient相同的 chat / stream_chat / close 异步接口
+BACKENDS = {'openai': AsyncGrokClient}
+
+
+def register_backend(name, factory):
+    """注册一个后端，MODEL_ENDPOINTS 中的端点可以通过 'backend': name 使用它"""
+    BACKENDS[name] = factory
+
+
+class ModelRouter:
+    """
+    按 MODEL_ROUTES 把每次调用路由到 MODEL_ENDPOINTS 中的某个端点，接口与AsyncGrokClient相同，
+    可以代替它传给所有异步函数。路由的依据是 routing_hints 设置的阶段、文件路径和估算大小。
+
+    主端点出错或超过规则的 timeout 时改用规则（或 FALLBACK_ENDPOINT）中的 fallback 端点；
+    流式调用只在收到第一个数据块之前回退。每个端点的客户端在第一次使用时创建，
+    DEFAULT_ENDPOINT 使用进程内共享的限流器，其他端点按URL各自限流。
+    """
+
+    def __init__(self, endpoints=None, routes=None, default=None, fallback=None, pool_size=100, cache=None,
+                 rate_limiter=None):
+        self.endpoints = MODEL_ENDPOINTS if endpoints is None else endpoints
+        self.routes = MODEL_ROUTES if routes is None else routes
+        self.default = default or DEFAULT_ENDPOINT
+        self.fallback = FALLBACK_ENDPOINT if fallback is None else fallback
+        self.pool_size = pool_size
+        self.cache = cache
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self._limiters = {}
+        self._clients = {}
+        self.stats = {}
+
+    @property
+    def model(self):
+        return self.endpoints[self.default]['model']
+
+    def client(self, name):
+        """返回端点 name 的客户端"""
+        if name not in self._clients:
+            if name not in self.endpoints:
+                raise Exception(f"Error: unknown model endpoint '{name}'")
+            endpoint = self.endpoints[name]
+            url = endpoint.get('url', API_URL)
+            if name == self.default:
+                limiter = self.rate_limiter
+            else:
+                limiter = self._limiters.setdefault(url, RateLimiter())
+            factory = BACKENDS[endpoint.get('backend', 'openai')]
+            self._clients[name] = factory(url=url, api_key=endpoint.get('api_key', API_KEY),
+                                          model=endpoint.get('model', MODEL), pool_size=self.pool_size,
+                                          cache=self.cache, rate_limiter=limiter)
+        return self._clients[name]
+
+    def route(self, hints=None):
+        """返回 (端点, 回退端点, 超时秒数)"""
+        hints = _routing_hints.get() if hints is None else hints
+        path = hints.get('path') or ''
+        size = hints.get('size')
+        for rule in self.routes:
+            if 'stage' in rule and rule['stage'] != hints.get('stage'):
+                continue
+            if 'extensions' in rule and os.path.splitext(path)[1].lower() not in rule['extensions']:
+                continue
+            if 'max_size' in rule and (size is None or size > rule['max_size']):
+                continue
+            if 'min_size' in rule and (size is None or size < rule['min_size']):
+                continue
+            return rule['endpoint'], rule.get('fallback', self.fallback), rule.get('timeout')
+        return self.default, self.fallback, None
+
+    def _count(self, name, key):
+        stats = self.stats.setdefault(name, {'calls': 0, 'failures': 0, 'fallbacks': 0})
+        stats[key] += 1
+
+    def _fall_back(self, primary, fallback, error):
+        self._count(primary, 'failures')
+        if not fallback or fallback == primary:
+            return False
+        reason = 'timed out' if isinstance(error, asyncio.TimeoutError) else f"failed ({error})"
+        log_event(f"Model endpoint '{primary}' {reason}, falling back to '{fallback}'", 'warning')
+        annotate_span(fallback=fallback)
+        self._count(fallback, 'fallbacks')
+        return True
+
+    async def chat(self, messages, bypass_cache=False, **options):
+        primary, fallback, timeout = self.route()
+        self._count(primary, 'calls')
+        annotate_span(endpoint=primary)
+        try:
+            return await asyncio.wait_for(self.client(primary).chat(messages, bypass_cache, **options), timeout)
+        except Exception as e:
+            if not self._fall_back(primary, fallback, e):
+                raise
+        return await self.client(fallback).chat(messages, bypass_cache, **options)
+
+    async def stream_chat(self, messages, **options):
+        primary, fallback, timeout = self.route()
+        self._count(primary, 'calls')
+        annotate_span(endpoint=primary)
+        chunks = self.client(primary).stream_chat(messages, **options)
+        try:
+            first = await asyncio.wait_for(chunks.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+        except Exception as e:
+            await chunks.aclose()
+            if not self._fall_back(primary, fallback, e):
+                raise
+            chunks = self.client(fallback).stream_chat(messages, **options)
+            first = await chunks.__anext__()
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    def summary(self):
+        return ', '.join(f"{name}: {stats['calls']} calls, {stats['failures']} failures, "
+                         f"{stats['fallbacks']} fallbacks" for name, stats in sorted(self.stats.items()))
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
 
-def call_grok_api(messages):
-    api_key = 'YOUR_XAI_API_KEY'  # Replace with your actual API key
-    url = 'https://api.x.ai/v1/chat/completions'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
-    data = {
-        'messages': messages,
-        'model': 'grok-beta',
-        'stream': False,
-        'temperature': 0
-    }
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 200:
-        result = response.json()
-        return result['choices'][0]['message']['content']
-    else:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
 
+def default_async_client(pool_size=100):
+    """配置了模型路由或回退端点时返回ModelRouter，否则返回AsyncGrokClient"""
+    if MODEL_ROUTES or FALLBACK_ENDPOINT or DEFAULT_ENDPOINT != 'grok':
+        return ModelRouter(pool_size=pool_size, cache=_default_cache())
+    return AsyncGrokClient(pool_size=pool_size, cache=_default_cache())
 
+
+@traced('estimate_file_sizes')
 def estimate_file_sizes(structure, goal):
     """
     通过调用xAI API来估算项目中每个文件的大小
@@ -35,6 +1759,15 @@ def estimate_file_sizes(structure, goal):
     
     返回一个字典，键为文件路径，值为估计大小（带单位）
     """
+    messages = _file_size_messages(structure, goal)
+    try:
+        response = call_grok_api(messages)
+    except Exception as e:
+        log_event(f"Error in file size estimation: {e}", 'warning')
+        return _default_file_size_estimation(structure)
+    return parse_file_sizes(response, structure)
+
+def _file_size_messages(structure, goal):
     system_message = {
         'role': 'system',
         'content': (
@@ -59,52 +1792,49 @@ def estimate_file_sizes(structure, goal):
         )
     }
     
-    messages = [system_message, user_message]
-    
-    try:
-        response = call_grok_api(messages)
+    return [system_message, user_message]
+
+def parse_file_sizes(response, structure):
+    """
+    从AI的响应中解析文件大小估算，解析失败时回退到默认估算方法
+    """
+    # 尝试从响应中提取JSON
+    def extract_json(text):
+        # 尝试找到JSON块
+        json_matches = re.findall(r'```json\n(.*?)```', text, re.DOTALL)
+        if json_matches:
+            return json_matches[0]
         
-        # 尝试从响应中提取JSON
-        def extract_json(text):
-            # 尝试找到JSON块
-            json_matches = re.findall(r'```json\n(.*?)```', text, re.DOTALL)
-            if json_matches:
-                return json_matches[0]
-            
-            # 尝试找到花括号包裹的JSON
-            json_matches = re.findall(r'{[^}]*}', text, re.DOTALL)
-            if json_matches:
-                return json_matches[0]
-            
-            return text.strip()
+        # 尝试找到花括号包裹的JSON
+        json_matches = re.findall(r'{[^}]*}', text, re.DOTALL)
+        if json_matches:
+            return json_matches[0]
         
-        cleaned_response = extract_json(response)
+        return text.strip()
+    
+    cleaned_response = extract_json(response)
+    
+    try:
+        file_sizes = json.loads(cleaned_response)
         
-        try:
-            file_sizes = json.loads(cleaned_response)
+        # 验证并修正输出格式
+        corrected_file_sizes = {}
+        for path, size in file_sizes.items():
+            # 确保size是字符串，并包含单位
+            if not isinstance(size, str):
+                size = f"{size} KB"
             
-            # 验证并修正输出格式
-            corrected_file_sizes = {}
-            for path, size in file_sizes.items():
-                # 确保size是字符串，并包含单位
-                if not isinstance(size, str):
-                    size = f"{size} KB"
-                
-                # 如果没有单位，默认添加KB
-                if not re.search(r'\s*(KB|bytes)', size):
-                    size = f"{size} KB"
-                
-                corrected_file_sizes[path] = size
+            # 如果没有单位，默认添加KB
+            if not re.search(r'\s*(KB|bytes)', size):
+                size = f"{size} KB"
             
-            return corrected_file_sizes
+            corrected_file_sizes[path] = size
         
-        except (json.JSONDecodeError, ValueError):
-            # 如果解析失败，回退到默认估算方法
-            print("AI file size estimation failed. Using default estimation.")
-            return _default_file_size_estimation(structure)
+        return corrected_file_sizes
     
-    except Exception as e:
-        print(f"Error in file size estimation: {e}")
+    except (json.JSONDecodeError, ValueError, AttributeError):
+        # 如果解析失败，回退到默认估算方法
+        log_event("AI file size estimation failed. Using default estimation.", 'warning')
         return _default_file_size_estimation(structure)
 
 def _default_file_size_estimation(structure):
@@ -127,38 +1857,48 @@ def _default_file_size_estimation(structure):
             sizes.update(_default_file_size_estimation(sub))
     return sizes
 
+@traced('determine_project_structure')
 def determine_project_structure(goal):
-    example_structure = {
-        "snake_game": {
-            "README.md": {},
-            "requirements.txt": {},
-            "main.py": {},
-            "game": {
-                "__init__.py": {},
-                "snake.py": {},
-                "food.py": {},
-                "game_manager.py": {}
-            },
-            "assets": {
-                "images": {
-                    "snake.png": {},
-                    "food.png": {}
-                },
-                "sounds": {
-                    "eat.wav": {},
-                    "game_over.wav": {}
-                }
-            },
-            "save_system": {
-                "__init__.py": {},
-                "save_manager.py": {}
+    messages = _project_structure_messages(goal)
+    response = call_grok_api(messages)
+    log_event("AI's response:")
+    log_event(response)
+    project_structure = parse_project_structure(response)
+    return project_structure
+
+_EXAMPLE_STRUCTURE = {
+    "snake_game": {
+        "README.md": {},
+        "requirements.txt": {},
+        "main.py": {},
+        "game": {
+            "__init__.py": {},
+            "snake.py": {},
+            "food.py": {},
+            "game_manager.py": {}
+        },
+        "assets": {
+            "images": {
+                "snake.png": {},
+                "food.png": {}
             },
-            "utils": {
-                "__init__.py": {},
-                "helpers.py": {}
+            "sounds": {
+                "eat.wav": {},
+                "game_over.wav": {}
             }
+        },
+        "save_system": {
+            "__init__.py": {},
+            "save_manager.py": {}
+        },
+        "utils": {
+            "__init__.py": {},
+            "helpers.py": {}
         }
     }
+}
+
+def _project_structure_messages(goal):
     system_message = {
         'role': 'system',
         'content': (
@@ -170,7 +1910,7 @@ def determine_project_structure(goal):
             'Do not include any explanations or additional text before or after the JSON. '
             'Only output the pure JSON content. '
             'Here is an example:\n\n'
-            '```json\n' + json.dumps(example_structure, indent=4) + '\n```'
+            '```json\n' + json.dumps(_EXAMPLE_STRUCTURE, indent=4) + '\n```'
         )
     }
     user_message = {
@@ -183,12 +1923,7 @@ def determine_project_structure(goal):
             'Please enclose the JSON content within triple backticks (```json).'
         )
     }
-    messages = [system_message, user_message]
-    response = call_grok_api(messages)
-    print("AI's response:")
-    print(response)
-    project_structure = parse_project_structure(response)
-    return project_structure
+    return [system_message, user_message]
 
 def parse_project_structure(response):
     try:
@@ -198,16 +1933,152 @@ def parse_project_structure(response):
             structure = json.loads(json_content)
             return structure
         else:
-            print("No JSON content found in AI's response.")
-            print("AI's response:")
-            print(response)
+            log_event("No JSON content found in AI's response.", 'error')
+            log_event("AI's response:")
+            log_event(response)
             return {}
     except json.JSONDecodeError as e:
-        print(f"Error parsing project structure: {e}")
-        print("AI's response:")
-        print(response)
+        log_event(f"Error parsing project structure: {e}", 'error')
+        log_event("AI's response:")
+        log_event(response)
         return {}
 
+# 一次调用同时返回目录结构和文件大小估算时，响应需要符合的JSON schema
+PROJECT_PLAN_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'structure': {
+            'type': 'object',
+            'description': 'Exactly one top-level directory. Folders are objects, files are empty objects.',
+            'minProperties': 1,
+            'maxProperties': 1
+        },
+        'sizes': {
+            'type': 'object',
+            'description': 'File path (including the top-level directory) to estimated size, e.g. "2 KB".',
+            'additionalProperties': {'type': 'string', 'pattern': r'^\d+(\.\d+)?\s*(KB|bytes)$'}
+        }
+    },
+    'required': ['structure', 'sizes'],
+    'additionalProperties': False
+}
+
+_SIZE_PATTERN = re.compile(PROJECT_PLAN_SCHEMA['properties']['sizes']['additionalProperties']['pattern'])
+
+@traced('plan_project')
+def plan_project(goal):
+    """
+    用一次API调用得到项目目录结构和每个文件的估计大小。
+
+    结构校验失败时回退到 determine_project_structure + estimate_file_sizes，
+    只有大小估算校验失败时只补一次 estimate_file_sizes 调用。
+
+    返回 (project_structure, file_sizes)，无法得到目录结构时 project_structure 为空字典
+    """
+    try:
+        response = call_grok_api(_project_plan_messages(goal), response_format=_project_plan_format())
+        structure, sizes = parse_project_plan(response)
+    except Exception as e:
+        log_event(f"Combined planning failed ({e}), asking for the structure and sizes separately.", 'warning')
+        structure = determine_project_structure(goal)
+        return structure, (estimate_file_sizes(structure, goal) if structure else {})
+    if sizes is None:
+        log_event("File size estimates did not match the structure, estimating them separately.", 'warning')
+        sizes = estimate_file_sizes(structure, goal)
+    return structure, sizes
+
+def _project_plan_format():
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': 'project_plan', 'schema': PROJECT_PLAN_SCHEMA}
+    }
+
+def _project_plan_messages(goal):
+    system_message = {
+        'role': 'system',
+        'content': (
+            'You are an AI assistant specializing in software development and software project estimation. '
+            'Your task is to provide the project directory structure and file size estimates based on the user\'s goal. '
+            'If the user\'s goal is very simple that you can achieve it with one python script file(smaller than 5KB), the project can just contain one script file. '
+            'Do not contain any folders or files about "test". '
+            'In "structure", folders are represented as objects and files are empty objects, with exactly one top-level directory. '
+            'In "sizes", give every file in the structure a realistic, conservative size estimate with a unit (KB or bytes), '
+            'keyed by its path including the top-level directory. '
+            'Return ONLY a JSON object that matches this JSON schema:\n\n'
+            + json.dumps(PROJECT_PLAN_SCHEMA, indent=4) +
+            '\n\nExample of "structure":\n\n' + json.dumps(_EXAMPLE_STRUCTURE, indent=4)
+        )
+    }
+    user_message = {
+        'role': 'user',
+        'content': (
+            f'Goal:\n"{goal}"\n\n'
+            'Return the JSON object with "structure" and "sizes" only, without any additional text.'
+        )
+    }
+    return [system_message, user_message]
+
+def _structure_files(structure, prefix=''):
+    # 返回结构中所有文件的路径（文件是空对象，且文件名包含扩展名）
+    files = []
+    for name, sub in structure.items():
+        path = f"{prefix}/{name}" if prefix else name
+        if sub:
+            files.extend(_structure_files(sub, path))
+        elif '.' in name:
+            files.append(path)
+    return files
+
+def validate_project_plan(data):
+    """
+    按 PROJECT_PLAN_SCHEMA 校验结构化输出，并检查大小估算与结构中的文件对得上。
+
+    返回 (structure, sizes)：结构不合法时抛出ValueError，大小估算不合法时 sizes 为None
+    """
+    if not isinstance(data, dict) or set(data) - {'structure', 'sizes'} or 'structure' not in data:
+        raise ValueError("expected an object with 'structure' and 'sizes'")
+    structure = data['structure']
+    if not isinstance(structure, dict) or len(structure) != 1:
+        raise ValueError("structure must have exactly one top-level directory")
+
+    def check_tree(tree, path):
+        for name, sub in tree.items():
+            if not isinstance(sub, dict) or not name.strip() or '/' in name or '\\' in name:
+                raise ValueError(f"invalid entry {path + name!r} in structure")
+            check_tree(sub, f"{path}{name}/")
+    check_tree(structure, '')
+    files = _structure_files(structure)
+    if not files:
+        raise ValueError("structure contains no files")
+
+    sizes = data.get('sizes')
+    if not isinstance(sizes, dict) or not all(
+            isinstance(size, str) and _SIZE_PATTERN.match(size.strip()) for size in sizes.values()):
+        return structure, None
+    top_level_dir = next(iter(structure))
+    known = {_normalize_plan_path(path, top_level_dir) for path in sizes}
+    known.update(os.path.basename(path) for path in sizes)
+    missing = [path for path in files
+               if _normalize_plan_path(path, top_level_dir) not in known and os.path.basename(path) not in known]
+    # 少数文件（例如空的 __init__.py）没有估算时用默认估算补齐，大部分文件对不上说明估算不可用
+    if len(missing) * 2 > len(files):
+        return structure, None
+    sizes = {path: size.strip() for path, size in sizes.items()}
+    defaults = _default_file_size_estimation(structure)
+    for path in missing:
+        sizes[path] = defaults.get(os.path.basename(path), '1 KB')
+    return structure, sizes
+
+def parse_project_plan(response):
+    """解析并校验结构化输出，允许响应被包在 ```json 代码块中"""
+    match = re.search(r'```(?:json)?\n(.*?)```', response, re.DOTALL)
+    text = match.group(1) if match else response
+    try:
+        data = json.loads(text.strip())
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    return validate_project_plan(data)
+
 def format_structure(structure, indent=0):
     lines = []
     for key, value in structure.items():
@@ -217,10 +2088,17 @@ def format_structure(structure, indent=0):
     return '\n'.join(lines)
 
 
+@traced('decompose_goal')
 def decompose_goal(goal, project_structure, file_sizes):
     """
     在这里对AI的提示进行强化，让AI在分解子任务时考虑文件大小、目录架构和用户需求。
     """
+    messages = _decompose_messages(goal, project_structure, file_sizes)
+    response = call_grok_api(messages)
+    plan = parse_subtasks(response)
+    return plan
+
+def _decompose_messages(goal, project_structure, file_sizes):
     example_subtasks = """
 Example of a full list of detailed subtasks (for illustration):
 1. Create a new file 'game/player.py' and write the Player class.
@@ -315,249 +2193,1513 @@ Example of a full list of detailed subtasks (for illustration):
             'Do not include tasks that create audio, image, or binary files. '
             'Do not include tasks that are not feasible in a pure text-based environment. '
             'If the goal is simple enough to achieve it with one script file, do not create any other script file. '
-            'If one of the script files is estimated to be bigger than 4KB, create temporary files(For example:snake_1.tmp, snake_2.tmp are the temporary file with parts of the code in snake.py). Otherwise, you don\'t need to do so. What\'s more temporary files should not be bigger than 4KB. You can create more temporary files if it is necessary. '
-	    'If there is no temporary files, don\'t \"Append\" anything in the tasks. If you want to \"Append\" something, you must say \"Append the content of \'xxx_n.tmp\' to \'xxx.py\'.\"(n is a number and xxx is the name of the script) '
+            + (_SINGLE_STEP_RULES if CONTINUATION_GENERATION else _CHUNKING_RULES) +
             'When planning tasks, consider three aspects: user requirements (the goal), the directory structure, and the estimated file sizes of each file. '
-            'If multiple temporary files need to be combined into one of the script files, please explicitly output the separate subtasks for appending them in order. '
             'No explanations, only list the tasks.\n\n'
             'Here is an example:\n\n' +
-            example_subtasks
+            (_single_step_example(example_subtasks) if CONTINUATION_GENERATION else example_subtasks)
         )
     }
 
-    user_message = {
-    'role': 'user',
-    'content': (
-        f'Based on the following goal, project directory structure, and estimated file sizes, please provide a detailed plan. '
-        f'Only use these operations: create/write file, delete file, append file content. '
-        f'No binary, audio, or image creation. All files are text-based.\n\n'
-        f'Goal:\n"{goal}"\n\n'
-        f'Project Directory Structure:\n{json.dumps(project_structure, indent=4)}\n\n'
-        f'Estimated File Sizes (in bytes):\n{json.dumps(file_sizes, indent=4)}\n\n'
-        'For some tasks, especially those begin with \"Create\" or \"Write\", provide the main action on the first line, followed by indented details using "-" marks(if it is necessary). '
-        'Each task should have implementation details that describe what the file should contain or do.'
-    )
-    }
-    messages = [system_message, user_message]
-    response = call_grok_api(messages)
-    plan = parse_subtasks(response)
-    return plan
+    user_message = {
+    'role': 'user',
+    'content': (
+        f'Based on the following goal, project directory structure, and estimated file sizes, please provide a detailed plan. '
+        f'Only use these operations: create/write file, delete file, append file content. '
+        f'No binary, audio, or image creation. All files are text-based.\n\n'
+        f'Goal:\n"{goal}"\n\n'
+        f'Project Directory Structure:\n{json.dumps(project_structure, indent=4)}\n\n'
+        f'Estimated File Sizes (in bytes):\n{json.dumps(file_sizes, indent=4)}\n\n'
+        'For some tasks, especially those begin with \"Create\" or \"Write\", provide the main action on the first line, followed by indented details using "-" marks(if it is necessary). '
+        'Each task should have implementation details that describe what the file should contain or do.'
+    )
+    }
+    return [system_message, user_message]
+
+_CHUNKING_RULES = (
+    'If one of the script files is estimated to be bigger than 4KB, create temporary files(For example:snake_1.tmp, snake_2.tmp are the temporary file with parts of the code in snake.py). Otherwise, you don\'t need to do so. What\'s more temporary files should not be bigger than 4KB. You can create more temporary files if it is necessary. '
+    'If there is no temporary files, don\'t \"Append\" anything in the tasks. If you want to \"Append\" something, you must say \"Append the content of \'xxx_n.tmp\' to \'xxx.py\'.\"(n is a number and xxx is the name of the script) '
+    'If multiple temporary files need to be combined into one of the script files, please explicitly output the separate subtasks for appending them in order. '
+)
+
+# 续写模式下输出长度不再受限，每个文件只需要一个创建步骤
+_SINGLE_STEP_RULES = (
+    'Create every file with exactly one task, no matter how big it is estimated to be: long outputs are continued automatically. '
+    'Do not create temporary files and do not use \"Append\" tasks. '
+)
+
+def _single_step_example(example_subtasks):
+    # 把示例中 main.py 的tmp分块、追加和删除步骤替换为一个创建步骤，并重新编号后面的步骤
+    head, rest = example_subtasks.split("7. Create a temporary file", 1)
+    tail = rest[rest.index("19. Create a new file 'readme.md'"):]
+    main_step = ("7. Create a new file 'main.py' and write the main program.\n"
+                 "     - Import `Player`, `Enemy`, `Level`, and `GameManager` classes and the utilities from 'utils/helpers.py'.\n"
+                 "     - Initialize `GameManager`, `Player`, and `Level`, e.g. `player = Player(start_position=(0, 0))`.\n"
+                 "     - Define the main game loop with `GameManager` updates, e.g. `game_manager.update(player_input)`.\n"
+                 "     - Handle game-over events, e.g. `if game_manager.is_game_over(): game_manager.end_game()`.\n")
+    tail = re.sub(r'^(\d+)\.', lambda m: f"{int(m.group(1)) - 11}.", tail, flags=re.MULTILINE)
+    return head + main_step + tail
+
+def parse_subtasks(response):
+    parser = SubtaskParser()
+    return parser.feed(response.strip()) + parser.close()
+
+class SubtaskParser:
+    """
+    增量地解析编号的计划：每次 feed 一段文本，返回其中已经完整的任务（主任务行加上它的"-"细节行）。
+    一个任务在下一个主任务开始时才算完整，最后一个任务由 close 返回。
+    """
+
+    def __init__(self):
+        self.pending = ''
+        self.current_task = []
+
+    def feed(self, text):
+        self.pending += text
+        *lines, self.pending = self.pending.split('\n')
+        steps = []
+        for line in lines:
+            self._line(line, steps)
+        return steps
+
+    def close(self):
+        steps = []
+        if self.pending:
+            self._line(self.pending, steps)
+            self.pending = ''
+        # 不要忘记添加最后一个任务
+        if self.current_task:
+            steps.append('\n'.join(self.current_task))
+            self.current_task = []
+        return steps
+
+    def _line(self, line, steps):
+        if not line.strip():
+            return
+
+        # 检查是否是新的主任务（以数字开头或是独立的create/append/delete操作）
+        if (re.match(r'^\d+\.', line.lstrip()) or
+            (not self.current_task and re.search(r'^(Create|Append|Delete)', line.strip(), re.IGNORECASE))):
+            # 如果已经收集了之前的任务，添加到步骤中
+            if self.current_task:
+                steps.append('\n'.join(self.current_task))
+                self.current_task = []
+
+            # 移除可能存在的行首数字编号
+            clean_line = re.sub(r'^\d+\.\s*', '', line.strip())
+            self.current_task.append(clean_line)
+        else:
+            # 这是子任务/细节行，添加到当前任务
+            if self.current_task:  # 只在有主任务时添加
+                stripped_line = line.strip()
+                # 如果行以连字符开头或者是纯操作指令，直接添加
+                if (stripped_line.startswith('-') or
+                    re.match(r'^(Create|Append|Delete)', stripped_line, re.IGNORECASE)):
+                    self.current_task.append(stripped_line)
+                # 否则，如果不是空行且不是独立操作，添加为子任务
+                elif stripped_line:
+                    self.current_task.append(f"- {stripped_line}")
+
+def build_filename_to_path_mapping(structure, current_path=''):
+    mapping = {}
+    for name, sub_structure in structure.items():
+        sanitized_name = sanitize_filename(name)
+        if '.' in name:
+            path = os.path.join(current_path, sanitized_name)
+            mapping[sanitized_name] = path
+        else:
+            new_path = os.path.join(current_path, sanitized_name)
+            mapping.update(build_filename_to_path_mapping(sub_structure, new_path))
+    return mapping
+
+def parse_size(size):
+    """
+    把估算的文件大小（例如 "2 KB"、"512 bytes"）转换为字节数，无法解析时返回0
+    """
+    match = re.search(r'([\d.]+)\s*(KB|MB|bytes|byte|B)?', str(size), re.IGNORECASE)
+    if not match:
+        return 0
+    try:
+        value = float(match.group(1))
+    except ValueError:
+        return 0
+    unit = (match.group(2) or 'KB').lower()
+    if unit == 'kb':
+        value *= 1024
+    elif unit == 'mb':
+        value *= 1024 * 1024
+    return int(value)
+
+def _normalize_plan_path(path, top_level_dir):
+    # 统一分隔符为'/'，并移除重复的顶级目录前缀
+    path = os.path.normpath(path).replace('\\', '/')
+    top_dir_normalized = top_level_dir.replace('\\', '/')
+    if path.startswith(top_dir_normalized + '/'):
+        path = path[len(top_dir_normalized) + 1:]
+    return path
+
+class StepOp(enum.Enum):
+    CREATE = 'create'
+    APPEND = 'append'
+    DELETE = 'delete'
+    UNKNOWN = 'unknown'
+
+class PlanStep:
+    """
+    编译后的计划步骤，执行器只运行这种步骤。
+
+    - op: StepOp
+    - text: 步骤原文（合并后的步骤是合成的文本），用于生成内容的提示词、日志和运行日志
+    - path: create/delete 的目标；src / dst: append 的源文件和目标文件。都是相对项目目录、以'/'分隔的路径，
+      无法从步骤中提取文件名时为None
+    - filename: create 步骤中写的文件名
+    - context: create 步骤作为上下文引用的文件
+    - sources: 合并进这个步骤的原始步骤文本
+    - size: create 步骤的文件估算大小（字节），没有估算时为None
+    """
+
+    __slots__ = ('op', 'text', 'path', 'src', 'dst', 'filename', 'context', 'sources', 'size')
+
+    def __init__(self, op, text, path=None, src=None, dst=None, filename=None, context=(), sources=None,
+                 size=None):
+        self.op = op
+        self.text = text
+        self.path = path
+        self.src = src
+        self.dst = dst
+        self.filename = filename
+        self.context = tuple(context)
+        self.sources = sources or [text]
+        self.size = size
+
+    @property
+    def task(self):
+        return self.text.split('\n')[0]
+
+    @property
+    def details(self):
+        return [line for line in self.text.split('\n')[1:] if line.strip()]
+
+    def reads(self):
+        """步骤读取的文件；作为上下文引用的文件也视为读取，保证生成时看到的上下文与执行顺序无关"""
+        if self.op is StepOp.APPEND and self.src and self.dst:
+            return {self.src}
+        if self.op is StepOp.CREATE and self.path:
+            return set(self.context) - {self.path}
+        return set()
+
+    def writes(self):
+        if self.op is StepOp.APPEND and self.src and self.dst:
+            return {self.dst}
+        if self.op in (StepOp.CREATE, StepOp.DELETE) and self.path:
+            return {self.path}
+        return set()
+
+    def __repr__(self):
+        target = f"{self.src} -> {self.dst}" if self.op is StepOp.APPEND else self.path
+        return f"PlanStep({self.op.value}, {target!r})"
+
+_STEP_NUMBER = re.compile(r'^\s*\d+\.\s*')
+
+_STEP_VERBS = {'create': StepOp.CREATE, 'write': StepOp.CREATE, 'append': StepOp.APPEND,
+               'delete': StepOp.DELETE, 'remove': StepOp.DELETE}
+_STEP_VERB_PATTERN = re.compile(r'^[\W_]*(?:\d+\.\s*)?(create|write|append|delete|remove)\b', re.IGNORECASE)
+
+def _classify_step(main_task):
+    match = _STEP_VERB_PATTERN.match(main_task)
+    if match:
+        return _STEP_VERBS[match.group(1).lower()]
+    # 没有以操作动词开头时，先去掉引号中的文件名再按关键词判断，
+    # 避免 'delete_utils.py'、'append_log.py' 这样的文件名被误判为删除或追加
+    unquoted = re.sub(r'([\'"`])[^\'"`]*\1', '', main_task).lower()
+    if 'delete' in unquoted:
+        return StepOp.DELETE
+    if 'append' in unquoted:
+        return StepOp.APPEND
+    if 'write' in unquoted or 'create' in unquoted:
+        return StepOp.CREATE
+    return StepOp.UNKNOWN
+
+def compile_step(step, filename_to_path, top_level_dir):
+    """把 parse_subtasks 得到的一个步骤编译为PlanStep，操作类型和路径只在这里解析一次"""
+    main_task = step.split('\n')[0]
+    op = _classify_step(main_task)
+    if op is StepOp.DELETE:
+        filename = extract_filename(main_task, operation='delete')
+        path = _normalize_plan_path(sanitize_filename(filename), top_level_dir) if filename else None
+        return PlanStep(op, step, path=path)
+    if op is StepOp.APPEND:
+        source, destination = extract_append_filenames(main_task)
+        if source and destination:
+            return PlanStep(op, step, src=_normalize_plan_path(source, top_level_dir),
+                            dst=_normalize_plan_path(destination, top_level_dir))
+        return PlanStep(op, step)
+    if op is StepOp.CREATE:
+        filename = extract_filename(main_task, operation='write')
+        if not filename:
+            return PlanStep(op, step)
+        path = _normalize_plan_path(_resolve_create_path(filename, filename_to_path, top_level_dir), top_level_dir)
+        context = []
+        if CONTEXT_TOKEN_BUDGET > 0:
+            context = [ref for ref in extract_context_references(step, filename_to_path, top_level_dir) if ref != path]
+        return PlanStep(op, step, path=path, filename=filename, context=context)
+    return PlanStep(op, step)
+
+def compile_plan(plan, filename_to_path, top_level_dir, file_sizes=None, optimize=True):
+    """
+    把计划编译为PlanStep列表，optimize为True时依次运行优化：
+
+    - 估算大小不超过 FOLD_MAX_BYTES 的文件，把 tmp分块 -> append -> delete 的链合并为一次直接写入
+    - 去掉删除从未创建过的文件的步骤
+    - 合并对同一个文件的重复写入
+    """
+    steps = [step if isinstance(step, PlanStep) else compile_step(step, filename_to_path, top_level_dir)
+             for step in plan]
+    if optimize:
+        steps = fold_append_chains(steps, top_level_dir, file_sizes)
+        steps = drop_dead_deletes(steps, filename_to_path, top_level_dir)
+        steps = merge_duplicate_writes(steps)
+    sizes = _size_lookup(file_sizes, top_level_dir)
+    for step in steps:
+        if step.op is StepOp.CREATE and step.path and step.size is None:
+            step.size = _estimated_size(sizes, step.path)
+    return steps
+
+def _size_lookup(file_sizes, top_level_dir):
+    sizes = {}
+    for path, size in (file_sizes or {}).items():
+        sizes[_normalize_plan_path(path, top_level_dir)] = parse_size(size)
+        sizes.setdefault(os.path.basename(path), parse_size(size))
+    return sizes
+
+def _estimated_size(sizes, path):
+    return sizes.get(path, sizes.get(os.path.basename(path)))
+
+def fold_append_chains(steps, top_level_dir, file_sizes=None, max_bytes=None):
+    """
+    计划会把估算较大的文件拆成若干tmp分块分别生成，再追加到目标文件并删除分块。
+    如果目标文件估算的最终大小不超过 max_bytes，就把整条链替换为一个直接生成目标文件的create步骤，
+    节省多余的API调用和文件操作。只合并结构简单的链：每个分块只创建一次、只被追加一次，
+    除了删除以外没有其他步骤读写分块，链的范围内也没有其他步骤读写目标文件。
+    """
+    max_bytes = FOLD_MAX_BYTES if max_bytes is None else max_bytes
+    if max_bytes <= 0:
+        return steps
+    sizes = _size_lookup(file_sizes, top_level_dir)
+    appends_by_dst = OrderedDict()
+    for i, step in enumerate(steps):
+        if step.op is StepOp.APPEND and step.dst:
+            appends_by_dst.setdefault(step.dst, []).append(i)
+
+    removed = set()
+    replacements = {}
+    for dst, append_indices in appends_by_dst.items():
+        chain = _append_chain(steps, dst, append_indices)
+        if chain is None:
+            continue
+        parts, involved = chain
+        estimate = sizes.get(dst, sizes.get(os.path.basename(dst)))
+        if estimate is None:
+            estimate = sum(sizes.get(steps[i].path, sizes.get(os.path.basename(steps[i].path), 0)) for i in parts)
+        if not estimate or estimate > max_bytes or involved & removed:
+            continue
+        chunk_paths = {steps[i].path for i in parts} - {dst}
+        lines = [f"Create a new file '{dst}' and write its complete content.",
+                 "- Write all of the following parts in this order as one file:"]
+        context = []
+        for n, i in enumerate(parts, 1):
+            lines.append(f"- Part {n}: {steps[i].task}")
+            lines.extend(detail for detail in steps[i].details if 'appended to' not in detail.lower())
+            context.extend(path for path in steps[i].context if path not in chunk_paths and path != dst)
+        first = min(involved)
+        replacements[first] = PlanStep(StepOp.CREATE, '\n'.join(lines), path=dst, filename=dst,
+                                       context=list(OrderedDict.fromkeys(context)),
+                                       sources=[source for i in sorted(involved) for source in steps[i].sources])
+        removed |= involved
+    if not replacements:
+        return steps
+    return [replacements[i] if i in replacements else step
+            for i, step in enumerate(steps) if i in replacements or i not in removed]
+
+def _append_chain(steps, dst, append_indices):
+    # 返回 (按追加顺序排列的内容步骤序号, 链涉及的所有步骤序号)，不满足合并条件时返回None
+    parts = []
+    involved = set(append_indices)
+    for a in append_indices:
+        src = steps[a].src
+        creates = [i for i, step in enumerate(steps) if step.op is StepOp.CREATE and step.path == src]
+        if len(creates) != 1 or creates[0] > a:
+            return None
+        for i, step in enumerate(steps):
+            if i in (creates[0], a):
+                continue
+            if step.op is StepOp.DELETE and step.path == src and i > a:
+                involved.add(i)
+            elif src in step.reads() | step.writes():
+                return None
+        parts.append(creates[0])
+        involved.add(creates[0])
+
+    # 目标文件可以在追加之前由一个create步骤写入开头部分
+    dst_creates = [i for i, step in enumerate(steps) if step.op is StepOp.CREATE and step.path == dst]
+    if len(dst_creates) > 1 or (dst_creates and dst_creates[0] > min(append_indices)):
+        return None
+    if dst_creates:
+        parts.insert(0, dst_creates[0])
+        involved.add(dst_creates[0])
+    first, last = min(involved), max(append_indices)
+    for i in range(first, last + 1):
+        if i not in involved and dst in steps[i].reads() | steps[i].writes():
+            return None
+    return parts, involved
+
+def drop_dead_deletes(steps, filename_to_path, top_level_dir):
+    """去掉删除从未创建过的文件（既不在目录结构中，之前的步骤也没有写入）的步骤"""
+    existing = {_normalize_plan_path(path, top_level_dir) for path in filename_to_path.values()}
+    kept = []
+    for step in steps:
+        if step.op is StepOp.DELETE and step.path and step.path not in existing:
+            continue
+        kept.append(step)
+        if step.op is StepOp.DELETE:
+            existing.discard(step.path)
+        else:
+            existing |= step.writes()
+    return kept
+
+def merge_duplicate_writes(steps):
+    """
+    对同一个文件的两次create之间如果没有步骤读写这个文件，前一次写入的内容会被直接覆盖，
+    把两者合并为一个步骤（放在前一次的位置，包含两者的要求），少生成一次内容。
+    """
+    steps = list(steps)
+    i = 0
+    while i < len(steps):
+        step = steps[i]
+        merged = False
+        if step.op is StepOp.CREATE and step.path:
+            for j in range(i + 1, len(steps)):
+                later = steps[j]
+                if later.op is StepOp.CREATE and later.path == step.path:
+                    details = [f"- {step.task}"] + step.details + later.details
+                    text = '\n'.join([later.task] + list(OrderedDict.fromkeys(details)))
+                    steps[i] = PlanStep(StepOp.CREATE, text, path=step.path, filename=later.filename,
+                                        context=list(OrderedDict.fromkeys(step.context + later.context)),
+                                        sources=step.sources + later.sources)
+                    del steps[j]
+                    merged = True
+                    break
+                if step.path in later.reads() | later.writes():
+                    break
+        # 合并后再检查同一个步骤，可能还有第三次写入
+        if not merged:
+            i += 1
+    return steps
+
+def build_step_graph(plan, filename_to_path, top_level_dir, file_sizes=None):
+    """
+    根据步骤（PlanStep或步骤文本）读写的文件构建依赖图（DAG）。
+
+    - 读或写某个文件的步骤要等待该文件之前的写入步骤（例如append要等待源tmp文件和目标文件的创建）
+    - 写某个文件的步骤要等待之前读取它的步骤（例如delete要等待所有读取该tmp文件的append）
+
+    返回 (deps, priority)：deps[i] 是步骤i依赖的步骤集合，
+    priority[i] 是从步骤i开始的关键路径长度（以估算的文件字节数计）。
+    """
+    graph = StepGraph(filename_to_path, top_level_dir, file_sizes)
+    for step in compile_plan(plan, filename_to_path, top_level_dir, optimize=False):
+        graph.add(step)
+    return graph.deps, graph.priorities()
+
+class StepGraph:
+    """
+    按计划顺序逐个加入步骤（PlanStep）、增量构建的依赖图，规则见 build_step_graph。
+    依赖总是指向更早的步骤，所以计划还在生成时就可以加入已经到达的步骤。
+    """
+
+    def __init__(self, filename_to_path, top_level_dir, file_sizes=None):
+        self.filename_to_path = filename_to_path
+        self.top_level_dir = top_level_dir
+        self.size_by_path = _size_lookup(file_sizes, top_level_dir)
+        self.deps = []
+        self.costs = []
+        self.last_writer = {}
+        self.readers = {}
+
+    def add(self, step):
+        """加入下一个步骤，返回它依赖的步骤集合"""
+        i = len(self.deps)
+        deps = set()
+        reads, writes = step.reads(), step.writes()
+        for path in reads | writes:
+            if path in self.last_writer:
+                deps.add(self.last_writer[path])
+        for path in writes:
+            deps.update(self.readers.get(path, ()))
+        for path in reads:
+            self.readers.setdefault(path, []).append(i)
+        for path in writes:
+            self.last_writer[path] = i
+            self.readers[path] = []
+        deps.discard(i)
+
+        # 只有创建文件的步骤需要调用AI，append/delete的开销可以忽略
+        cost = 1
+        if step.op is StepOp.CREATE and step.path:
+            if step.size is None:
+                step.size = _estimated_size(self.size_by_path, step.path)
+            cost += step.size if step.size is not None else 1024
+        self.deps.append(deps)
+        self.costs.append(cost)
+        return deps
+
+    def priorities(self):
+        """每个步骤开始的关键路径长度；倒序计算即可"""
+        dependents = [[] for _ in self.deps]
+        for i, d in enumerate(self.deps):
+            for j in d:
+                dependents[j].append(i)
+        priority = [0] * len(self.deps)
+        for i in reversed(range(len(self.deps))):
+            priority[i] = self.costs[i] + max((priority[j] for j in dependents[i]), default=0)
+        return priority
+
+class ProjectIndex:
+    """
+    执行器维护的项目文件索引，代替每个步骤开始时对项目目录的完整遍历。
+
+    每个条目保存文件内容和元数据（size、mtime、sha256）。执行器在写入、追加和删除文件时
+    更新索引；读取时只通过 os.stat 比较 mtime 和 size 判断文件是否在外部被修改，
+    只有过期的条目才会重新读取。
+    """
+
+    TEXT_EXTENSIONS = ('.py', '.txt', '.md', '.tmp')
+
+    def __init__(self, project_folder, extensions=TEXT_EXTENSIONS):
+        self.project_folder = project_folder
+        self.extensions = extensions
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def _rel_path(self, full_path):
+        return os.path.relpath(full_path, self.project_folder)
 
-def parse_subtasks(response):
-    steps = []
-    current_task = []
-    lines = response.strip().split('\n')
-    
-    for line in lines:
-        if not line.strip():
-            continue
-            
-        # 检查是否是新的主任务（以数字开头或是独立的create/append/delete操作）
-        if (re.match(r'^\d+\.', line.lstrip()) or 
-            (not current_task and re.search(r'^(Create|Append|Delete)', line.strip(), re.IGNORECASE))):
-            # 如果已经收集了之前的任务，添加到步骤中
-            if current_task:
-                steps.append('\n'.join(current_task))
-                current_task = []
-            
-            # 移除可能存在的行首数字编号
-            clean_line = re.sub(r'^\d+\.\s*', '', line.strip())
-            current_task.append(clean_line)
+    def _tracked(self, full_path):
+        return full_path.endswith(self.extensions)
+
+    def scan(self):
+        """遍历一次项目目录，建立初始索引"""
+        for root, dirs, files in os.walk(self.project_folder):
+            for fname in files:
+                full_path = os.path.join(root, fname)
+                if self._tracked(full_path):
+                    self.refresh(full_path)
+        return self
+
+    def _store(self, full_path, content):
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return
+        with self._lock:
+            self.entries[self._rel_path(full_path)] = {
+                'content': content,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': hashlib.sha256(content.encode('utf-8')).hexdigest()
+            }
+
+    def refresh(self, full_path):
+        """从磁盘重新读取一个文件，文件不存在时从索引中删除"""
+        try:
+            with open(full_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError):
+            self.record_delete(full_path)
+            return None
+        self._store(full_path, content)
+        return content
+
+    def record_write(self, full_path, content):
+        if self._tracked(full_path):
+            self._store(full_path, content)
+
+    def record_append(self, full_path, appended):
+        if not self._tracked(full_path):
+            return
+        with self._lock:
+            entry = self.entries.get(self._rel_path(full_path))
+        if entry is None:
+            self.refresh(full_path)
         else:
-            # 这是子任务/细节行，添加到当前任务
-            if current_task:  # 只在有主任务时添加
-                stripped_line = line.strip()
-                # 如果行以连字符开头或者是纯操作指令，直接添加
-                if (stripped_line.startswith('-') or 
-                    re.match(r'^(Create|Append|Delete)', stripped_line, re.IGNORECASE)):
-                    current_task.append(stripped_line)
-                # 否则，如果不是空行且不是独立操作，添加为子任务
-                elif stripped_line:
-                    current_task.append(f"- {stripped_line}")
-    
-    # 不要忘记添加最后一个任务
-    if current_task:
-        steps.append('\n'.join(current_task))
-    
-    return steps
+            self._store(full_path, entry['content'] + appended)
 
-def build_filename_to_path_mapping(structure, current_path=''):
-    mapping = {}
-    for name, sub_structure in structure.items():
-        sanitized_name = sanitize_filename(name)
-        if '.' in name:
-            path = os.path.join(current_path, sanitized_name)
-            mapping[sanitized_name] = path
+    def record_delete(self, full_path):
+        with self._lock:
+            self.entries.pop(self._rel_path(full_path), None)
+
+    def read(self, full_path):
+        """返回文件内容；只有mtime或size与索引不一致时才重新读取磁盘"""
+        rel_path = self._rel_path(full_path)
+        with self._lock:
+            entry = self.entries.get(rel_path)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            self.record_delete(full_path)
+            return None
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['content']
+        return self.refresh(full_path)
+
+    def metadata(self, rel_path):
+        with self._lock:
+            entry = self.entries.get(rel_path)
+        if entry is None:
+            return None
+        return {key: entry[key] for key in ('size', 'mtime', 'hash')}
+
+    def files(self):
+        """返回 {相对路径: 内容}，作为生成代码时的上下文"""
+        with self._lock:
+            rel_paths = list(self.entries)
+        files = {}
+        for rel_path in rel_paths:
+            content = self.read(os.path.join(self.project_folder, rel_path))
+            if content is not None:
+                files[rel_path] = content
+        return files
+
+class StagingArea:
+    """
+    内存中的暂存文件系统。执行计划时的创建、追加和删除只修改内存中的文件树，
+    commit() 时每个最终文件只用临时文件加 os.replace 原子地写入一次，暂存的删除操作也在这时执行。
+    tmp分块文件在内存中创建、追加和删除，不会落盘。
+
+    commit 中途失败时会恢复已经写入的文件；执行失败时调用 discard() 丢弃暂存内容，项目目录保持不变。
+    未暂存的文件从 index（ProjectIndex）或磁盘读取。
+    无法作为文件写入的目标（目录，或者上级路径是文件）在 write()/append() 时就抛出异常，
+    只让这一个步骤失败；commit 时才发现的这类目标被跳过，不影响其他文件。
+
+    流式生成的文件通过 stream() 边生成边写入目标同目录下的临时文件（spooled），commit 时改名为目标文件，
+    内容不在内存中保留。spool 为False时流式内容也保存在内存中。
+
+    disk 为False时项目目录不在磁盘上（例如直接写入归档）：没有暂存的路径视为不存在，从不读取 project_folder
+    下的磁盘文件或 index，结果与当前目录中是否碰巧有同名的目录无关。此时 spool 为True时所有暂存的文件
+    （不只是流式生成的）都写入一个私有的临时目录，内存中最多只有正在读写的一个文件，discard() 时删除该目录。
+    """
+
+    def __init__(self, project_folder, index=None, spool=True, disk=True):
+        self.project_folder = project_folder
+        self.index = index
+        self.spool = spool
+        self.disk = disk
+        self.files = {}
+        self.spooled = {}
+        self.deleted = set()
+        self._spool_dir = None
+        self._lock = threading.Lock()
+
+    def _spool_file(self, path):
+        # 在私有的临时目录中为 path 创建一个新的临时文件（disk 为False时使用）
+        with self._lock:
+            if self._spool_dir is None:
+                self._spool_dir = tempfile.mkdtemp(prefix='xai-staging-')
+            directory = self._spool_dir
+        return tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.staged')
+
+    def _spools_writes(self):
+        return self.spool and not self.disk
+
+    def _store_spooled(self, path, tmp_path):
+        with self._lock:
+            self.files.pop(path, None)
+            self.deleted.discard(path)
+            previous = self.spooled.get(path)
+            self.spooled[path] = tmp_path
+        _remove_file(previous)
+
+    def exists(self, path):
+        with self._lock:
+            if path in self.files or path in self.spooled:
+                return True
+            if path in self.deleted or not self.disk:
+                return False
+        return os.path.exists(path)
+
+    def read(self, path):
+        with self._lock:
+            if path in self.files:
+                return self.files[path]
+            if path in self.deleted:
+                return None
+            spooled = self.spooled.get(path)
+        if spooled is not None:
+            with open(spooled, 'r', encoding='utf-8') as f:
+                return f.read()
+        if not self.disk:
+            return None
+        if self.index is not None:
+            content = self.index.read(path)
+            if content is not None:
+                return content
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def check_writable(self, path):
+        """path 无法作为文件写入时抛出异常：它是目录（磁盘上或者暂存的文件在它下面），或者上级路径是文件"""
+        with self._lock:
+            staged = set(self.files) | set(self.spooled)
+        reason = _unwritable_reason(path) if self.disk else None
+        if reason is None:
+            prefix = path + os.sep
+            if any(other.startswith(prefix) for other in staged):
+                reason = 'it is a directory'
+            else:
+                parent = os.path.dirname(path)
+                while parent and parent != self.project_folder and parent != os.path.dirname(parent):
+                    if parent in staged:
+                        reason = f"{parent} is a file"
+                        break
+                    parent = os.path.dirname(parent)
+        if reason is not None:
+            raise Exception(f"Error: cannot write {path}: {reason}")
+
+    def write(self, path, content):
+        self.check_writable(path)
+        if self._spools_writes():
+            fd, tmp_path = self._spool_file(path)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            self._store_spooled(path, tmp_path)
+            return
+        with self._lock:
+            self.files[path] = content
+            self.deleted.discard(path)
+            spooled = self.spooled.pop(path, None)
+        _remove_file(spooled)
+
+    def append(self, path, text):
+        self.check_writable(path)
+        if self._spools_writes():
+            with self._lock:
+                spooled = self.spooled.get(path)
+            if spooled is None:
+                self.write(path, text)
+            else:
+                # 追加到临时文件末尾，不把整个文件读入内存
+                with open(spooled, 'a', encoding='utf-8') as f:
+                    f.write(text)
+            return
+        current = self.read(path) or ''
+        with self._lock:
+            self.files[path] = current + text
+            self.deleted.discard(path)
+            spooled = self.spooled.pop(path, None)
+        _remove_file(spooled)
+
+    def delete(self, path):
+        with self._lock:
+            self.files.pop(path, None)
+            self.deleted.add(path)
+            spooled = self.spooled.pop(path, None)
+        _remove_file(spooled)
+
+    @contextlib.contextmanager
+    def stream(self, path):
+        """
+        返回流式写入 path 的文本文件对象。内容写入目标同目录（目录还不存在时为项目目录；disk 为False时为
+        私有的临时目录）的临时文件，正常结束后暂存为 path，出错时删除临时文件
+        """
+        self.check_writable(path)
+        directory = None
+        if self.disk:
+            directory = next((d for d in (os.path.dirname(path), self.project_folder) if os.path.isdir(d)), None)
+        if not self.spool or (self.disk and directory is None):
+            buffer = io.StringIO()
+            yield buffer
+            self.write(path, buffer.getvalue())
+            return
+        if self.disk:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.staged')
         else:
-            new_path = os.path.join(current_path, sanitized_name)
-            mapping.update(build_filename_to_path_mapping(sub_structure, new_path))
-    return mapping
+            fd, tmp_path = self._spool_file(path)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            _remove_file(tmp_path)
+            raise
+        self._store_spooled(path, tmp_path)
 
-def execute_plan(plan, project_folder, project_structure, filename_to_path, goal, top_level_dir):
-    logs = []
-    for step in plan:
-        logs.extend(execute_step(step, project_folder, project_structure, filename_to_path, goal, top_level_dir))
-    return logs
+    def snapshot(self):
+        """返回 {相对路径: 内容}：项目索引（disk 为False时不包括）叠加暂存的修改"""
+        files = self.index.files() if self.index is not None and self.disk else {}
+        with self._lock:
+            for path in self.deleted:
+                files.pop(os.path.relpath(path, self.project_folder), None)
+            for path, content in self.files.items():
+                files[os.path.relpath(path, self.project_folder)] = content
+            spooled = list(self.spooled)
+        for path in spooled:
+            content = self.read(path)
+            if content is not None:
+                files[os.path.relpath(path, self.project_folder)] = content
+        return files
 
-def execute_step(step, project_folder, project_structure, filename_to_path, goal, top_level_dir):
-    logs = []
-    main_task = step.split('\n')[0]
-    print(f"\nExecuting task:\n{main_task}")
-    logs.append(f"\nExecuting task:\n{step}")
-    print(f"Top level directory: {top_level_dir}")
-    logs.append(f"Top level directory: {top_level_dir}")
+    def export(self, sink, prefix, paths):
+        """
+        按 paths（相对路径，例如计划中各步骤写入的文件，按计划顺序）把这些文件的最终内容逐个写入 sink
+        （例如ArchiveSink），条目名加上 prefix。每次只读入一个文件；已经删除或从未写入的路径跳过。返回写入的文件数
+        """
+        count = 0
+        for path in dict.fromkeys(paths):
+            content = self.read(os.path.normpath(os.path.join(self.project_folder, path)))
+            if content is None:
+                continue
+            sink.add(posixpath.join(prefix, path.replace(os.sep, '/')), content)
+            count += 1
+        return count
 
-    # Build existing files context
-    existing_files = {}
-    for root, dirs, files in os.walk(project_folder):
-        for fname in files:
-            if fname.endswith('.py') or fname.endswith('.txt') or fname.endswith('.md') or fname.endswith('.tmp'):
-                file_path = os.path.join(root, fname)
-                rel_path = os.path.relpath(file_path, project_folder)
-                if os.path.isfile(file_path):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        existing_files[rel_path] = f.read()
-
-    step_lower = main_task.lower()
-
-    # 处理删除操作
-    if 'delete' in step_lower:
-        filename = extract_filename(main_task, operation='delete')
-        if filename:
-            # 规范化文件名
-            sanitized_filename = sanitize_filename(filename)
-            
-            # 统一路径分隔符为 '/'
-            sanitized_filename = sanitized_filename.replace('\\', '/')
-            top_level_dir_normalized = top_level_dir.replace('\\', '/')
+    def commit(self):
+        """把暂存的修改写入磁盘，返回写入的文件数和从磁盘删除的文件数"""
+        with self._lock:
+            files = dict(self.files)
+            spooled = dict(self.spooled)
+            deleted = set(self.deleted)
+        # 暂存之后才变得无法写入的目标（例如外部创建了同名目录）只跳过这个文件，其他文件照常提交
+        for staged in (files, spooled):
+            for path in list(staged):
+                reason = _unwritable_reason(path)
+                if reason is not None:
+                    log_event(f"Skipped {path}: {reason}", level='error')
+                    del staged[path]
+        originals = []
+        removed = 0
+        try:
+            for path in list(files) + list(spooled):
+                original = None
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        original = f.read()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                originals.append((path, original))
+                if path in files:
+                    _atomic_write(path, files[path])
+                    if self.index is not None:
+                        self.index.record_write(path, files[path])
+                else:
+                    os.replace(spooled[path], path)
+                    if self.index is not None:
+                        self.index.refresh(path)
+            for path in deleted:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        originals.append((path, f.read()))
+                    os.remove(path)
+                    removed += 1
+                if self.index is not None:
+                    self.index.record_delete(path)
+        except BaseException:
+            self._restore(originals)
+            raise
+        self.discard()
+        return len(files) + len(spooled), removed
 
-            # 移除重复的顶级目录前缀
-            if sanitized_filename.startswith(top_level_dir_normalized + '/'):
-                sanitized_filename = sanitized_filename[len(top_level_dir_normalized) + 1:]
-            
-            # 构建完整路径
-            full_path = os.path.normpath(os.path.join(project_folder, sanitized_filename))
-            
-            print(f"Attempting to delete: {full_path}")
-            logs.append(f"Attempting to delete: {full_path}")
-            
+    def _restore(self, originals):
+        for path, original in reversed(originals):
             try:
-                if os.path.exists(full_path):
-                    os.remove(full_path)
-                    logs.append(f"Deleted file: {full_path}")
-                    print(f"Deleted file: {full_path}")
+                if original is None:
+                    if os.path.exists(path):
+                        os.remove(path)
                 else:
-                    logs.append(f"File not found: {full_path}")
-                    print(f"File not found: {full_path}")
-            except Exception as e:
-                logs.append(f"Error deleting file {full_path}: {e}")
-                print(f"Error deleting file {full_path}: {e}")
+                    _atomic_write(path, original)
+            except OSError as e:
+                log_event(f"Failed to roll back {path}: {e}", 'error')
+            if self.index is not None:
+                self.index.refresh(path)
+
+    def discard(self):
+        with self._lock:
+            self.files.clear()
+            self.deleted.clear()
+            spooled = list(self.spooled.values())
+            self.spooled.clear()
+            spool_dir, self._spool_dir = self._spool_dir, None
+        for tmp_path in spooled:
+            _remove_file(tmp_path)
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+def _remove_file(path):
+    if path is not None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _unwritable_reason(path):
+    # 磁盘上的 path 无法作为文件写入的原因，可以写入时返回None
+    if os.path.isdir(path):
+        return 'it is a directory'
+    parent = os.path.dirname(path)
+    while parent and not os.path.exists(parent):
+        if parent == os.path.dirname(parent):
+            break
+        parent = os.path.dirname(parent)
+    if parent and os.path.exists(parent) and not os.path.isdir(parent):
+        return f"{parent} is a file"
+    return None
+
+class ArchiveSink:
+    """
+    把生成的项目直接写入tar.gz或zip归档，target 为路径或可写的二进制文件对象（可以不支持seek）。
+
+    条目按 add() 的顺序逐个压缩写出，sink 本身除了当前条目不额外占用内存（生成项目时内容先暂存在
+    StagingArea(disk=False) 的临时目录中，执行和校验完成后才按计划顺序写入）；时间戳、属主和权限都是固定值，
+    相同的内容总是得到相同的归档字节，可以按内容缓存。写入路径时先写同目录的临时文件，close() 时原子地替换。
+    """
+
+    FORMATS = ('tar.gz', 'zip')
+
+    def __init__(self, target, format=None):
+        if format is None:
+            name = target if isinstance(target, str) else getattr(target, 'name', '')
+            format = 'zip' if str(name).lower().endswith('.zip') else 'tar.gz'
+        if format not in self.FORMATS:
+            raise Exception(f"Error: unsupported archive format '{format}', expected one of {self.FORMATS}")
+        self.target = target
+        self.format = format
+        self.count = 0
+        self._tmp_path = None
+        if isinstance(target, str):
+            fd, self._tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix='.',
+                                                  suffix='.partial')
+            self._raw = os.fdopen(fd, 'wb')
         else:
-            logs.append("No filename specified for deletion.")
-            print("No filename specified for deletion.")
-        
-        return logs
+            self._raw = target
+        self._gzip = None
+        if format == 'zip':
+            self._archive = zipfile.ZipFile(self._raw, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self._gzip = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw, mtime=0)
+            self._archive = tarfile.open(fileobj=self._gzip, mode='w|')
 
-    # Handle append operation
-    if 'append' in step_lower:
-        # We assume format: "Append the content of 'source' to 'destination'"
-        # Extract source and destination filenames
-        source, destination = extract_append_filenames(main_task)
-        # Debug logs
-        print(f"Extracted source: {source}, destination: {destination}")
-        logs.append(f"Extracted source: {source}, destination: {destination}")
-        if source and destination:
-            # Normalize paths first
-            source_norm = os.path.normpath(source)
-            destination_norm = os.path.normpath(destination)
-
-            # Remove top_level_dir prefix if present
-            if source_norm.startswith(top_level_dir + os.sep):
-                source_norm = source_norm[len(top_level_dir) + len(os.sep):]
-            if destination_norm.startswith(top_level_dir + os.sep):
-                destination_norm = destination_norm[len(top_level_dir) + len(os.sep):]
-
-            # Now, join with project_folder
-            src_path = os.path.join(project_folder, source_norm)
-            dst_path = os.path.join(project_folder, destination_norm)
-
-            # Debug log
-            print(f"Source path after normalization and stripping: {src_path}")
-            print(f"Destination path after normalization and stripping: {dst_path}")
-            logs.append(f"Source path after normalization and stripping: {src_path}")
-            logs.append(f"Destination path after normalization and stripping: {dst_path}")
-
-            # Check existence
-            if os.path.exists(src_path) and os.path.exists(dst_path):
-                with open(src_path, 'r', encoding='utf-8') as sf:
-                    src_content = sf.read()
-                with open(dst_path, 'a', encoding='utf-8') as df:
-                    df.write('\n' + src_content)
-                logs.append(f"Appended content of {src_path} to {dst_path}")
-                print(f"Appended content of {src_path} to {dst_path}")
-            else:
-                logs.append(f"Source or destination file not found for append: {src_path}, {dst_path}")
-                print(f"Source or destination file not found for append: {src_path}, {dst_path}")
+    def add(self, name, content):
+        if escapes_project(name):
+            raise Exception(f"Error: archive entry '{name}' points outside the archive")
+        data = content.encode('utf-8')
+        if self.format == 'zip':
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self._archive.writestr(info, data)
         else:
-            logs.append("Could not extract source/destination for append operation.")
-            print("Could not extract source/destination for append operation.")
-        return logs
-
-    # Handle create/write operation (default)
-    if any(keyword in step_lower for keyword in ['write', 'create']):
-        filename_from_step = extract_filename(main_task, operation='write')
-        if filename_from_step:
-            filename = filename_from_step
-            # 将路径统一为'/'
-            filename = filename.replace('\\', '/')
-            top_dir_normalized = top_level_dir.replace('\\', '/')
-
-            sanitized_filename = sanitize_filename(filename)
-            # 如果在filename_to_path中找不到，说明是新文件，可直接用sanitized_filename作为relative_path
-            if sanitized_filename in filename_to_path:
-                relative_path = filename_to_path[sanitized_filename]
-            else:
-                relative_path = sanitized_filename
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = 0
+            self._archive.addfile(info, io.BytesIO(data))
+        self.count += 1
+
+    def _close_streams(self):
+        self._archive.close()
+        if self._gzip is not None:
+            self._gzip.close()
+        if self._tmp_path is not None:
+            self._raw.close()
+
+    def close(self):
+        self._close_streams()
+        if self._tmp_path is not None:
+            os.replace(self._tmp_path, self.target)
+
+    def abort(self):
+        """放弃写了一半的归档（写入路径时删除临时文件）"""
+        try:
+            self._close_streams()
+        finally:
+            if self._tmp_path is not None and os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+
+class RunJournal:
+    """
+    项目目录下 .xai_journal 中崩溃安全的运行日志：
+
+    - journal.jsonl: 追加写入的记录（目标、目录结构、大小估算、计划，以及每个步骤的状态和内容的sha256），
+      每条记录写入后立即fsync，崩溃时最多丢失正在写入的那一条。流水线模式下计划的每个步骤到达时就记录，
+      计划生成完后再记录完整的计划
+    - blobs/<sha256>: 生成的文件内容，在引用它的记录之前原子地写入
+
+    - plan.txt: 最近一次计划的文本，可以编辑后用 --update --plan 增量更新项目
+
+    步骤按内容（去掉序号的步骤文本的sha256）识别，所以重新生成的计划中相同的步骤也能复用已经生成的内容。
+    """
+
+    DIRNAME = '.xai_journal'
+
+    def __init__(self, project_folder):
+        self.project_folder = project_folder
+        self.path = os.path.join(project_folder, self.DIRNAME)
+        self.blob_dir = os.path.join(self.path, 'blobs')
+        self.journal_path = os.path.join(self.path, 'journal.jsonl')
+        self.run = None
+        self.plan = None
+        # 流水线模式下已经到达、但计划还没有生成完的步骤
+        self.partial_plan = []
+        # 执行时是否对计划运行了优化（流水线模式逐步编译，不优化），继续运行时按同样的方式编译
+        self.optimized = True
+        self.finished = False
+        self.steps = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, project_folder, goal, structure, file_sizes):
+        """开始一次新的运行，覆盖目录中已有的日志"""
+        journal = cls(project_folder)
+        os.makedirs(journal.blob_dir, exist_ok=True)
+        journal._file = open(journal.journal_path, 'w', encoding='utf-8')
+        journal.record_run(goal, structure, file_sizes)
+        return journal
+
+    @classmethod
+    def load(cls, project_folder):
+        """读取已有的日志以便继续运行；崩溃时写了一半的最后一行会被截掉"""
+        journal = cls(project_folder)
+        if not os.path.exists(journal.journal_path):
+            raise Exception(f"Error: no run journal found in {project_folder}")
+        valid_bytes = 0
+        with open(journal.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                journal._replay(record)
+                valid_bytes += len(line)
+        if journal.run is None:
+            raise Exception(f"Error: run journal in {project_folder} is empty")
+        os.makedirs(journal.blob_dir, exist_ok=True)
+        journal._file = open(journal.journal_path, 'a', encoding='utf-8')
+        journal._file.truncate(valid_bytes)
+        return journal
+
+    def _replay(self, record):
+        event = record.get('event')
+        if event == 'run':
+            self.run = record
+        elif event == 'plan':
+            self.plan = record['plan']
+            self.optimized = record.get('optimized', True)
+            self.partial_plan = []
+        elif event == 'plan_step':
+            self.partial_plan.append(record['text'])
+        elif event == 'step':
+            self.steps[record['step']] = record
+        elif event == 'finished':
+            self.finished = True
+
+    def _append(self, record):
+        with self._lock:
+            self._replay(record)
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    @staticmethod
+    def step_key(step):
+        # 去掉序号：插入或删除其他步骤后，没有变化的步骤仍然对应同一条记录
+        return hashlib.sha256(_STEP_NUMBER.sub('', step.text, count=1).encode('utf-8')).hexdigest()
+
+    def record_run(self, goal, structure, file_sizes):
+        self._append({'event': 'run', 'goal': goal, 'structure': structure, 'file_sizes': file_sizes,
+                      'time': time.time()})
+
+    def record_plan(self, plan, optimized=True):
+        _atomic_write(os.path.join(self.path, 'plan.txt'), format_plan(plan))
+        self._append({'event': 'plan', 'plan': plan, 'optimized': optimized})
+
+    def record_plan_step(self, step):
+        """流水线模式下记录刚到达的计划步骤（在执行它之前）"""
+        self._append({'event': 'plan_step', 'text': step})
+
+    @staticmethod
+    def content_hash(content):
+        """内容的sha256。比较磁盘上的文件时按文本模式读取（换行统一为LF），与记录时的内容一致"""
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-            # 再次统一relative_path的分隔符为'/'
-            relative_path = relative_path.replace('\\', '/')
+    def record_content(self, step, relative_path, content):
+        """保存步骤生成的内容，再记录步骤完成"""
+        sha = self.content_hash(content)
+        blob_path = os.path.join(self.blob_dir, sha)
+        if not os.path.exists(blob_path):
+            _atomic_write(blob_path, content)
+        self._append({'event': 'step', 'step': self.step_key(step), 'task': step.task,
+                      'status': 'generated', 'path': relative_path.replace('\\', '/'), 'sha256': sha})
 
-            # 如果relative_path以top_level_dir开头，则移除
-            if relative_path.startswith(top_dir_normalized + '/'):
-                relative_path = relative_path[len(top_dir_normalized) + 1:]
+    def invalidate(self, step):
+        """丢弃步骤已经生成的内容，下一次执行时重新生成"""
+        self._append({'event': 'step', 'step': self.step_key(step), 'task': step.task, 'status': 'invalidated'})
 
-            print(f"Relative path for creation: {relative_path}")
-            logs.append(f"Relative path for creation: {relative_path}")
+    def generated_files(self):
+        """运行日志中记录的已生成文件 {相对路径: sha256}"""
+        return {record['path']: record['sha256'] for record in self.steps.values()
+                if record.get('status') == 'generated'}
 
+    def record_failure(self, step, error):
+        self._append({'event': 'step', 'step': self.step_key(step), 'task': step.task,
+                      'status': 'failed', 'error': str(error)})
+
+    def content(self, step):
+        """
+        返回上一次运行为这个步骤生成的内容：优先读取保存的内容，其次是哈希一致的磁盘文件。
+        没有记录或哈希都对不上时返回None。
+        """
+        record = self.steps.get(self.step_key(step))
+        if record is None or record.get('status') != 'generated':
+            return None
+        candidates = [os.path.join(self.blob_dir, record['sha256']),
+                      os.path.join(self.project_folder, record['path'])]
+        for path in candidates:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            if self.content_hash(content) == record['sha256']:
+                return content
+        return None
+
+    def pending_steps(self, steps):
+        """编译后的计划中还需要调用API生成内容的步骤序号"""
+        return [i for i, step in enumerate(steps) if step.op is StepOp.CREATE and self.content(step) is None]
+
+    def prepare_resume(self, steps, project_folder, staging=None):
+        """
+        继续运行前清空计划中被追加内容的文件：所有步骤会按计划重新执行（已生成的内容不再调用API），
+        避免上一次运行已经追加过的内容被重复追加。传入 staging 时在暂存区中清空，提交时才修改磁盘。
+        """
+        for step in steps:
+            if step.op is not StepOp.APPEND:
+                continue
+            for path in step.writes():
+                full_path = os.path.join(project_folder, path)
+                if staging is not None:
+                    if staging.exists(full_path):
+                        staging.write(full_path, '')
+                elif os.path.exists(full_path):
+                    _atomic_write(full_path, '')
+
+    def finish(self):
+        self._append({'event': 'finished', 'time': time.time()})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def _context_files(step, action, project_folder, project_structure, filename_to_path, top_level_dir, goal,
+                   index, staging):
+    """
+    为create步骤构建上下文（见 build_context），并记录附带的文件和估算的prompt token数
+    """
+    files = {}
+    if CONTEXT_TOKEN_BUDGET > 0:
+        def read_file(rel_path):
+            if escapes_project(rel_path):
+                return None
+            full_path = os.path.normpath(os.path.join(project_folder, rel_path))
+            if staging is not None:
+                return staging.read(full_path)
+            if index is not None:
+                return index.read(full_path)
+            try:
+                with open(full_path, 'r', encoding='utf-8') as f:
+                    return f.read()
+            except OSError:
+                return None
+
+        files, included = build_context(step.text, action['relative_path'], read_file, filename_to_path,
+                                        top_level_dir, references=step.context)
+        if included:
+            summary = ', '.join(f"{path} ({kind}, {tokens} tokens)" for path, kind, tokens in included)
+            log_event(f"Context files: {summary}")
+
+    messages = _content_messages(step.text, action['relative_path'], project_structure, files, goal)
+    prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+    log_event(f"Prompt tokens (estimated): {prompt_tokens}")
+    return files
+
+@traced('execute_plan')
+def execute_plan(plan, project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                 file_sizes=None, max_workers=MAX_WORKERS, stream=False, index=None, staged=None, journal=None):
+    """
+    并行执行计划中互不依赖的步骤。就绪的步骤按关键路径长度（估算大小）从大到小调度，
+    返回执行结果的摘要（见 plan_summary），详细日志通过 log_event 输出。stream为True时以流式方式生成文件内容。
+    index 为项目的ProjectIndex，为None时扫描项目目录创建一个。
+    staged 为True时（None表示使用 STAGED_WRITES）所有修改先暂存在内存中，全部步骤结束后再提交到磁盘。
+    journal 为可选的RunJournal：已经生成过的内容直接复用，新生成的内容写入日志。
+    plan 为步骤文本时先用 compile_plan 编译并优化。
+    """
+    plan = _compiled(plan, filename_to_path, top_level_dir, file_sizes)
+    index = index or ProjectIndex(project_folder).scan()
+    staging = _start_staging(project_folder, index, staged)
+    deps, priority = build_step_graph(plan, filename_to_path, top_level_dir, file_sizes)
+    dependents = [[] for _ in plan]
+    for i, d in enumerate(deps):
+        for j in d:
+            dependents[j].append(i)
+    remaining = [len(d) for d in deps]
+    ready = [(-priority[i], i) for i in range(len(plan)) if not deps[i]]
+    heapq.heapify(ready)
+    results = [None] * len(plan)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+            while ready or running:
+                while ready and len(running) < max_workers:
+                    _, i = heapq.heappop(ready)
+                    # 复制上下文，让工作线程中的span挂在当前的tracer下
+                    future = pool.submit(contextvars.copy_context().run, execute_step, plan[i], project_folder,
+                                         project_structure, filename_to_path, goal, top_level_dir, stream, index,
+                                         staging, journal)
+                    running[future] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        results[i] = 'failed'
+                        log_event(f"Failed to execute step {i + 1}: {e}", level='error')
+                    for j in dependents[i]:
+                        remaining[j] -= 1
+                        if remaining[j] == 0:
+                            heapq.heappush(ready, (-priority[j], j))
+    except BaseException:
+        if staging is not staged:
+            _discard_staging(staging)
+        raise
+
+    if staging is not staged:
+        _commit_staging(staging, project_folder)
+    return plan_summary(results)
+
+def plan_summary(outcomes):
+    """
+    把每个步骤的结果（'ok'、'skipped'、'failed'）汇总成计划执行的摘要：
+    {'steps', 'ok', 'skipped', 'failed', 'failed_steps'}，failed_steps 为失败步骤的序号（从1开始）
+    """
+    summary = {'steps': len(outcomes), 'ok': 0, 'skipped': 0, 'failed': 0, 'failed_steps': []}
+    for i, outcome in enumerate(outcomes):
+        summary[outcome] += 1
+        if outcome == 'failed':
+            summary['failed_steps'].append(i + 1)
+    return summary
+
+def merge_summaries(*summaries):
+    """合并多个摘要：计数相加，列表拼接"""
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            merged[key] = merged[key] + value if key in merged else (list(value) if isinstance(value, list) else value)
+    return merged
+
+def _compiled(plan, filename_to_path, top_level_dir, file_sizes):
+    if all(isinstance(step, PlanStep) for step in plan):
+        return plan
+    return compile_plan(plan, filename_to_path, top_level_dir, file_sizes)
+
+def _start_staging(project_folder, index, staged):
+    # staged 也可以是调用方的StagingArea，调用方负责提交或丢弃
+    if isinstance(staged, StagingArea):
+        return staged
+    staged = STAGED_WRITES if staged is None else staged
+    return StagingArea(project_folder, index) if staged else None
+
+def _discard_staging(staging):
+    if staging is not None:
+        staging.discard()
+        log_event("Execution failed. Discarded staged changes, the project folder was not modified.", 'error')
+
+def _commit_staging(staging, project_folder):
+    if staging is None:
+        return
+    written, deleted = staging.commit()
+    log_event(f"Committed {written} files to {project_folder} ({deleted} deleted)")
+
+@traced('execute_step')
+def execute_step(step, project_folder, project_structure, filename_to_path, goal, top_level_dir, stream=False,
+                 index=None, staging=None, journal=None):
+    # 路由模型时按步骤生成的文件和估算大小选择；返回 'ok'、'skipped' 或 'failed'
+    with routing_hints(path=step.path, size=step.size), step_events(step) as scope:
+        _start_step(step, top_level_dir)
+
+        action = _prepare_step(step, project_folder)
+        if action is None:
+            return 'failed' if scope['errors'] else 'skipped'
+
+        content = _journaled_content(journal, step, action)
+        if action['op'] == 'create' and stream and content is None:
+            try:
+                with _stream_target(action['path'], staging) as out:
+                    stats = stream_content_to_file(
+                        step.text, action['relative_path'], action['path'], project_structure, goal,
+                        existing_files=_context_files(step, action, project_folder, project_structure,
+                                                      filename_to_path, top_level_dir, goal, index, staging),
+                        out=out)
+            except Exception as e:
+                log_event(f"Failed to execute step: {e}", level='error')
+                if journal is not None:
+                    journal.record_failure(step, e)
+                return 'failed'
+            content = _finish_stream(action['path'], stats, index, staging)
+            _journal_content(journal, step, action, content)
+            return _step_outcome(scope)
+
+        if action['op'] == 'create' and content is None:
             try:
                 content = get_content_from_ai(
-                    step,
-                    filename,
-                    relative_path,
+                    step.text,
+                    action['filename'],
+                    action['relative_path'],
                     project_structure,
-                    existing_files={},
+                    existing_files=_context_files(step, action, project_folder, project_structure, filename_to_path,
+                                                  top_level_dir, goal, index, staging),
                     goal=goal
                 )
-                full_path = os.path.normpath(os.path.join(project_folder, relative_path))
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                with open(full_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                print(f"Wrote content to {full_path}\n")
-                logs.append(f"Wrote content to {full_path}\n")
             except Exception as e:
-                logs.append(f"Failed to execute step: {e}")
-                print(f"Failed to execute step: {e}")
-        else:
-            logs.append("No filename specified in step.")
-            print("No filename specified in step.")
+                log_event(f"Failed to execute step: {e}", level='error')
+                if journal is not None:
+                    journal.record_failure(step, e)
+                return 'failed'
+            _journal_content(journal, step, action, content)
+
+        _apply_step(action, content, index, staging)
+        return _step_outcome(scope)
+
+def _step_outcome(scope):
+    return 'failed' if scope['errors'] else 'ok'
+
+def _journaled_content(journal, step, action):
+    # 上一次运行已经为这个步骤生成过内容时直接复用
+    if journal is None or action['op'] != 'create':
+        return None
+    content = journal.content(step)
+    if content is not None:
+        log_event(f"Reusing generated content for {action['relative_path']} from the run journal")
+    return content
+
+def _journal_content(journal, step, action, content):
+    if journal is not None and content is not None:
+        journal.record_content(step, action['relative_path'], content)
+
+def _stream_target(full_path, staging):
+    # 暂存模式下流式内容写入暂存区的临时文件，提交时再改名为目标文件；否则直接写入目标文件
+    return staging.stream(full_path) if staging is not None else contextlib.nullcontext()
+
+def _finish_stream(full_path, stats, index, staging):
+    """流式写入结束后更新索引，返回写入的内容"""
+    if staging is not None:
+        content = staging.read(full_path)
+    else:
+        with open(full_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if index is not None:
+            index.refresh(full_path)
+    _log_stream_result(full_path, stats)
+    return content
+
+def _log_stream_result(full_path, stats):
+    log_event(_format_stream_stats(stats))
+    log_event(f"Wrote content to {full_path}\n")
+
+def _start_step(step, top_level_dir):
+    annotate_span(task=step.task)
+    log_event(f"\nExecuting task:\n{step.task}")
+    log_event(f"Top level directory: {top_level_dir}")
+
+def _resolve_create_path(filename, filename_to_path, top_level_dir):
+    # 将路径统一为'/'
+    filename = filename.replace('\\', '/')
+    top_dir_normalized = top_level_dir.replace('\\', '/')
+
+    sanitized_filename = sanitize_filename(filename)
+    # 如果在filename_to_path中找不到，说明是新文件，可直接用sanitized_filename作为relative_path
+    if sanitized_filename in filename_to_path:
+        relative_path = filename_to_path[sanitized_filename]
     else:
-        # Other steps (if any appear, just log)
-        print(f"Unknown Command: {step}")
-        logs.append(f"Unknown Command: {step}")
+        relative_path = sanitized_filename
+
+    # 再次统一relative_path的分隔符为'/'
+    relative_path = relative_path.replace('\\', '/')
+
+    # 如果relative_path以top_level_dir开头，则移除
+    if relative_path.startswith(top_dir_normalized + '/'):
+        relative_path = relative_path[len(top_dir_normalized) + 1:]
+    return relative_path
+
+def _prepare_step(step, project_folder):
+    """
+    把编译后的步骤（PlanStep）转换为要执行的操作，但不访问文件或API。
+
+    返回一个字典（'op' 为 'delete'、'append' 或 'create'），无法执行时返回None（路径指向项目目录之外时记录错误）
+    """
+    unsafe = [path for path in (step.path, step.src, step.dst) if path and escapes_project(path)]
+    if unsafe:
+        log_event(f"Refusing to access {', '.join(unsafe)}: the path points outside the project folder", 'error')
+        return None
+
+    if step.op is StepOp.DELETE:
+        if step.path:
+            full_path = os.path.normpath(os.path.join(project_folder, step.path))
+            log_event(f"Attempting to delete: {full_path}")
+            return {'op': 'delete', 'path': full_path}
+
+        log_event("No filename specified for deletion.", level='warning')
+        return None
+
+    if step.op is StepOp.APPEND:
+        log_event(f"Extracted source: {step.src}, destination: {step.dst}")
+        if step.src and step.dst:
+            src_path = os.path.normpath(os.path.join(project_folder, step.src))
+            dst_path = os.path.normpath(os.path.join(project_folder, step.dst))
+            log_event(f"Source path after normalization and stripping: {src_path}")
+            log_event(f"Destination path after normalization and stripping: {dst_path}")
+            return {'op': 'append', 'src': src_path, 'dst': dst_path}
+
+        log_event("Could not extract source/destination for append operation.", level='warning')
+        return None
+
+    if step.op is StepOp.CREATE:
+        if step.path:
+            log_event(f"Relative path for creation: {step.path}")
+            full_path = os.path.normpath(os.path.join(project_folder, step.path))
+            return {'op': 'create', 'filename': step.filename, 'relative_path': step.path, 'path': full_path}
+
+        log_event("No filename specified in step.", level='warning')
+        return None
+
+    # Other steps (if any appear, just log)
+    log_event(f"Unknown Command: {step.text}", level='warning')
+    return None
+
+def _apply_step(action, content, index=None, staging=None):
+    """
+    把 _prepare_step 解析出的操作应用到磁盘上，create 操作需要传入生成的内容。
+    如果传入了 index，同时更新ProjectIndex；如果传入了 staging，只修改暂存区，不访问磁盘。
+    """
+    if staging is not None:
+        _apply_staged_step(action, content, staging)
+        return
+
+    if action['op'] == 'delete':
+        full_path = action['path']
+        try:
+            if os.path.exists(full_path):
+                os.remove(full_path)
+                if index is not None:
+                    index.record_delete(full_path)
+                log_event(f"Deleted file: {full_path}")
+            else:
+                log_event(f"File not found: {full_path}", level='warning')
+        except Exception as e:
+            log_event(f"Error deleting file {full_path}: {e}", level='error')
+
+    elif action['op'] == 'append':
+        src_path, dst_path = action['src'], action['dst']
+        # Check existence
+        if os.path.exists(src_path) and os.path.exists(dst_path):
+            src_content = index.read(src_path) if index is not None else None
+            if src_content is None:
+                with open(src_path, 'r', encoding='utf-8') as sf:
+                    src_content = sf.read()
+            with open(dst_path, 'a', encoding='utf-8') as df:
+                df.write('\n' + src_content)
+            if index is not None:
+                index.record_append(dst_path, '\n' + src_content)
+            log_event(f"Appended content of {src_path} to {dst_path}")
+        else:
+            log_event(f"Source or destination file not found for append: {src_path}, {dst_path}", level='error')
+
+    elif action['op'] == 'create':
+        full_path = action['path']
+        try:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            if index is not None:
+                index.record_write(full_path, content)
+            log_event(f"Wrote content to {full_path}\n")
+        except Exception as e:
+            log_event(f"Failed to execute step: {e}", level='error')
+
+def _apply_staged_step(action, content, staging):
+    if action['op'] == 'delete':
+        full_path = action['path']
+        if staging.exists(full_path):
+            staging.delete(full_path)
+            log_event(f"Deleted file: {full_path}")
+        else:
+            log_event(f"File not found: {full_path}", level='warning')
+
+    elif action['op'] == 'append':
+        src_path, dst_path = action['src'], action['dst']
+        src_content = staging.read(src_path) if staging.exists(src_path) else None
+        if src_content is not None and staging.exists(dst_path):
+            try:
+                staging.append(dst_path, '\n' + src_content)
+            except Exception as e:
+                log_event(f"Failed to execute step: {e}", level='error')
+                return
+            log_event(f"Appended content of {src_path} to {dst_path}")
+        else:
+            log_event(f"Source or destination file not found for append: {src_path}, {dst_path}", level='error')
 
-    return logs
+    elif action['op'] == 'create':
+        full_path = action['path']
+        try:
+            staging.write(full_path, content)
+        except Exception as e:
+            log_event(f"Failed to execute step: {e}", level='error')
+            return
+        log_event(f"Wrote content to {full_path}\n")
 
+@traced('get_content_from_ai')
 def get_content_from_ai(step, filename, file_path, project_structure, existing_files, goal):
+    messages = _content_messages(step, file_path, project_structure, existing_files, goal)
+    return generate_content(messages)
+
+def generate_content(messages, client=None):
+    """
+    生成一个文件的内容（格式与 parse_content_from_response 相同）。
+    输出因为长度上限被截断时继续请求，各段拼接为一个文件，见 ContinuedGeneration。
+    """
+    client = client or get_client()
+    out = io.StringIO()
+    generation = ContinuedGeneration(messages, out)
+    request = messages
+    while request is not None:
+        choice = client.chat(request, **_content_options())['choices'][0]
+        generation.start_part()
+        generation.feed(choice['message']['content'])
+        request = generation.next_request(choice.get('finish_reason'))
+    generation.close()
+    return out.getvalue()
+
+def _content_options():
+    return {'max_tokens': MAX_OUTPUT_TOKENS} if MAX_OUTPUT_TOKENS else {}
+
+def _content_messages(step, file_path, project_structure, existing_files, goal):
     # Get the main task description (first line) and any additional details
     task_lines = step.split('\n')
     main_task = task_lines[0]
@@ -596,10 +3738,351 @@ def get_content_from_ai(step, filename, file_path, project_structure, existing_f
         )
     }
 
-    messages = [system_message, user_message]
-    response = call_grok_api(messages)
-    content = parse_content_from_response(response)
-    return content
+    return [system_message, user_message]
+
+def estimate_tokens(text):
+    # 粗略估算：平均每个token约4个字符
+    return (len(text) + 3) // 4
+
+_STUB_CACHE_SIZE = 1024
+_stub_cache = OrderedDict()
+_stub_cache_lock = threading.Lock()
+
+def _stub_function(node):
+    stub = ast.FunctionDef if isinstance(node, ast.FunctionDef) else ast.AsyncFunctionDef
+    body = []
+    docstring = ast.get_docstring(node, clean=False)
+    if docstring is not None:
+        body.append(ast.Expr(ast.Constant(docstring)))
+    body.append(ast.Expr(ast.Constant(Ellipsis)))
+    kwargs = {'type_params': node.type_params} if hasattr(node, 'type_params') else {}
+    return stub(name=node.name, args=node.args, body=body, decorator_list=node.decorator_list,
+                returns=node.returns, type_comment=None, lineno=node.lineno, **kwargs)
+
+def _stub_class(node):
+    body = []
+    docstring = ast.get_docstring(node, clean=False)
+    if docstring is not None:
+        body.append(ast.Expr(ast.Constant(docstring)))
+    for child in node.body:
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            body.append(_stub_function(child))
+        elif isinstance(child, ast.ClassDef):
+            body.append(_stub_class(child))
+        elif isinstance(child, (ast.AnnAssign, ast.Assign)):
+            body.append(child)
+    if not body:
+        body.append(ast.Expr(ast.Constant(Ellipsis)))
+    kwargs = {'type_params': node.type_params} if hasattr(node, 'type_params') else {}
+    return ast.ClassDef(name=node.name, bases=node.bases, keywords=node.keywords, body=body,
+                        decorator_list=node.decorator_list, **kwargs)
+
+def python_stub(source):
+    """
+    用AST把Python源码压缩为接口存根：保留import、模块级赋值、类和函数的签名、类型注解和docstring，
+    函数体替换为 ...。无法解析时返回None。结果按内容哈希缓存。
+    """
+    key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    with _stub_cache_lock:
+        if key in _stub_cache:
+            _stub_cache.move_to_end(key)
+            return _stub_cache[key]
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        stub = None
+    else:
+        body = []
+        docstring = ast.get_docstring(tree, clean=False)
+        if docstring is not None:
+            body.append(ast.Expr(ast.Constant(docstring)))
+        for node in tree.body:
+            if isinstance(node, (ast.Import, ast.ImportFrom, ast.AnnAssign, ast.Assign)):
+                body.append(node)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                body.append(_stub_function(node))
+            elif isinstance(node, ast.ClassDef):
+                body.append(_stub_class(node))
+        stub = ast.unparse(ast.Module(body=body, type_ignores=[]))
+    with _stub_cache_lock:
+        _stub_cache[key] = stub
+        if len(_stub_cache) > _STUB_CACHE_SIZE:
+            _stub_cache.popitem(last=False)
+    return stub
+
+def _check_python_source(item):
+    """
+    在工作进程中解析并编译一个文件。item 为 (相对路径, 源码)。
+
+    返回字典：error 为语法错误（没有时为None），imports 为 [(模块, [导入的名字], level, 行号)]，
+    names 为模块顶层定义的名字，dynamic 为True时（from x import * 或模块级 __getattr__）不检查从它导入的名字
+    """
+    rel_path, source = item
+    result = {'path': rel_path, 'error': None, 'imports': [], 'names': [], 'dynamic': False}
+    try:
+        tree = ast.parse(source, filename=rel_path)
+        compile(tree, rel_path, 'exec')
+    except SyntaxError as e:
+        result['error'] = f"SyntaxError: {e.msg} (line {e.lineno})"
+        return result
+    except ValueError as e:
+        result['error'] = f"ValueError: {e}"
+        return result
+
+    names = set()
+    def collect(body):
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.add(node.name)
+                if node.name == '__getattr__':
+                    result['dynamic'] = True
+            elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign, ast.For, ast.With, ast.AsyncWith)):
+                targets = getattr(node, 'targets', None) or [getattr(node, 'target', None)]
+                targets += [item.optional_vars for item in getattr(node, 'items', [])]
+                for target in targets:
+                    for name in ast.walk(target) if target is not None else ():
+                        if isinstance(name, ast.Name):
+                            names.add(name.id)
+            elif isinstance(node, ast.Import):
+                names.update(alias.asname or alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    if alias.name == '*':
+                        result['dynamic'] = True
+                    names.add(alias.asname or alias.name)
+            # 条件定义（if/try）中的名字同样视为模块的名字
+            for field in ('body', 'orelse', 'finalbody'):
+                if isinstance(node, (ast.If, ast.Try, ast.For, ast.While, ast.With)) and hasattr(node, field):
+                    collect(getattr(node, field))
+            for handler in getattr(node, 'handlers', []):
+                collect(handler.body)
+    collect(tree.body)
+    result['names'] = sorted(names)
+
+    # try ... except ImportError 中的导入是可选的，不检查
+    guarded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Try) and any(
+                handler.type is None or any(isinstance(name, ast.Name) and name.id in (
+                    'ImportError', 'ModuleNotFoundError', 'Exception') for name in ast.walk(handler.type))
+                for handler in node.handlers):
+            guarded.update(id(child) for statement in node.body for child in ast.walk(statement))
+
+    for node in ast.walk(tree):
+        if id(node) in guarded:
+            continue
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                result['imports'].append((alias.name, [], 0, node.lineno))
+        elif isinstance(node, ast.ImportFrom):
+            result['imports'].append((node.module or '', [alias.name for alias in node.names], node.level,
+                                      node.lineno))
+    return result
+
+def _module_name(rel_path):
+    parts = rel_path[:-3].split('/')
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+def _python_sources(project_folder):
+    # 项目中所有Python文件 {相对路径: 源码}，无法读取的文件为None
+    sources = {}
+    for root, dirs, files in os.walk(project_folder):
+        dirs[:] = [d for d in dirs if d != RunJournal.DIRNAME and not d.startswith('.')]
+        for name in files:
+            if name.endswith('.py'):
+                full_path = os.path.join(root, name)
+                rel_path = os.path.relpath(full_path, project_folder).replace(os.sep, '/')
+                try:
+                    with open(full_path, 'r', encoding='utf-8') as f:
+                        sources[rel_path] = f.read()
+                except (OSError, UnicodeDecodeError):
+                    sources[rel_path] = None
+    return sources
+
+def validate_project(project_folder, paths=None, max_workers=None, sources=None):
+    """
+    检查项目中的Python文件：在进程池中并行解析和编译每个文件，再检查项目内模块之间的导入
+    （导入的项目模块是否存在、from 导入的名字是否在模块中定义）。第三方库和标准库的导入不检查。
+
+    模块名按相对项目目录的路径解析，也接受相对导入文件所在目录的导入（直接运行子目录中的脚本时）。
+    paths 为要检查的文件（相对路径），为None时检查所有文件；其余文件仍然用于解析导入。
+    sources 为 {相对路径: 源码} 时检查这些源码（例如暂存区中的项目），不读取磁盘。
+    返回 {相对路径: [错误信息]}，只包含有错误的文件
+    """
+    if sources is None:
+        sources = _python_sources(project_folder)
+    items = [(rel_path, source) for rel_path, source in sorted(sources.items()) if source is not None]
+    if len(items) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(_check_python_source, items, chunksize=max(1, len(items) // 16)))
+        except (OSError, NotImplementedError):
+            # 无法创建进程池的环境（例如没有 /dev/shm）中在当前进程检查
+            results = [_check_python_source(item) for item in items]
+    else:
+        results = [_check_python_source(item) for item in items]
+
+    modules = {_module_name(result['path']): result for result in results}
+    errors = {}
+    for rel_path, source in sources.items():
+        if source is None:
+            errors[rel_path] = ["file is not valid UTF-8 text"]
+    for result in results:
+        if paths is not None and result['path'] not in paths:
+            continue
+        problems = [result['error']] if result['error'] else _import_errors(result, modules)
+        if problems:
+            errors[result['path']] = problems
+    return errors
+
+def _module_exists(name, modules):
+    # 没有 __init__.py 的目录是命名空间包
+    return name in modules or any(other.startswith(name + '.') for other in modules)
+
+def _import_targets(result, modules):
+    """
+    解析一个文件（_check_python_source 的结果）中的导入，逐个产出 (行号, 模块, 导入的名字, 目标)。
+    目标为项目中的模块名；'' 表示项目之外的模块（第三方库或标准库）；None 表示项目中找不到的模块
+    """
+    # 导入文件所在的包（目录），相对导入和直接运行子目录中的脚本时都以它为基准
+    package = [part for part in os.path.dirname(result['path']).split('/') if part]
+    roots = [''] + (['.'.join(package)] if package else [])
+    project_names = {name.split('.')[0] for name in modules}
+    if package:
+        prefix = '.'.join(package) + '.'
+        project_names.update(name[len(prefix):].split('.')[0] for name in modules if name.startswith(prefix))
+
+    for module, names, level, lineno in result['imports']:
+        if level:
+            if level - 1 > len(package):
+                yield lineno, '.' * level + module, names, None
+                continue
+            target = '.'.join(package[:len(package) - level + 1] + ([module] if module else []))
+            if target:
+                yield lineno, target, names, target if _module_exists(target, modules) else None
+            continue
+        target = ''
+        for root in roots:
+            name = f"{root}.{module}" if root else module
+            if _module_exists(name, modules):
+                target = name
+                break
+        else:
+            if module.split('.')[0] in project_names:
+                target = None
+        yield lineno, module, names, target
+
+def _import_errors(result, modules):
+    problems = []
+    for lineno, module, names, target in _import_targets(result, modules):
+        if target is None:
+            problems.append(f"line {lineno}: No module named '{module}'")
+            continue
+        if target not in modules or modules[target]['dynamic'] or modules[target]['error']:
+            continue
+        defined = set(modules[target]['names'])
+        for name in names:
+            if name != '*' and name not in defined and not _module_exists(f"{target}.{name}", modules):
+                problems.append(f"line {lineno}: cannot import name '{name}' from '{target}'")
+    return problems
+
+def project_dependencies(project_folder, steps=()):
+    """
+    根据项目中Python文件的导入和计划步骤引用的文件（"Dependencies include ..."、import 细节行）
+    构建文件之间的依赖关系，返回 {相对路径: 它依赖的项目文件集合}
+    """
+    results = [_check_python_source(item) for item in _python_sources(project_folder).items()
+               if item[1] is not None]
+    modules = {_module_name(result['path']): result for result in results}
+    deps = {}
+    for result in results:
+        paths = deps.setdefault(result['path'], set())
+        for _, _, names, target in _import_targets(result, modules):
+            if not target:
+                continue
+            if target in modules:
+                paths.add(modules[target]['path'])
+            for name in names:
+                if f"{target}.{name}" in modules:
+                    paths.add(modules[f"{target}.{name}"]['path'])
+        paths.discard(result['path'])
+    for step in steps:
+        if step.op is StepOp.CREATE and step.path:
+            deps.setdefault(step.path, set()).update(path for path in step.context if path != step.path)
+    return deps
+
+def extract_context_references(step, filename_to_path, top_level_dir):
+    """
+    从步骤的细节行（"Dependencies include ..."、"import ..."）中提取引用的项目文件，
+    返回相对项目目录的路径列表（按首次出现的顺序）
+    """
+    known_paths = {_normalize_plan_path(path, top_level_dir) for path in filename_to_path.values()}
+    references = []
+
+    def add(path):
+        if path and path not in references:
+            references.append(path)
+
+    for line in step.split('\n')[1:]:
+        line_lower = line.lower()
+        if 'import' not in line_lower and 'dependencies include' not in line_lower:
+            continue
+        for name in re.findall(r'[\'"]([\w./\\-]+\.\w+)[\'"]', line):
+            add(_normalize_plan_path(_resolve_create_path(name, filename_to_path, top_level_dir), top_level_dir))
+        for module in re.findall(r'\b(?:from|import)\s+([A-Za-z_][\w.]*)', line):
+            base = module.replace('.', '/')
+            for candidate in (base + '.py', base + '/__init__.py'):
+                if candidate in known_paths:
+                    add(candidate)
+                    break
+    return references
+
+def build_context(step, current_path, read_file, filename_to_path, top_level_dir, budget=None, references=None):
+    """
+    在token预算内为步骤构建上下文，只包含步骤引用的文件（见 extract_context_references）。
+
+    Python文件先以接口存根的形式加入；如果预算还有剩余，再按引用顺序把存根替换为完整内容。
+    read_file(rel_path) 返回文件内容（不存在时返回None）。references 为已经解析好的引用列表（PlanStep.context）。
+    返回 (files, included)：files 为 {相对路径: 内容}，included 为 [(路径, 'stub'或'full', token数)]
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    current_path = _normalize_plan_path(current_path, top_level_dir)
+    candidates = []
+    if references is None:
+        references = extract_context_references(step, filename_to_path, top_level_dir)
+    for rel_path in references:
+        if rel_path == current_path:
+            continue
+        content = read_file(rel_path)
+        if not content or not content.strip():
+            continue
+        stub = python_stub(content) if rel_path.endswith('.py') else None
+        candidates.append((rel_path, content, stub))
+
+    chosen = {}
+    used = 0
+    # 先放入存根（非Python文件直接放入完整内容）
+    for rel_path, content, stub in candidates:
+        text = stub if stub is not None else content
+        kind = 'stub' if stub is not None else 'full'
+        tokens = estimate_tokens(text)
+        if used + tokens <= budget:
+            chosen[rel_path] = (text, kind, tokens)
+            used += tokens
+    # 预算有剩余时把存根升级为完整内容
+    for rel_path, content, stub in candidates:
+        if rel_path in chosen and chosen[rel_path][1] == 'stub':
+            tokens = estimate_tokens(content)
+            extra = tokens - chosen[rel_path][2]
+            if used + extra <= budget:
+                chosen[rel_path] = (content, 'full', tokens)
+                used += extra
+
+    files = {rel_path: text for rel_path, (text, _, _) in chosen.items()}
+    included = [(rel_path, kind, tokens) for rel_path, (_, kind, tokens) in chosen.items()]
+    return files, included
 
 def parse_content_from_response(response):
     response = response.replace('\r\n', '\n')
@@ -611,6 +4094,274 @@ def parse_content_from_response(response):
         content = response.strip()
     return content
 
+class FenceWriter:
+    """
+    增量版的 parse_content_from_response：边接收流式响应边把代码块内容写入文件对象。
+
+    多个代码块之间用换行连接；如果整个响应中没有代码块，则在 close() 时写入去掉首尾空白的整个响应。
+    只有第一个代码块之前的文本会被缓存，代码块的内容直接写出。
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.state = 'outside'
+        self.pending = ''
+        self.preamble = []
+        self.blocks = 0
+        self.written = 0
+
+    def _write(self, text):
+        if text:
+            self.out.write(text)
+            self.written += len(text)
+
+    def feed(self, text):
+        self.pending += text
+        # '\r\n' 可能被拆分在两个数据块之间，先保留末尾的 '\r'
+        keep_cr = self.pending.endswith('\r')
+        body = self.pending[:-1] if keep_cr else self.pending
+        self.pending = body.replace('\r\n', '\n')
+        self._process()
+        if keep_cr:
+            self.pending += '\r'
+        self.out.flush()
+
+    def _process(self):
+        while True:
+            if self.state == 'outside':
+                index = self.pending.find('```')
+                if index < 0:
+                    # 末尾的反引号可能是下一个代码块标记的开头
+                    cut = len(self.pending.rstrip('`'))
+                    if self.blocks == 0:
+                        self.preamble.append(self.pending[:cut])
+                    self.pending = self.pending[cut:]
+                    return
+                if self.blocks == 0:
+                    self.preamble.append(self.pending[:index])
+                self.pending = self.pending[index + 3:]
+                self.state = 'header'
+            elif self.state == 'header':
+                # 与正则 ```(?:\w*\n)? 一致：语言标记后紧跟换行时才跳过
+                match = re.match(r'\w*', self.pending)
+                if match.end() == len(self.pending):
+                    return
+                if self.pending[match.end()] == '\n':
+                    self.pending = self.pending[match.end() + 1:]
+                if self.blocks > 0:
+                    self._write('\n')
+                self.blocks += 1
+                self.state = 'inside'
+            else:
+                index = self.pending.find('```')
+                if index < 0:
+                    cut = len(self.pending.rstrip('`'))
+                    self._write(self.pending[:cut])
+                    self.pending = self.pending[cut:]
+                    return
+                self._write(self.pending[:index])
+                self.pending = self.pending[index + 3:]
+                self.state = 'outside'
+
+    def close(self):
+        """处理剩余的缓冲内容，返回写入的字符数"""
+        self.pending = self.pending.replace('\r\n', '\n')
+        if self.state == 'inside':
+            # 响应在代码块中途结束，保留已经收到的代码
+            self._write(self.pending)
+        elif self.blocks == 0:
+            self._write((''.join(self.preamble) + self.pending).strip())
+        self.pending = ''
+        self.out.flush()
+        return self.written
+
+_CONTINUE_PROMPT = (
+    'Your previous response was cut off by the output length limit; the assistant message above is the end of it. '
+    'Continue exactly where it stopped. Do not repeat anything that was already written, do not restart the file '
+    'or the code block and do not add explanations.'
+)
+
+def _continuation_messages(messages, tail):
+    return messages + [{'role': 'assistant', 'content': tail}, {'role': 'user', 'content': _CONTINUE_PROMPT}]
+
+class ContinuedGeneration:
+    """
+    把一次逻辑请求的多段输出（第一次响应和之后的续写响应）拼接后交给同一个FenceWriter，
+    代码块的状态因此跨段保持：在代码块中途被截断的内容，在续写中继续属于这个代码块。
+
+    续写的开头先缓存 HEAD_CHARS 个字符再写出：上一段停在代码块中时去掉续写重新打开的代码块标记，
+    续写开头重复了已经写出的内容时去掉重复的部分（见 _overlap）。
+    写出的内容超过 max_bytes（默认 MAX_FILE_BYTES）时抛出异常。
+    """
+
+    HEAD_CHARS = 256
+    OVERLAP_MIN = 16
+    OVERLAP_LINES = 2
+
+    def __init__(self, messages, out, max_bytes=None):
+        self.messages = messages
+        self.writer = FenceWriter(out)
+        self.max_bytes = MAX_FILE_BYTES if max_bytes is None else max_bytes
+        self.parts = 0
+        self.tail = ''
+        self.head = None
+
+    def start_part(self):
+        self.parts += 1
+        self.head = '' if self.parts > 1 else None
+
+    def feed(self, text):
+        if self.head is not None:
+            self.head += text
+            if len(self.head) < self.HEAD_CHARS:
+                return
+            text, self.head = self._trim(self.head), None
+        self._write(text)
+
+    def _write(self, text):
+        self.tail = (self.tail + text)[-CONTINUATION_TAIL_CHARS:]
+        self.writer.feed(text)
+        if self.max_bytes and self.writer.written > self.max_bytes:
+            raise Exception(f"Error: generated content exceeds the maximum file size of {self.max_bytes} chars")
+
+    def _trim(self, text):
+        if self.writer.state == 'inside':
+            match = re.match(r'\s*```\w*\n', text)
+            if match:
+                text = text[match.end():]
+        return text[self._overlap(text):]
+
+    def _overlap(self, text):
+        """
+        续写开头重复已写出内容的长度。重复必须从已写出内容的某一行的行首开始，且至少有 OVERLAP_MIN 个非空白字符；
+        上一段停在行尾时还要求至少重复 OVERLAP_LINES 行，紧接着出现的一行相同代码（例如两个函数以同样的return结尾）不算重复
+        """
+        for size in range(min(len(self.tail), len(text)), 0, -1):
+            overlap = text[:size]
+            start = len(self.tail) - size
+            if not self.tail.endswith(overlap) or (start > 0 and self.tail[start - 1] != '\n'):
+                continue
+            if len(''.join(overlap.split())) < self.OVERLAP_MIN:
+                return 0
+            if self.tail.endswith('\n') and overlap.count('\n') < self.OVERLAP_LINES:
+                continue
+            return size
+        return 0
+
+    def next_request(self, finish_reason):
+        """一段输出结束。输出被截断时返回续写请求的消息，否则返回None"""
+        if self.head is not None:
+            self._write(self._trim(self.head))
+            self.head = None
+        if finish_reason != 'length':
+            return None
+        if self.parts > MAX_CONTINUATIONS:
+            log_event(f"Output is still truncated after {MAX_CONTINUATIONS} continuations, keeping what was generated", 'warning')
+            return None
+        log_event(f"Output truncated after {self.writer.written} chars, requesting continuation {self.parts}...")
+        return _continuation_messages(self.messages, self.tail)
+
+    def close(self):
+        """返回写出的字符数"""
+        return self.writer.close()
+
+def _chunk_text(chunk):
+    choices = chunk.get('choices') or [{}]
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+def _chunk_finish_reason(chunk):
+    choices = chunk.get('choices') or [{}]
+    return choices[0].get('finish_reason')
+
+def _stream_stats(start, first_token, end, tokens, written):
+    ttft = (first_token - start) if first_token is not None else None
+    duration = end - first_token if first_token is not None else 0
+    tokens_per_sec = tokens / duration if duration > 0 else 0.0
+    return {'chars': written, 'tokens': tokens, 'ttft': ttft, 'tokens_per_sec': tokens_per_sec}
+
+def _format_stream_stats(stats):
+    ttft = f"{stats['ttft']:.2f}s" if stats['ttft'] is not None else "n/a"
+    return (f"Streamed {stats['tokens']} tokens ({stats['chars']} chars), "
+            f"time to first token {ttft}, {stats['tokens_per_sec']:.1f} tokens/s")
+
+def _open_stream_target(full_path, out):
+    if out is not None:
+        return contextlib.nullcontext(out)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    return open(full_path, 'w', encoding='utf-8')
+
+@traced('get_content_from_ai')
+def stream_content_to_file(step, file_path, full_path, project_structure, goal, client=None, existing_files=None,
+                           out=None):
+    """
+    流式版的 get_content_from_ai：边接收边把代码写入 full_path（传入 out 时写入该文件对象）。
+    输出被截断时在同一个文件中继续写入续写的内容。
+
+    返回统计信息：写入字符数、token数、首个token的延迟（ttft）和每秒token数
+    """
+    client = client or get_client()
+    messages = _content_messages(step, file_path, project_structure, existing_files or {}, goal)
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+    with trace_span('api_call', model=client.model, stream=True), _open_stream_target(full_path, out) as f:
+        generation = ContinuedGeneration(messages, f)
+        request = messages
+        while request is not None:
+            generation.start_part()
+            finish_reason = None
+            for chunk in client.stream_chat(request, **_content_options()):
+                text = _chunk_text(chunk)
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    tokens += 1
+                    generation.feed(text)
+                finish_reason = _chunk_finish_reason(chunk) or finish_reason
+                _add_usage(usage, chunk.get('usage'))
+            request = generation.next_request(finish_reason)
+        written = generation.close()
+        stats = _stream_stats(start, first_token, time.perf_counter(), usage['completion_tokens'] or tokens, written)
+        annotate_span(prompt_tokens=usage['prompt_tokens'], completion_tokens=stats['tokens'],
+                      ttft=stats['ttft'], tokens_per_sec=stats['tokens_per_sec'], parts=generation.parts)
+    return stats
+
+def _add_usage(total, usage):
+    for key in total:
+        total[key] += (usage or {}).get(key) or 0
+
+@traced('get_content_from_ai')
+async def async_stream_content_to_file(step, file_path, full_path, project_structure, goal, client,
+                                       existing_files=None, out=None):
+    """stream_content_to_file 的异步版本"""
+    messages = _content_messages(step, file_path, project_structure, existing_files or {}, goal)
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+    with trace_span('api_call', model=client.model, stream=True), _open_stream_target(full_path, out) as f:
+        generation = ContinuedGeneration(messages, f)
+        request = messages
+        while request is not None:
+            generation.start_part()
+            finish_reason = None
+            async for chunk in client.stream_chat(request, **_content_options()):
+                text = _chunk_text(chunk)
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    tokens += 1
+                    generation.feed(text)
+                finish_reason = _chunk_finish_reason(chunk) or finish_reason
+                _add_usage(usage, chunk.get('usage'))
+            request = generation.next_request(finish_reason)
+        written = generation.close()
+        stats = _stream_stats(start, first_token, time.perf_counter(), usage['completion_tokens'] or tokens, written)
+        annotate_span(prompt_tokens=usage['prompt_tokens'], completion_tokens=stats['tokens'],
+                      ttft=stats['ttft'], tokens_per_sec=stats['tokens_per_sec'], parts=generation.parts)
+    return stats
+
 def extract_filename(step, operation='write'):
     """
     提取文件名，支持单引号和双引号包围的文件名。
@@ -660,95 +4411,1572 @@ def sanitize_filename(filename):
     sanitized = sanitized.replace(' ', '_')
     return sanitized
 
+def escapes_project(path):
+    """
+    来自模型的路径（目录结构、计划中的文件名）是绝对路径或含有 '..' 时可能指向项目目录之外，
+    不能用于读写，也不能作为归档中的条目名
+    """
+    return os.path.isabs(path) or path.startswith(('/', '\\')) or '..' in re.split(r'[/\\]', path)
+
 def is_non_text_file(filename):
     non_text_extensions = ['wav', 'png', 'mp3', 'jpg', 'jpeg', 'gif', 'bmp', 'mp4', 'avi', 'mov', 'pdf', 'zip', 'exe']
     extension = filename.split('.')[-1].lower()
     return extension in non_text_extensions
 
-def create_project_folder(project_structure):
+def create_project_folder(project_structure, output_root=None, create=True):
+    # create 为False时只计算项目目录的路径（生成归档时项目只存在于暂存区中）
     if len(project_structure) != 1:
         raise Exception("Project structure must have exactly one top-level directory.")
     top_level_dir = list(project_structure.keys())[0]
     sanitized_name = sanitize_filename(top_level_dir)
-    project_folder = os.path.join(os.getcwd(), sanitized_name)
-    os.makedirs(project_folder, exist_ok=True)
-    print(f"Created project folder at: {project_folder}")
+    if escapes_project(sanitized_name) or not sanitized_name.strip('./\\'):
+        raise Exception(f"Error: invalid top-level directory name '{top_level_dir}'")
+    project_folder = os.path.join(output_root or os.getcwd(), sanitized_name)
+    if create:
+        os.makedirs(project_folder, exist_ok=True)
+        log_event(f"Created project folder at: {project_folder}")
     return project_folder, project_structure[top_level_dir], top_level_dir
 
-def create_directories(base_path, structure):
+def create_directories(base_path, structure, overwrite=True):
+    # overwrite 为False时保留已经存在的文件，只补建缺少的目录和占位文件
     for name, sub_structure in structure.items():
         sanitized_name = sanitize_filename(name)
+        if escapes_project(sanitized_name):
+            log_event(f"Skipping '{name}' in the project structure: it points outside the project folder", 'error')
+            continue
         dir_path = os.path.join(base_path, sanitized_name)
         if '.' in sanitized_name:
             if is_non_text_file(sanitized_name):
                 placeholder_filename = f"{sanitized_name}.replacement"
                 full_path = os.path.join(base_path, placeholder_filename)
+                if not overwrite and os.path.exists(full_path):
+                    continue
                 with open(full_path, 'w', encoding='utf-8') as f:
                     f.write(f"Placeholder for {sanitized_name}")
-                print(f"Created placeholder file for non-text file: {full_path}")
+                log_event(f"Created placeholder file for non-text file: {full_path}")
             else:
+                if not overwrite and os.path.exists(dir_path):
+                    continue
                 with open(dir_path, 'w', encoding='utf-8') as f:
                     f.write('')
-                print(f"Created file: {dir_path}")
+                log_event(f"Created file: {dir_path}")
         else:
             os.makedirs(dir_path, exist_ok=True)
-            print(f"Created directory: {dir_path}")
+            log_event(f"Created directory: {dir_path}")
             if sub_structure:
-                create_directories(dir_path, sub_structure)
+                create_directories(dir_path, sub_structure, overwrite)
+
+def placeholder_files(base_path, structure, replacements=True):
+    """
+    create_directories 会创建的文件 {路径: 内容}（空文件和非文本文件的占位文件），不访问磁盘。
+    replacements 为False时不包括非文本文件的 .replacement 占位文件（例如写入归档时）
+    """
+    files = {}
+    for name, sub_structure in structure.items():
+        sanitized_name = sanitize_filename(name)
+        if escapes_project(sanitized_name):
+            continue
+        path = os.path.join(base_path, sanitized_name)
+        if '.' in sanitized_name:
+            if not is_non_text_file(sanitized_name):
+                files[path] = ''
+            elif replacements:
+                files[f"{path}.replacement"] = f"Placeholder for {sanitized_name}"
+        elif sub_structure:
+            files.update(placeholder_files(path, sub_structure, replacements))
+    return files
+
+async def _ainput(prompt):
+    # 先输出之前的事件，提示才会出现在它们之后；input()会阻塞，放到线程池中执行以免卡住事件循环
+    await flush_events()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, input, prompt)
+
+async def _confirm_from_input(prompt, data=None):
+    answer = await _ainput(prompt)
+    return answer.lower() == 'y'
+
+@traced('determine_project_structure')
+async def async_determine_project_structure(goal, client):
+    messages = _project_structure_messages(goal)
+    response = await async_call_grok_api(messages, client)
+    log_event("AI's response:")
+    log_event(response)
+    return parse_project_structure(response)
+
+@traced('plan_project')
+async def async_plan_project(goal, client):
+    """plan_project的异步版本"""
+    try:
+        response = await async_call_grok_api(_project_plan_messages(goal), client,
+                                             response_format=_project_plan_format())
+        structure, sizes = parse_project_plan(response)
+    except Exception as e:
+        log_event(f"Combined planning failed ({e}), asking for the structure and sizes separately.", 'warning')
+        structure = await async_determine_project_structure(goal, client)
+        return structure, (await async_estimate_file_sizes(structure, goal, client) if structure else {})
+    if sizes is None:
+        log_event("File size estimates did not match the structure, estimating them separately.", 'warning')
+        sizes = await async_estimate_file_sizes(structure, goal, client)
+    return structure, sizes
+
+@traced('estimate_file_sizes')
+async def async_estimate_file_sizes(structure, goal, client):
+    messages = _file_size_messages(structure, goal)
+    try:
+        response = await async_call_grok_api(messages, client)
+    except Exception as e:
+        log_event(f"Error in file size estimation: {e}", 'warning')
+        return _default_file_size_estimation(structure)
+    return parse_file_sizes(response, structure)
+
+@traced('decompose_goal')
+async def async_decompose_goal(goal, project_structure, file_sizes, client):
+    messages = _decompose_messages(goal, project_structure, file_sizes)
+    response = await async_call_grok_api(messages, client)
+    return parse_subtasks(response)
+
+@traced('get_content_from_ai')
+async def async_get_content_from_ai(step, filename, file_path, project_structure, existing_files, goal, client):
+    messages = _content_messages(step, file_path, project_structure, existing_files, goal)
+    return await async_generate_content(messages, client)
+
+async def async_generate_content(messages, client):
+    """generate_content 的异步版本"""
+    out = io.StringIO()
+    generation = ContinuedGeneration(messages, out)
+    request = messages
+    while request is not None:
+        result = await client.chat(request, **_content_options())
+        choice = result['choices'][0]
+        generation.start_part()
+        generation.feed(choice['message']['content'])
+        request = generation.next_request(choice.get('finish_reason'))
+    generation.close()
+    return out.getvalue()
+
+@traced('execute_step')
+async def async_execute_step(step, project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                             client, stream=False, index=None, staging=None, journal=None):
+    # 路由模型时按步骤生成的文件和估算大小选择；返回 'ok'、'skipped' 或 'failed'
+    with routing_hints(path=step.path, size=step.size), step_events(step) as scope:
+        _start_step(step, top_level_dir)
+        action = _prepare_step(step, project_folder)
+        if action is None:
+            return 'failed' if scope['errors'] else 'skipped'
+
+        content = _journaled_content(journal, step, action)
+        if action['op'] == 'create' and stream and content is None:
+            try:
+                with _stream_target(action['path'], staging) as out:
+                    stats = await async_stream_content_to_file(
+                        step.text, action['relative_path'], action['path'], project_structure, goal, client,
+                        existing_files=_context_files(step, action, project_folder, project_structure,
+                                                      filename_to_path, top_level_dir, goal, index, staging),
+                        out=out)
+            except Exception as e:
+                log_event(f"Failed to execute step: {e}", level='error')
+                if journal is not None:
+                    journal.record_failure(step, e)
+                return 'failed'
+            content = _finish_stream(action['path'], stats, index, staging)
+            _journal_content(journal, step, action, content)
+            return _step_outcome(scope)
+
+        if action['op'] == 'create' and content is None:
+            try:
+                content = await async_get_content_from_ai(
+                    step.text,
+                    action['filename'],
+                    action['relative_path'],
+                    project_structure,
+                    existing_files=_context_files(step, action, project_folder, project_structure, filename_to_path,
+                                                  top_level_dir, goal, index, staging),
+                    goal=goal,
+                    client=client
+                )
+            except Exception as e:
+                log_event(f"Failed to execute step: {e}", level='error')
+                if journal is not None:
+                    journal.record_failure(step, e)
+                return 'failed'
+            _journal_content(journal, step, action, content)
+
+        _apply_step(action, content, index, staging)
+        return _step_outcome(scope)
+
+@traced('execute_plan')
+async def async_execute_plan(plan, project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                             client, file_sizes=None, max_concurrency=MAX_WORKERS, stream=False, index=None,
+                             staged=None, journal=None):
+    """
+    execute_plan的异步版本：调度规则相同，同一时间最多执行max_concurrency个步骤。
+
+    如果运行被取消，所有正在执行的步骤都会被取消并等待其结束后再向上抛出，暂存的修改会被丢弃。
+    """
+    plan = _compiled(plan, filename_to_path, top_level_dir, file_sizes)
+    index = index or ProjectIndex(project_folder).scan()
+    staging = _start_staging(project_folder, index, staged)
+    deps, priority = build_step_graph(plan, filename_to_path, top_level_dir, file_sizes)
+    dependents = [[] for _ in plan]
+    for i, d in enumerate(deps):
+        for j in d:
+            dependents[j].append(i)
+    remaining = [len(d) for d in deps]
+    ready = [(-priority[i], i) for i in range(len(plan)) if not deps[i]]
+    heapq.heapify(ready)
+    results = [None] * len(plan)
+
+    running = {}
+    failed = True
+    try:
+        while ready or running:
+            while ready and len(running) < max_concurrency:
+                _, i = heapq.heappop(ready)
+                task = asyncio.ensure_future(async_execute_step(
+                    plan[i], project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                    client, stream, index, staging, journal))
+                running[task] = i
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = running.pop(task)
+                try:
+                    results[i] = task.result()
+                except Exception as e:
+                    results[i] = 'failed'
+                    log_event(f"Failed to execute step {i + 1}: {e}", level='error')
+                for j in dependents[i]:
+                    remaining[j] -= 1
+                    if remaining[j] == 0:
+                        heapq.heappush(ready, (-priority[j], j))
+        failed = False
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        if failed and staging is not staged:
+            _discard_staging(staging)
+
+    if staging is not staged:
+        _commit_staging(staging, project_folder)
+    return plan_summary(results)
+
+async def async_stream_subtasks(goal, project_structure, file_sizes, client):
+    """以流式方式生成计划，每解析出一个完整的任务就立即产出"""
+    parser = SubtaskParser()
+    async for chunk in client.stream_chat(_decompose_messages(goal, project_structure, file_sizes)):
+        for step in parser.feed(_chunk_text(chunk)):
+            yield step
+    for step in parser.close():
+        yield step
+
+@traced('execute_plan')
+async def async_execute_plan_stream(steps, plan, project_folder, project_structure, filename_to_path, goal,
+                                    top_level_dir, client, file_sizes=None, max_concurrency=MAX_WORKERS,
+                                    stream=False, index=None, staged=None, accept=None, journal=None):
+    """
+    async_execute_plan的流水线版本：steps 是逐个产出步骤的异步迭代器（例如 async_stream_subtasks），
+    每个步骤一到达就编译（compile_step）并加入依赖图，依赖满足后立即执行，计划的生成和文件的生成因此重叠进行。
+    到达的步骤按顺序追加到 plan 列表中。计划不完整时无法运行 compile_plan 的优化，步骤按原样执行。
+
+    计划还没有生成完时无法计算关键路径，就绪的步骤按估算的文件大小从大到小执行。
+    accept(plan) 对新到达的步骤返回False时停止生成计划，取消正在执行的步骤并丢弃暂存的修改，返回None。
+    journal 记录每个到达的步骤，计划生成完时立即记录完整的计划（不等步骤执行完），崩溃后继续运行不必重新生成计划。
+    """
+    index = index or ProjectIndex(project_folder).scan()
+    staging = _start_staging(project_folder, index, staged)
+    graph = StepGraph(filename_to_path, top_level_dir, file_sizes)
+    queue = asyncio.Queue()
+
+    async def produce():
+        # 在单独的任务中读取计划，出错时把异常交给调度循环，None 表示计划结束
+        try:
+            with trace_span('decompose_goal'), routing_hints(stage='decompose_goal'):
+                async for step in steps:
+                    await queue.put(step)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    getter = asyncio.ensure_future(queue.get())
+    ready = []
+    running = {}
+    compiled = []
+    results = []
+    finished = []
+    remaining = []
+    dependents = []
+    failed = True
+    try:
+        while getter is not None or ready or running:
+            while ready and len(running) < max_concurrency:
+                _, i = heapq.heappop(ready)
+                task = asyncio.ensure_future(async_execute_step(
+                    compiled[i], project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                    client, stream, index, staging, journal))
+                running[task] = i
+            waiting = set(running) | ({getter} if getter is not None else set())
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                step = getter.result()
+                getter = None
+                if isinstance(step, Exception):
+                    raise step
+                if step is None:
+                    if journal is not None:
+                        journal.record_plan(plan, optimized=False)
+                else:
+                    plan.append(step)
+                    if accept is not None and not accept(plan):
+                        return None
+                    if journal is not None:
+                        journal.record_plan_step(step)
+                    i = len(results)
+                    compiled.append(compile_step(step, filename_to_path, top_level_dir))
+                    unfinished = [j for j in graph.add(compiled[i]) if not finished[j]]
+                    results.append(None)
+                    finished.append(False)
+                    remaining.append(len(unfinished))
+                    dependents.append([])
+                    for j in unfinished:
+                        dependents[j].append(i)
+                    if not unfinished:
+                        heapq.heappush(ready, (-graph.costs[i], i))
+                    getter = asyncio.ensure_future(queue.get())
+            for task in done:
+                if task not in running:
+                    continue
+                i = running.pop(task)
+                try:
+                    results[i] = task.result()
+                except Exception as e:
+                    results[i] = 'failed'
+                    log_event(f"Failed to execute step {i + 1}: {e}", level='error')
+                finished[i] = True
+                for j in dependents[i]:
+                    remaining[j] -= 1
+                    if remaining[j] == 0:
+                        heapq.heappush(ready, (-graph.costs[j], j))
+        failed = False
+    finally:
+        pending = [task for task in list(running) + [producer, getter] if task is not None]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if failed and staging is not staged:
+            _discard_staging(staging)
+
+    if staging is not staged:
+        _commit_staging(staging, project_folder)
+    return plan_summary(results)
+
+async def async_repair_project(steps, project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                               client, stream=False, journal=None, retries=None, staging=None):
+    """
+    用 validate_project 检查执行完成的项目，把出错的文件对应到生成它的create步骤，
+    只重新生成这些文件（提示词中附带错误信息），重复直到没有错误或用完 retries 轮（默认 VALIDATION_RETRIES）。
+    没有对应create步骤的文件（例如由tmp分块追加而成）只报告错误。
+    传入 staging 时检查和修改暂存区中的项目，不访问磁盘。
+    返回摘要 {'repaired': 重新生成的文件数, 'invalid': 仍然无法通过检查的文件数}
+    """
+    retries = VALIDATION_RETRIES if retries is None else retries
+    owners = {}
+    for step in steps:
+        if step.op is StepOp.CREATE and step.path and step.path.endswith('.py'):
+            owners[step.path] = step
+    loop = asyncio.get_running_loop()
+    repaired = 0
+    for attempt in range(retries + 1):
+        sources = None
+        if staging is not None:
+            sources = {path.replace(os.sep, '/'): content for path, content in staging.snapshot().items()
+                       if path.endswith('.py')}
+        with trace_span('validate', attempt=attempt):
+            errors = await loop.run_in_executor(None, validate_project, project_folder, None, None, sources)
+        if not errors:
+            log_event("Validation passed: no syntax or import errors in the generated Python files.")
+            return {'repaired': repaired, 'invalid': 0}
+        for path, problems in sorted(errors.items()):
+            log_event(f"Validation failed for {path}: {'; '.join(problems)}", level='warning')
+        targets = [(owners[path], problems) for path, problems in sorted(errors.items()) if path in owners]
+        if attempt == retries or not targets:
+            break
+        log_event(f"\nRegenerating {len(targets)} files that failed validation (attempt {attempt + 1}/{retries})...")
+        results = await asyncio.gather(*(
+            _async_regenerate_step(step, problems, project_folder, project_structure, filename_to_path, goal,
+                                   top_level_dir, client, stream, journal, staging)
+            for step, problems in targets), return_exceptions=True)
+        for (step, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                log_event(f"Failed to regenerate {step.path}: {result}", level='error')
+            elif result == 'ok':
+                repaired += 1
+    log_event(f"{len(errors)} files still fail validation.", level='error')
+    return {'repaired': repaired, 'invalid': len(errors)}
+
+async def _async_regenerate_step(step, problems, project_folder, project_structure, filename_to_path, goal,
+                                 top_level_dir, client, stream, journal, staging=None):
+    # 在步骤的细节中附上校验错误，直接写入项目目录（计划已经执行完成，不再暂存；生成归档时写入归档的暂存区）
+    details = '\n'.join(f"  {problem}" for problem in problems)
+    repair = PlanStep(StepOp.CREATE, f"{step.text}\n- The previous version of this file failed validation:\n"
+                                     f"{details}\n- Fix these problems and write the complete file again.",
+                      path=step.path, filename=step.filename, context=step.context, sources=step.sources,
+                      size=step.size)
+    outcome = await async_execute_step(repair, project_folder, project_structure, filename_to_path, goal, top_level_dir,
+                                       client, stream, staging.index if staging is not None else None, staging)
+    if journal is not None and outcome == 'ok':
+        # 以原来的步骤记录修复后的内容，继续运行时复用修复后的文件；重新生成失败时磁盘上仍是旧文件，不记录
+        with open(os.path.join(project_folder, step.path), 'r', encoding='utf-8') as f:
+            journal.record_content(step, step.path, f.read())
+    return outcome
+
+async def async_main(goal=None, confirm=None, client=None, stream=None, trace_dir=None, output_root=None,
+                     pipeline=None, resume=None, update=None, plan_file=None, archive=None, log_handlers=None):
+    """
+    完整的生成流程。
+
+    参数:
+    - goal: 项目目标，为None时从标准输入读取
+    - confirm: 异步回调 confirm(prompt, data) -> bool，用于确认估算（data为文件大小字典）
+      和计划（data为步骤列表），默认从标准输入读取y/n
+    - client: AsyncGrokClient，为None时创建一个并在结束时关闭
+    - stream: 是否以流式方式生成文件内容，为None时使用 STREAM_GENERATION
+    - trace_dir: 导出追踪数据和指标的目录，为None时使用 TRACE_DIR
+    - output_root: 在该目录下创建项目，为None时使用当前目录
+    - pipeline: 是否边生成计划边执行步骤，为None时使用 PIPELINED_PLANNING。
+      此时不再确认完整的计划：ConfirmPolicy 对每个到达的步骤检查，交互模式下在开始前询问一次
+    - resume: 项目目录，根据其中的运行日志继续上一次中断的运行（忽略 goal、output_root 和 pipeline）
+    - update: 项目目录，按新的 goal（为None时沿用上一次的目标）或编辑过的计划 plan_file 增量更新项目
+    - archive: 归档的路径或可写的二进制文件对象，把项目直接写入tar.gz（路径以 .zip 结尾时为zip）
+      而不创建项目目录，此时返回 archive
+    - log_handlers: 这次运行的事件处理器列表，为None时使用 default_log_handlers()（控制台，LOG_FILE 设置时加上JSONL文件）
+
+    返回项目目录，流程中止时返回None
+    """
+    trace_dir = TRACE_DIR if trace_dir is None else trace_dir
+    if resume:
+        run = _resume_pipeline(resume, confirm, client, stream)
+    elif update:
+        run = _update_pipeline(update, goal, plan_file, confirm, client, stream)
+    else:
+        run = _run_pipeline(goal, confirm, client, stream, output_root, pipeline, archive)
+    # 对冲的预算和延迟记录、事件日志属于这一次运行
+    token = _current_hedger.set(Hedger() if HEDGE_PERCENTILE is not None else None)
+    events = EventLog(log_handlers)
+    events_token = _current_events.set(events)
+    try:
+        if not trace_dir:
+            return await run
+
+        tracer = Tracer()
+        with use_tracer(tracer):
+            try:
+                with trace_span('run'):
+                    return await run
+            finally:
+                tracer.export(trace_dir)
+                _print_trace_summary(tracer, trace_dir)
+    finally:
+        _current_events.reset(events_token)
+        _current_hedger.reset(token)
+        await asyncio.get_running_loop().run_in_executor(None, events.flush)
+
+def _print_trace_summary(tracer, trace_dir):
+    log_event("\nStage timings:")
+    for name, (count, total) in sorted(tracer.stage_summary().items(), key=lambda item: -item[1][1]):
+        log_event(f"{name}: {count} x, {total:.2f}s")
+    prompt_tokens = sum(span['attrs'].get('prompt_tokens', 0) for span in tracer.spans)
+    completion_tokens = sum(span['attrs'].get('completion_tokens', 0) for span in tracer.spans)
+    log_event(f"Tokens: {prompt_tokens} prompt, {completion_tokens} completion")
+    log_event(f"Trace written to: {trace_dir}")
+
+async def _run_pipeline(goal, confirm, client, stream, output_root=None, pipeline=None, archive=None):
+    confirm = confirm or _confirm_from_input
+    stream = STREAM_GENERATION if stream is None else stream
+    pipeline = PIPELINED_PLANNING if pipeline is None else pipeline
+    own_client = client is None
+    client = client or default_async_client()
+    journal = None
+    try:
+        if goal is None:
+            goal = await _ainput("Please enter your software development goal:\n")
+        plan_index = get_plan_index()
+        reused = None
+        if plan_index is not None:
+            reused, similarity = plan_index.lookup(goal)
+            if reused is not None:
+                log_event(f"\nReusing the structure and plan of a similar goal ({similarity:.2f}): {reused['goal']}")
+        project_structure, file_sizes = await _plan_structure(goal, confirm, client, reused)
+        if not project_structure:
+            return None
+
+        staging = index = None
+        if archive is not None:
+            # 项目只存在于暂存区的临时目录中，执行和校验完成后按计划顺序写入归档，不创建项目目录（也没有运行日志），
+            # 也不读取当前目录中碰巧同名的目录。.replacement 占位文件不进入归档
+            project_folder, adjusted_structure, top_level_dir = create_project_folder(project_structure, output_root,
+                                                                                      create=False)
+            index = ProjectIndex(project_folder)
+            staging = StagingArea(project_folder, index, disk=False)
+            placeholders = placeholder_files(project_folder, adjusted_structure, replacements=False)
+            for path, content in placeholders.items():
+                staging.write(path, content)
+        else:
+            project_folder, adjusted_structure, top_level_dir = create_project_folder(project_structure, output_root)
+            create_directories(project_folder, adjusted_structure)
+            log_event("\nCreated project directories and placeholder files.")
+        filename_to_path = build_filename_to_path_mapping(adjusted_structure)
+        if RUN_JOURNAL and archive is None:
+            journal = RunJournal.create(project_folder, goal, project_structure, file_sizes)
+
+        accept = None
+        if reused is not None:
+            # 计划已经有了，不需要边生成边执行
+            pipeline = False
+        if pipeline:
+            if isinstance(confirm, ConfirmPolicy):
+                accept = confirm.accept_steps
+            elif not await confirm("\nExecute plan steps as soon as they are generated, "
+                                   "without reviewing the full plan first? (y/n): "):
+                pipeline = False
+
+        if pipeline:
+            log_event("\nCreating a detailed plan and executing steps as they arrive...")
+            plan = []
+            summary = await async_execute_plan_stream(
+                async_stream_subtasks(goal, project_structure, file_sizes, client), plan, project_folder,
+                adjusted_structure, filename_to_path, goal, top_level_dir, client, file_sizes,
+                stream=stream, index=index, staged=staging, accept=accept, journal=journal)
+            _print_plan(plan)
+            if summary is None:
+                log_event("Operation cancelled.")
+                return None
+            if plan_index is not None:
+                plan_index.add(goal, project_structure, file_sizes, plan)
+            steps = compile_plan(plan, filename_to_path, top_level_dir, optimize=False)
+        else:
+            if reused is not None:
+                plan = reused['plan']
+            else:
+                log_event("\nCreating a detailed plan...")
+                # 将 file_sizes 传入 decompose_goal，促使AI考虑文件大小
+                plan = await async_decompose_goal(goal, project_structure, file_sizes, client)
+            _print_plan(plan)
+
+            if not await confirm("\nPlease confirm the above detailed plan is correct. Proceed? (y/n): ", plan):
+                log_event("Operation cancelled.")
+                return None
+            if journal is not None:
+                journal.record_plan(plan)
+            if plan_index is not None and reused is None:
+                plan_index.add(goal, project_structure, file_sizes, plan)
+            steps = _compile_for_run(plan, filename_to_path, top_level_dir, file_sizes)
+            summary = await async_execute_plan(steps, project_folder, adjusted_structure, filename_to_path, goal,
+                                               top_level_dir, client, file_sizes, stream=stream, index=index,
+                                               staged=staging, journal=journal)
+        if VALIDATE_OUTPUT:
+            summary = merge_summaries(summary, await async_repair_project(
+                steps, project_folder, adjusted_structure, filename_to_path, goal, top_level_dir, client, stream,
+                journal, staging=staging))
+        if archive is None:
+            _report_run(summary, client, project_folder, journal, steps)
+            return project_folder
+        location = _write_archive(staging, archive, os.path.basename(project_folder), steps,
+                                  [os.path.relpath(path, project_folder) for path in placeholders])
+        _report_run(summary, client, location, journal, steps)
+        return archive
+    finally:
+        if journal is not None:
+            journal.close()
+        if own_client:
+            await client.close()
+
+def _format_summary(summary):
+    parts = [f"{summary['steps']} steps, {summary['ok']} ok, {summary['skipped']} skipped, {summary['failed']} failed"]
+    if summary['failed_steps']:
+        parts.append(f"failed steps: {', '.join(map(str, summary['failed_steps'][:20]))}")
+    if 'invalid' in summary:
+        parts.append(f"{summary['repaired']} files repaired, {summary['invalid']} still invalid")
+    if 'deleted' in summary:
+        parts.append(f"{summary['deleted']} files deleted, {summary['kept']} kept")
+    return '; '.join(parts)
+
+def _write_archive(staging, archive, prefix, steps, placeholders=()):
+    """
+    把暂存区中的项目写入归档（路径或文件对象）：先是计划中各步骤写入的文件（按计划顺序），
+    再是没有步骤写入的占位文件（按路径排序）。返回用于显示的归档位置
+    """
+    sink = ArchiveSink(archive)
+    try:
+        count = staging.export(sink, prefix, [path for step in steps for path in step.writes()]
+                               + sorted(path.replace(os.sep, '/') for path in placeholders))
+        sink.close()
+    except BaseException:
+        sink.abort()
+        raise
+    finally:
+        staging.discard()
+    target = archive if isinstance(archive, str) else getattr(archive, 'name', 'the archive')
+    log_event(f"Wrote {count} files to {target}")
+    return target
 
-def main():
-    goal = input("Please enter your software development goal:\n")
-    print("\nDetermining project directory structure...")
-    project_structure = determine_project_structure(goal)
+async def _plan_structure(goal, confirm, client, reused=None):
+    """
+    确定目录结构和文件大小估算并请用户确认，失败或被拒绝时返回 (None, None)。
+    reused 为 PlanIndex 中相似目标的条目时直接使用其中的结构和估算
+    """
+    file_sizes = None
+    if reused is not None:
+        project_structure, file_sizes = reused['structure'], reused['sizes']
+    elif COMBINED_PLANNING:
+        log_event("\nDetermining project directory structure and file sizes...")
+        project_structure, file_sizes = await async_plan_project(goal, client)
+    else:
+        log_event("\nDetermining project directory structure...")
+        project_structure = await async_determine_project_structure(goal, client)
     if not project_structure:
-        print("Failed to determine project structure. Exiting.")
-        return
+        log_event("Failed to determine project structure. Exiting.", 'error')
+        return None, None
     
-    print("\nProject Directory Structure:")
-    print(json.dumps(project_structure, indent=4))
+    log_event("\nProject Directory Structure:")
+    log_event(json.dumps(project_structure, indent=4))
     
-    print("\nEstimating file sizes...")
-    file_sizes = estimate_file_sizes(project_structure, goal)
+    if file_sizes is None:
+        log_event("\nEstimating file sizes...")
+        file_sizes = await async_estimate_file_sizes(project_structure, goal, client)
     
-    print("Estimated File Sizes:")
+    log_event("Estimated File Sizes:")
     for file, size in file_sizes.items():
-        print(f"{file}: {size}")
+        log_event(f"{file}: {size}")
     
-    proceed = input("\nDo these estimated file sizes look reasonable? Proceed? (y/n): ")
-    if proceed.lower() != 'y':
-        print("Please adjust the estimation or project structure.")
-        return
+    if not await confirm("\nDo these estimated file sizes look reasonable? Proceed? (y/n): ", file_sizes):
+        log_event("Please adjust the estimation or project structure.")
+        return None, None
+    return project_structure, file_sizes
+
+async def _resume_pipeline(project_folder, confirm, client, stream):
+    """根据项目目录中的运行日志继续上一次中断的运行"""
+    confirm = confirm or _confirm_from_input
+    stream = STREAM_GENERATION if stream is None else stream
+    own_client = client is None
+    client = client or default_async_client()
+    project_folder = os.path.abspath(project_folder)
+    journal = RunJournal.load(project_folder)
+    try:
+        goal = journal.run['goal']
+        project_structure = journal.run['structure']
+        file_sizes = journal.run['file_sizes']
+        top_level_dir = list(project_structure.keys())[0]
+        adjusted_structure = project_structure[top_level_dir]
+        create_directories(project_folder, adjusted_structure, overwrite=False)
+        filename_to_path = build_filename_to_path_mapping(adjusted_structure)
+        log_event(f"Resuming the run in {project_folder}\nGoal: {goal}")
+
+        plan = journal.plan
+        if plan is None:
+            log_event("\nThe previous run stopped before the plan was complete"
+                      + (f" ({len(journal.partial_plan)} steps had arrived)" if journal.partial_plan else "")
+                      + ", creating the plan again...")
+            plan = await async_decompose_goal(goal, project_structure, file_sizes, client)
+            _print_plan(plan)
+            if not await confirm("\nPlease confirm the above detailed plan is correct. Proceed? (y/n): ", plan):
+                log_event("Operation cancelled.")
+                return None
+            journal.record_plan(plan)
+
+        steps = _compile_for_run(plan, filename_to_path, top_level_dir, file_sizes, journal.optimized)
+        pending = journal.pending_steps(steps)
+        generated = sum(1 for step in steps if step.op is StepOp.CREATE) - len(pending)
+        log_event(f"\n{generated} files were already generated, {len(pending)} still need to be generated"
+                  + (f", continuing from step {pending[0] + 1}." if pending else "."))
+        summary = await _replay_steps(steps, project_folder, adjusted_structure, filename_to_path, goal,
+                                      top_level_dir, client, file_sizes, stream, journal)
+        if VALIDATE_OUTPUT:
+            summary = merge_summaries(summary, await async_repair_project(
+                steps, project_folder, adjusted_structure, filename_to_path, goal, top_level_dir, client, stream,
+                journal))
+        _report_run(summary, client, project_folder, journal, steps)
+        return project_folder
+    finally:
+        journal.close()
+        if own_client:
+            await client.close()
+
+async def _update_pipeline(project_folder, goal, plan_file, confirm, client, stream):
+    """
+    增量更新已经生成过的项目：与运行日志中上一次运行的目标、目录结构和计划比较，
+    只重新生成内容变化（新增或修改）的步骤，以及接口因此改变的文件的依赖方，其余文件保持不动。
+
+    - goal 与上一次不同时重新确定目录结构和计划；相同时沿用上一次的目录结构和计划
+    - plan_file 为编辑过的计划（格式与 .xai_journal/plan.txt 相同），给出时代替上面的计划
+    - 依赖关系来自已生成文件的导入和计划中引用的文件（project_dependencies）。
+      重新生成的文件接口（python_stub）不变时不再影响依赖它的文件
+    """
+    confirm = confirm or _confirm_from_input
+    stream = STREAM_GENERATION if stream is None else stream
+    own_client = client is None
+    client = client or default_async_client()
+    project_folder = os.path.abspath(project_folder)
+    journal = RunJournal.load(project_folder)
+    try:
+        previous = journal.run
+        goal = goal or previous['goal']
+        log_event(f"Updating the project in {project_folder}\nGoal: {goal}")
+        if goal != previous['goal']:
+            project_structure, file_sizes = await _plan_structure(goal, confirm, client)
+            if not project_structure:
+                return None
+        else:
+            project_structure, file_sizes = previous['structure'], previous['file_sizes']
+        top_level_dir = list(project_structure.keys())[0]
+        adjusted_structure = project_structure[top_level_dir]
+
+        if plan_file:
+            with open(plan_file, 'r', encoding='utf-8') as f:
+                plan = parse_subtasks(f.read())
+        elif goal != previous['goal'] or journal.plan is None:
+            log_event("\nCreating a detailed plan...")
+            plan = await async_decompose_goal(goal, project_structure, file_sizes, client)
+        else:
+            plan = journal.plan
+        _print_plan(plan)
+
+        filename_to_path = build_filename_to_path_mapping(adjusted_structure)
+        steps = _compile_for_run(plan, filename_to_path, top_level_dir, file_sizes)
+        changed = {step.path for step in steps if step.op is StepOp.CREATE and journal.content(step) is None}
+        written = set().union(*(step.writes() for step in steps))
+        structure_files = {_normalize_plan_path(path, top_level_dir) for path in filename_to_path.values()}
+        removed = sorted(path for path in journal.generated_files()
+                         if path not in written and path not in structure_files
+                         and os.path.exists(os.path.join(project_folder, path)))
+        if not changed and not removed:
+            if goal != previous['goal'] or plan != journal.plan:
+                journal.record_run(goal, project_structure, file_sizes)
+                journal.record_plan(plan)
+            log_event("\nNo files need to be regenerated.")
+            return project_folder
+        log_event(f"\n{len(changed)} files changed in the plan and will be regenerated"
+                  + (f", {len(removed)} files are no longer part of the project" if removed else "") + ":")
+        for path in sorted(changed):
+            log_event(f"  {path}")
+        for path in removed:
+            log_event(f"  {path} (remove)")
+        if not await confirm("\nRegenerate the changed files (and the files that depend on them)? (y/n): ",
+                             sorted(changed)):
+            log_event("Operation cancelled.")
+            return None
+
+        journal.record_run(goal, project_structure, file_sizes)
+        journal.record_plan(plan)
+        create_directories(project_folder, adjusted_structure, overwrite=False)
+        summary = merge_summaries(
+            _remove_stale_files(removed, project_folder, journal),
+            await _regenerate_changed(steps, changed, project_folder, adjusted_structure, filename_to_path,
+                                      goal, top_level_dir, client, file_sizes, stream, journal))
+        if VALIDATE_OUTPUT:
+            summary = merge_summaries(summary, await async_repair_project(
+                steps, project_folder, adjusted_structure, filename_to_path, goal, top_level_dir, client, stream,
+                journal))
+        _report_run(summary, client, project_folder, journal, steps)
+        return project_folder
+    finally:
+        journal.close()
+        if own_client:
+            await client.close()
+
+async def _replay_steps(steps, project_folder, project_structure, filename_to_path, goal, top_level_dir, client,
+                        file_sizes, stream, journal):
+    """
+    按运行日志重新执行 steps（已经生成过的内容直接复用）。被追加的文件在暂存区中清空，
+    和执行结果一起提交，执行失败时磁盘上的项目保持不变；STAGED_WRITES 为False时直接在磁盘上清空
+    """
+    index = ProjectIndex(project_folder).scan()
+    staging = _start_staging(project_folder, index, None)
+    journal.prepare_resume(steps, project_folder, staging)
+    try:
+        summary = await async_execute_plan(steps, project_folder, project_structure, filename_to_path, goal,
+                                           top_level_dir, client, file_sizes, stream=stream, index=index,
+                                           staged=staging if staging is not None else False, journal=journal)
+    except BaseException:
+        _discard_staging(staging)
+        raise
+    _commit_staging(staging, project_folder)
+    return summary
+
+def _remove_stale_files(paths, project_folder, journal):
+    # 只删除内容仍然与运行日志一致的文件，用户改动过的文件保留；返回删除和保留的文件数
+    deleted = kept = 0
+    recorded = journal.generated_files()
+    for path in paths:
+        full_path = os.path.join(project_folder, path)
+        content = _read_text(full_path)
+        if content is None:
+            continue
+        if RunJournal.content_hash(content) == recorded[path]:
+            os.remove(full_path)
+            log_event(f"Deleted file: {full_path}")
+            deleted += 1
+        else:
+            log_event(f"Kept {full_path}: it was edited after it was generated", level='warning')
+            kept += 1
+    return {'deleted': deleted, 'kept': kept}
+
+async def _regenerate_changed(steps, changed, project_folder, project_structure, filename_to_path, goal,
+                              top_level_dir, client, file_sizes, stream, journal):
+    """
+    分轮重新生成：第一轮是变化的文件；每一轮结束后，接口改变的文件的依赖方组成下一轮
+    （它们的步骤没有变化，先从运行日志中丢弃旧的内容）。每个文件最多重新生成一次。返回各轮摘要的合并
+    """
+    summary = plan_summary([])
+    dirty, forced, done = set(changed), set(), set()
+    wave = 1
+    while dirty:
+        subset = _steps_for_paths(steps, dirty)
+        if forced:
+            for step in subset:
+                if step.op is StepOp.CREATE:
+                    journal.invalidate(step)
+        before = {path: _read_text(os.path.join(project_folder, path)) for path in dirty}
+        log_event(f"\nRegenerating {len(dirty)} files (round {wave}): {', '.join(sorted(dirty))}")
+        summary = merge_summaries(summary, await _replay_steps(
+            subset, project_folder, project_structure, filename_to_path, goal, top_level_dir, client, file_sizes,
+            stream, journal))
+        done |= dirty
+        dependents = {}
+        for path, deps in project_dependencies(project_folder, steps).items():
+            for dep in deps:
+                dependents.setdefault(dep, set()).add(path)
+        affected = set()
+        for path in dirty:
+            after = _read_text(os.path.join(project_folder, path))
+            if _interface(path, before[path]) != _interface(path, after):
+                affected |= dependents.get(path, set())
+        owned = {step.path for step in steps if step.op is StepOp.CREATE} | {
+            step.dst for step in steps if step.op is StepOp.APPEND}
+        dirty = forced = (affected & owned) - done
+        wave += 1
+    return summary
+
+def _steps_for_paths(steps, paths):
+    # 生成 paths 中文件的步骤；由tmp分块追加而成的文件整条链重新执行（没有变化的分块从运行日志中复用）
+    selected = {i for i, step in enumerate(steps) if step.op is StepOp.CREATE and step.path in paths}
+    chunks = {steps[i].path for i in selected}
+    destinations = {step.dst for step in steps
+                    if step.op is StepOp.APPEND and (step.dst in paths or step.src in chunks)}
+    sources = {step.src for step in steps if step.op is StepOp.APPEND and step.dst in destinations}
+    for i, step in enumerate(steps):
+        if (step.op is StepOp.APPEND and step.dst in destinations) or (
+                step.op in (StepOp.CREATE, StepOp.DELETE) and step.path in sources):
+            selected.add(i)
+    return [steps[i] for i in sorted(selected)]
+
+def _read_text(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def _interface(path, content):
+    # 文件对依赖方可见的部分：Python文件为接口存根，其他文件为完整内容
+    if content is not None and path.endswith('.py'):
+        stub = python_stub(content)
+        if stub is not None:
+            return stub
+    return content
+
+def _compile_for_run(plan, filename_to_path, top_level_dir, file_sizes, optimize=True):
+    steps = compile_plan(plan, filename_to_path, top_level_dir, file_sizes, optimize)
+    if len(steps) != len(plan):
+        log_event(f"Optimized plan: {len(plan)} steps compiled to {len(steps)} steps")
+        for step in steps:
+            if len(step.sources) > 1:
+                log_event(f"  {step.task} (from {len(step.sources)} steps)")
+    return steps
+
+def _report_run(summary, client, project_folder, journal, steps):
+    # 每个事件在发生时已经输出过，这里只输出摘要和最近的错误
+    log_event("\nAll steps executed.")
+    log_event(f"Summary: {_format_summary(summary)}")
+    events = _current_events.get()
+    if events is not None and events.errors:
+        log_event("Recent errors:")
+        for message in events.errors:
+            log_event(f"  {message}")
+    if client.cache is not None:
+        stats = client.cache.stats()
+        log_event(f"Response cache: {stats['hits']} hits, {stats['misses']} misses")
+    plan_index = get_plan_index()
+    if plan_index is not None:
+        stats = plan_index.stats()
+        log_event(f"Plan cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} goals")
+    if isinstance(client, ModelRouter):
+        log_event(f"Model endpoints: {client.summary()}")
+    hedger = _current_hedger.get()
+    if hedger is not None and hedger.hedges:
+        log_event(f"Hedging: {hedger.summary()}")
+    limits = client.rate_limiter.snapshot()
+    if limits['waits'] or limits['rate_limited']:
+        log_event(f"Rate limiter: waited {limits['wait_time']:.1f}s over {limits['waits']} requests, "
+                  f"{limits['rate_limited']} 429 responses, concurrency now {limits['concurrency']}")
+    if journal is not None:
+        pending = journal.pending_steps(steps)
+        if pending:
+            log_event(f"\n{len(pending)} files could not be generated. "
+                      f"Run again with --resume {project_folder} to generate only those.")
+        else:
+            journal.finish()
+    log_event(f"\nYour project files are located in: {project_folder}")
 
-    project_folder, adjusted_structure, top_level_dir = create_project_folder(project_structure)
-    create_directories(project_folder, adjusted_structure)
-    print("\nCreated project directories and placeholder files.")
-    filename_to_path = build_filename_to_path_mapping(adjusted_structure)
+def _print_plan(plan):
+    log_event("\nDetailed Plan:")
+    if plan:
+        log_event(format_plan(plan).rstrip('\n'))
 
-    print("\nCreating a detailed plan...")
-    # 将 file_sizes 传入 decompose_goal，促使AI考虑文件大小
-    plan = decompose_goal(goal, project_structure, file_sizes)
-    print("\nDetailed Plan:")
+def format_plan(plan):
+    """把计划格式化为带序号的文本（parse_subtasks 可以读回同样的步骤）"""
+    text = []
     for i, step in enumerate(plan, 1):
         # 分割步骤的多行内容
         lines = step.split('\n')
-        # 打印主任务（第一行），移除可能存在的序号
+        # 主任务（第一行），移除可能存在的序号
         main_task = re.sub(r'^\d+\.\s*', '', lines[0].strip())
-        print(f"{i}. {main_task}")
-        # 打印子任务细节（其余行）
+        text.append(f"{i}. {main_task}\n")
+        # 子任务细节（其余行）
         for detail in lines[1:]:
             if detail.strip():
-                print(f"   {detail.strip()}")
+                text.append(f"   {detail.strip()}\n")
+    return ''.join(text)
+
+class ConfirmPolicy:
+    """
+    非交互模式下代替 y/n 输入的确认策略。
+
+    参数:
+    - approve: 为False时拒绝所有确认
+    - max_total_kb: 估算的文件总大小（KB）超过该值时拒绝
+    - max_files: 估算中的文件数超过该值时拒绝
+    - max_steps: 计划的步骤数超过该值时拒绝
+
+    被拒绝时 rejected 记录原因。
+    """
+
+    LIMITS = ('max_total_kb', 'max_files', 'max_steps')
+
+    def __init__(self, approve=True, max_total_kb=None, max_files=None, max_steps=None):
+        self.approve = approve
+        self.max_total_kb = max_total_kb
+        self.max_files = max_files
+        self.max_steps = max_steps
+        self.rejected = None
+
+    @classmethod
+    def from_dict(cls, options, ceiling=None):
+        """
+        从字典创建策略。ceiling 为批处理或服务的默认策略时它是上限：options 只能收紧限制，
+        不能放宽或去掉ceiling中的限制，也不能在ceiling拒绝时批准
+        """
+        options = options or {}
+        ceiling = ceiling or {}
+        for name, value in itertools.chain(options.items(), ceiling.items()):
+            if name in cls.LIMITS and value is not None and (isinstance(value, bool)
+                                                             or not isinstance(value, (int, float))):
+                raise Exception(f"Error: policy limit '{name}' must be a number")
+        limits = {}
+        for name in cls.LIMITS:
+            values = [value for value in (ceiling.get(name), options.get(name)) if value is not None]
+            limits[name] = min(values) if values else None
+        return cls(bool(ceiling.get('approve', True)) and bool(options.get('approve', True)), **limits)
+
+    def check(self, data):
+        if not self.approve:
+            return "confirmation policy rejects everything"
+        if isinstance(data, dict):
+            total_kb = sum(parse_size(size) for size in data.values()) / 1024
+            if self.max_total_kb is not None and total_kb > self.max_total_kb:
+                return f"estimated size {total_kb:.1f} KB exceeds {self.max_total_kb} KB"
+            if self.max_files is not None and len(data) > self.max_files:
+                return f"{len(data)} files exceed {self.max_files}"
+        elif isinstance(data, list):
+            if self.max_steps is not None and len(data) > self.max_steps:
+                return f"{len(data)} plan steps exceed {self.max_steps}"
+        return None
+
+    def accept_steps(self, plan):
+        """流水线模式下对正在生成的计划逐步检查，代替对完整计划的确认"""
+        reason = self.check(plan)
+        if reason:
+            log_event(f"Plan rejected (policy: {reason})")
+            self.rejected = reason
+        return reason is None
+
+    async def __call__(self, prompt, data=None):
+        reason = self.check(data)
+        log_event(f"{prompt.strip()} {'n' if reason else 'y'} (policy{': ' + reason if reason else ''})")
+        if reason:
+            self.rejected = reason
+        return reason is None
+
+def load_jobs(jobs_path):
+    """
+    读取JSONL格式的任务文件，每行一个任务:
+    {"id": "snake", "goal": "...", "stream": false, "pipeline": true, "policy": {"max_total_kb": 200}, "archive": "zip"}
+    只有 goal 是必需的，id 默认为行号。archive 为 "tar.gz" 或 "zip" 时项目写入输出目录中的 <id>.tar.gz / <id>.zip。
+    """
+    jobs = []
+    with open(jobs_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if not job.get('goal'):
+                raise Exception(f"Job on line {line_number} has no goal.")
+            job.setdefault('id', f"job_{line_number}")
+            jobs.append(job)
+    return jobs
+
+async def run_job(job, output_dir, client, semaphore, default_policy=None, trace=False, log_handlers=None):
+    """
+    运行一个批处理任务，返回结果记录：id、goal、status（ok/rejected/failed/cancelled）、
+    output、error、started、finished、wall_time。
+    任务的 policy 只能收紧 default_policy；log_handlers 传给 async_main
+    """
+    job_id = sanitize_filename(str(job['id']))
+    output_root = os.path.abspath(job.get('output_root') or os.path.join(output_dir, job_id))
+    record = {'id': job['id'], 'goal': job['goal'], 'status': 'failed', 'output': None, 'error': None}
+    archive = None
+    if job.get('archive'):
+        archive = os.path.join(output_root, f"{job_id}.{'zip' if job['archive'] == 'zip' else 'tar.gz'}")
+    async with semaphore:
+        record['started'] = time.time()
+        start = time.perf_counter()
+        try:
+            policy = ConfirmPolicy.from_dict(job.get('policy'), default_policy)
+            os.makedirs(output_root, exist_ok=True)
+            trace_dir = os.path.join(output_root, 'trace') if trace else ''
+            project_folder = await async_main(job['goal'], policy, client, stream=job.get('stream'),
+                                              trace_dir=trace_dir, output_root=output_root,
+                                              pipeline=job.get('pipeline'), archive=archive,
+                                              log_handlers=log_handlers)
+            if project_folder:
+                record.update(status='ok', output=project_folder)
+            elif policy.rejected:
+                record.update(status='rejected', error=policy.rejected)
+            else:
+                record['error'] = "Failed to determine project structure."
+        except asyncio.CancelledError:
+            record.update(status='cancelled')
+            raise
+        except Exception as e:
+            record['error'] = str(e)
+        finally:
+            record['finished'] = time.time()
+            record['wall_time'] = time.perf_counter() - start
+    return record
+
+async def run_batch(jobs_path, output_dir, max_concurrency=4, results_path=None, default_policy=None,
+                    client=None, trace=False):
+    """
+    非交互地批量生成项目：每个任务有自己的输出目录，最多 max_concurrency 个任务同时运行，
+    所有任务共享同一个API客户端。每个任务完成后把结果记录追加到 results_path（JSONL）。
+    进度记录到批处理自己的EventLog（运行ID为 batch）
+    """
+    async with process_events('batch'):
+        return await _run_batch(jobs_path, output_dir, max_concurrency, results_path, default_policy, client, trace)
+
+async def _run_batch(jobs_path, output_dir, max_concurrency, results_path, default_policy, client, trace):
+    jobs = load_jobs(jobs_path)
+    own_client = client is None
+    client = client or default_async_client(pool_size=max(100, max_concurrency * MAX_WORKERS))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results_file = open(results_path, 'a', encoding='utf-8') if results_path else None
+    records = []
+    try:
+        tasks = [asyncio.ensure_future(run_job(job, output_dir, client, semaphore, default_policy, trace))
+                 for job in jobs]
+        try:
+            for task in asyncio.as_completed(tasks):
+                record = await task
+                records.append(record)
+                log_event(f"[batch] {record['id']}: {record['status']} in {record['wall_time']:.1f}s"
+                          + (f" ({record['error']})" if record['error'] else ''), _job_level(record['status']),
+                          job=record['id'])
+                if results_file is not None:
+                    results_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    results_file.flush()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if results_file is not None:
+            results_file.close()
+        if own_client:
+            await client.close()
+    order = {job['id']: i for i, job in enumerate(jobs)}
+    records.sort(key=lambda record: order[record['id']])
+    ok = sum(record['status'] == 'ok' for record in records)
+    log_event(f"\nBatch finished: {ok}/{len(records)} projects generated.")
+    return records
+
+class ServiceError(Exception):
+    """生成服务拒绝一个请求，status 是返回给客户端的HTTP状态码"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ServiceJob:
+    """
+    生成服务中的一个任务：请求、状态、结果记录，以及最近 SERVICE_LOG_LINES 行输出。
+    任务本身是它那次运行的事件处理器，事件的消息就是任务的输出
+    """
+
+    synchronous = False
+
+    def __init__(self, job_id, request, requester, priority):
+        self.id = job_id
+        self.request = request
+        self.requester = requester
+        self.priority = priority
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.record = None
+        self.task = None
+        self.lines = collections.deque(maxlen=SERVICE_LOG_LINES)
+        self.line_count = 0
+        self._partial = ''
+        self.changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status not in ('queued', 'running')
+
+    def write(self, text):
+        with self.changed:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+            self.lines.extend(lines)
+            self.line_count += len(lines)
+            if lines:
+                self.changed.notify_all()
+        return len(text)
+
+    def handle(self, event):
+        self.write(event['message'] + '\n')
+
+    def flush(self):
+        pass
+
+    def finish(self, status, record=None):
+        with self.changed:
+            if self._partial:
+                self.lines.append(self._partial)
+                self.line_count += 1
+                self._partial = ''
+            self.status = status
+            self.record = record
+            self.changed.notify_all()
+
+    def read_logs(self, offset, wait=None):
+        """返回第 offset 行起的输出和下一次读取的offset；wait 秒内没有新输出且任务未结束时返回空列表"""
+        with self.changed:
+            if wait and offset >= self.line_count and not self.finished:
+                self.changed.wait(wait)
+            first = self.line_count - len(self.lines)
+            lines = list(itertools.islice(self.lines, max(offset - first, 0), None))
+            return lines, self.line_count
+
+    def to_dict(self):
+        return {'id': self.id, 'goal': self.request['goal'], 'client': self.requester, 'priority': self.priority,
+                'status': self.status, 'submitted': self.submitted, 'record': self.record}
+
+
+class GenerationService:
+    """
+    常驻的生成服务：通过本地HTTP接口提交目标、查询状态、读取日志和获取生成的文件。
+
+    任务按优先级（priority越大越先，相同时先进先出）排队，队列最多 queue_size 个任务，
+    每个客户端（按连接的对端地址区分）最多同时有 client_limit 个排队或运行中的任务。
+    请求中的 policy 只能在 default_policy 的基础上收紧限制。
+    workers 个任务同时运行，共享同一个API客户端、响应缓存和计划缓存。
+    收到SIGTERM/SIGINT后不再接受新任务，取消排队的任务，最多等待 drain_timeout 秒让运行中的任务完成，
+    之后取消它们（可以用 --resume 继续）。
+
+    接口:
+    - POST /jobs  {"goal", "priority", "stream", "pipeline", "policy", "archive"} -> 202 任务状态
+    - GET /jobs, GET /jobs/<id>, DELETE /jobs/<id>（取消）
+    - GET /jobs/<id>/logs?offset=N&follow=1  纯文本输出，follow时持续输出直到任务结束
+    - GET /jobs/<id>/files  生成的文件列表，GET /jobs/<id>/files/<path>  文件内容，
+      GET /jobs/<id>/archive  归档（提交时 archive 为 "tar.gz" 或 "zip"）
+    - GET /logs  服务自己最近的事件（任务状态等），纯文本
+    - GET /health, GET /metrics（OpenMetrics）
+    """
+
+    def __init__(self, output_dir, workers=4, queue_size=None, client_limit=None, default_policy=None,
+                 client=None, trace=False, drain_timeout=None):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.queue_size = SERVICE_QUEUE_SIZE if queue_size is None else queue_size
+        self.client_limit = SERVICE_CLIENT_LIMIT if client_limit is None else client_limit
+        self.default_policy = default_policy
+        self.client = client
+        self.trace = trace
+        self.drain_timeout = SERVICE_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        self.jobs = OrderedDict()
+        self.log = RingBufferLogHandler(SERVICE_LOG_LINES)
+        self.accepting = True
+        self.counts = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._available = None
+        self._stopping = None
+
+    def submit(self, request, requester='local'):
+        """
+        把一个任务加入队列并返回它，请求无效或超出限制时抛出ServiceError。
+        requester 是服务确定的客户端标识（HTTP接口中为对端地址），不取自请求内容
+        """
+        if not isinstance(request, dict) or not isinstance(request.get('goal'), str) or not request['goal'].strip():
+            raise ServiceError(400, "Error: the request needs a goal")
+        try:
+            priority = int(request.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ServiceError(400, "Error: priority must be an integer")
+        if request.get('policy') is not None:
+            if not isinstance(request['policy'], dict):
+                raise ServiceError(400, "Error: policy must be an object")
+            try:
+                ConfirmPolicy.from_dict(request['policy'], self.default_policy)
+            except Exception as e:
+                raise ServiceError(400, str(e))
+        # 输出目录由服务决定
+        request = {key: request[key] for key in ('goal', 'stream', 'pipeline', 'policy', 'archive') if key in request}
+        with self._lock:
+            if not self.accepting:
+                raise ServiceError(503, "Error: the service is shutting down")
+            active = [job for job in self.jobs.values() if not job.finished]
+            if sum(job.status == 'queued' for job in active) >= self.queue_size:
+                raise ServiceError(503, f"Error: the queue is full ({self.queue_size} jobs)")
+            if sum(job.requester == requester for job in active) >= self.client_limit:
+                raise ServiceError(429, f"Error: client '{requester}' already has {self.client_limit} active jobs")
+            job = ServiceJob(uuid.uuid4().hex[:12], request, requester, priority)
+            self.jobs[job.id] = job
+            heapq.heappush(self._heap, (-priority, next(self._sequence), job))
+            self._count('submitted')
+            self._forget_finished()
+        self._loop.call_soon_threadsafe(self._available.release)
+        return job
+
+    def _count(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - SERVICE_KEEP_FINISHED, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ServiceError(404, f"Error: no job '{job_id}'")
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        with self._lock:
+            if job.status == 'queued':
+                job.finish('cancelled')
+                self._count('cancelled')
+            elif job.status == 'running' and job.task is not None:
+                self._loop.call_soon_threadsafe(job.task.cancel)
+        return job
+
+    def health(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {'status': 'ok' if self.accepting else 'draining', 'workers': self.workers,
+                'queued': statuses.count('queued'), 'running': statuses.count('running')}
+
+    def metrics(self):
+        """返回OpenMetrics文本格式的任务计数、队列长度以及API客户端的统计"""
+        health = self.health()
+        with self._lock:
+            counts = dict(self.counts)
+        lines = ['# TYPE xai_service_submitted counter', f"xai_service_submitted_total {counts.pop('submitted', 0)}",
+                 '# TYPE xai_service_jobs counter']
+        for status, value in sorted(counts.items()):
+            lines.append(f'xai_service_jobs_total{{status="{status}"}} {value}')
+        lines += ['# TYPE xai_service_queued gauge', f"xai_service_queued {health['queued']}",
+                  '# TYPE xai_service_running gauge', f"xai_service_running {health['running']}"]
+        limits = self.client.rate_limiter.snapshot()
+        lines += ['# TYPE xai_rate_limiter_concurrency gauge', f"xai_rate_limiter_concurrency {limits['concurrency']}",
+                  '# TYPE xai_rate_limiter_waits counter', f"xai_rate_limiter_waits_total {limits['waits']}",
+                  '# TYPE xai_rate_limited counter', f"xai_rate_limited_total {limits['rate_limited']}"]
+        if self.client.cache is not None:
+            stats = self.client.cache.stats()
+            lines += ['# TYPE xai_cache_hits counter', f"xai_cache_hits_total {stats['hits']}",
+                      '# TYPE xai_cache_misses counter', f"xai_cache_misses_total {stats['misses']}"]
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    async def _worker(self, semaphore):
+        while True:
+            await self._available.acquire()
+            with self._lock:
+                _, _, job = heapq.heappop(self._heap)
+                if job.status != 'queued':
+                    continue
+                job.status = 'running'
+            job.task = asyncio.ensure_future(self._run(job, semaphore))
+            await asyncio.wait({job.task})
+
+    async def _run(self, job, semaphore):
+        # 任务的事件写入任务自己的输出（以及 LOG_FILE），不输出到服务的控制台
+        try:
+            record = await run_job(dict(job.request, id=job.id), self.output_dir, self.client, semaphore,
+                                   self.default_policy, self.trace, [job] + default_log_handlers(console=False))
+        except asyncio.CancelledError:
+            record = {'id': job.id, 'goal': job.request['goal'], 'status': 'cancelled', 'output': None,
+                      'error': None}
+        with self._lock:
+            self._count(record['status'])
+        job.finish(record['status'], record)
+        log_event(f"[serve] {job.id}: {record['status']}" + (f" ({record['error']})" if record['error'] else ''),
+                  _job_level(record['status']), job=job.id)
+
+    def stop(self):
+        """停止接受新任务并开始排空（可以从任意线程调用）"""
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """运行服务直到 stop() 或收到SIGTERM/SIGINT。服务自己的事件（运行ID为 service）也保留在 self.log 中"""
+        async with process_events('service', default_log_handlers() + [self.log]):
+            await self._serve(host, port)
+
+    async def _serve(self, host, port):
+        self._loop = asyncio.get_running_loop()
+        self._available = asyncio.Semaphore(0)
+        self._stopping = asyncio.Event()
+        own_client = self.client is None
+        self.client = self.client or default_async_client(pool_size=max(100, self.workers * MAX_WORKERS))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        server = ThreadingHTTPServer((host, port), _ServiceHandler)
+        server.daemon_threads = True
+        server.service = self
+        self.address = server.server_address
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        semaphore = asyncio.Semaphore(self.workers)
+        workers = [asyncio.ensure_future(self._worker(semaphore)) for _ in range(self.workers)]
+        log_event(f"Generation service listening on http://{self.address[0]}:{self.address[1]}")
+        try:
+            await self._stopping.wait()
+            log_event("Draining: no new jobs are accepted.", 'warning')
+            await self._drain()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            server.shutdown()
+            server.server_close()
+            if own_client:
+                await self.client.close()
+
+    async def _drain(self):
+        with self._lock:
+            self.accepting = False
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.status == 'queued':
+                job.finish('cancelled')
+                self._count('cancelled')
+        running = [job.task for job in jobs if job.status == 'running' and job.task is not None]
+        if running:
+            log_event(f"Waiting up to {self.drain_timeout}s for {len(running)} running jobs...")
+            _, pending = await asyncio.wait(running, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
 
-    proceed = input("\nPlease confirm the above detailed plan is correct. Proceed? (y/n): ")
-    if proceed.lower() != 'y':
-        print("Operation cancelled.")
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """GenerationService的HTTP接口"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data, ensure_ascii=False))
+
+    def _route(self, method):
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/') if part]
+        try:
+            if method == 'GET' and parts == ['health']:
+                return self._send_json(200, service.health())
+            if method == 'GET' and parts == ['logs']:
+                return self._send(200, ''.join(event['message'].strip('\n') + '\n'
+                                               for event in list(service.log.events)),
+                                  'text/plain; charset=utf-8')
+            if method == 'GET' and parts == ['metrics']:
+                return self._send(200, service.metrics(), 'application/openmetrics-text; version=1.0.0')
+            if parts == ['jobs'] and method == 'POST':
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    raise ServiceError(400, "Error: the body is not valid JSON")
+                # 按对端地址限制，请求头和请求内容由客户端决定，不能用来区分客户端
+                job = service.submit(request, self.client_address[0])
+                return self._send_json(202, job.to_dict())
+            if parts == ['jobs'] and method == 'GET':
+                with service._lock:
+                    jobs = [job.to_dict() for job in service.jobs.values()]
+                return self._send_json(200, jobs)
+            if len(parts) >= 2 and parts[0] == 'jobs':
+                job = service.get(parts[1])
+                if len(parts) == 2 and method == 'GET':
+                    return self._send_json(200, job.to_dict())
+                if len(parts) == 2 and method == 'DELETE':
+                    return self._send_json(200, service.cancel(job.id).to_dict())
+                if parts[2:] == ['logs'] and method == 'GET':
+                    return self._send_logs(job, int(query.get('offset', ['0'])[0]), query.get('follow') == ['1'])
+                if parts[2:3] == ['files'] and method == 'GET':
+                    return self._send_files(job, '/'.join(parts[3:]))
+                if parts[2:] == ['archive'] and method == 'GET':
+                    return self._send_archive(job)
+            raise ServiceError(404, f"Error: no route for {method} {url.path}")
+        except ServiceError as e:
+            self._send_json(e.status, {'error': str(e)})
+        except ValueError as e:
+            self._send_json(400, {'error': f"Error: {e}"})
+
+    def _send_logs(self, job, offset, follow):
+        if not follow:
+            lines, offset = job.read_logs(offset)
+            self.send_response(200)
+            self.send_header('X-Log-Offset', str(offset))
+            data = ''.join(line + '\n' for line in lines).encode('utf-8')
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        # 没有Content-Length，任务结束后关闭连接
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        while True:
+            finished = job.finished
+            lines, offset = job.read_logs(offset, wait=1.0)
+            if lines:
+                self.wfile.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+                self.wfile.flush()
+            elif finished:
+                return
+
+    def _send_archive(self, job):
+        output = (job.record or {}).get('output')
+        if not output or not os.path.isfile(output):
+            raise ServiceError(409, f"Error: job '{job.id}' has no archive ({job.status})")
+        content_type = 'application/zip' if output.endswith('.zip') else 'application/gzip'
+        with open(output, 'rb') as f:
+            self._send(200, f.read(), content_type)
+
+    def _send_files(self, job, relative_path):
+        output = (job.record or {}).get('output')
+        if not output or not os.path.isdir(output):
+            raise ServiceError(409, f"Error: job '{job.id}' has no output folder ({job.status})")
+        root = os.path.realpath(output)
+        if not relative_path:
+            files = []
+            for folder, dirs, names in os.walk(root):
+                dirs[:] = [name for name in dirs if name != RunJournal.DIRNAME]
+                files += [os.path.relpath(os.path.join(folder, name), root) for name in names]
+            return self._send_json(200, sorted(files))
+        path = os.path.realpath(os.path.join(root, relative_path))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            raise ServiceError(404, f"Error: no file '{relative_path}'")
+        with open(path, 'rb') as f:
+            self._send(200, f.read(), 'application/octet-stream')
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Python projects with the xAI API.')
+    parser.add_argument('--batch', metavar='JOBS_JSONL', help='generate every goal in a JSONL job file')
+    parser.add_argument('--serve', metavar='PORT', type=int,
+                        help='run as a service with an HTTP API for submitting goals on this port')
+    parser.add_argument('--host', default='127.0.0.1', help='service mode: address to listen on')
+    parser.add_argument('--output-dir', default='.', help='batch and service mode: root directory for the projects')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='batch and service mode: projects generated at once')
+    parser.add_argument('--results', help='batch mode: append a JSONL result record per job to this file')
+    parser.add_argument('--policy', default='{}',
+                        help='batch and service mode: confirmation policy as JSON that jobs can only tighten, '
+                             'e.g. \'{"max_total_kb": 200}\'')
+    parser.add_argument('--trace', action='store_true', help='batch and service mode: export a trace per job')
+    parser.add_argument('--resume', metavar='PROJECT_DIR',
+                        help='continue an interrupted run from the journal in its project folder')
+    parser.add_argument('--update', metavar='PROJECT_DIR',
+                        help='regenerate only what changed in a previously generated project')
+    parser.add_argument('--goal', help='the goal; in update mode the new goal (default: keep the previous one)')
+    parser.add_argument('--archive', metavar='ARCHIVE',
+                        help='write the project straight into this .tar.gz or .zip instead of a folder')
+    parser.add_argument('--plan', metavar='PLAN_FILE',
+                        help='update mode: an edited copy of <project>/.xai_journal/plan.txt')
+    parser.add_argument('--log-file', metavar='LOG_JSONL',
+                        help='also append structured run events to this JSONL file (rotated by size)')
+    parser.add_argument('--log-level', choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get), help='minimum event level')
+    parser.add_argument('--combined-planning', action='store_true',
+                        help='get the structure and file sizes from one structured-output (JSON schema) call')
+    args = parser.parse_args(argv)
+
+    global LOG_FILE, LOG_LEVEL, COMBINED_PLANNING
+    LOG_FILE = args.log_file or LOG_FILE
+    LOG_LEVEL = args.log_level or LOG_LEVEL
+    COMBINED_PLANNING = args.combined_planning or COMBINED_PLANNING
+
+    if args.serve is not None:
+        service = GenerationService(args.output_dir, args.concurrency, default_policy=json.loads(args.policy),
+                                    trace=args.trace)
+        asyncio.run(service.serve(args.host, args.serve))
+        return
+    if args.batch:
+        asyncio.run(run_batch(args.batch, args.output_dir, args.concurrency, args.results,
+                              json.loads(args.policy), trace=args.trace))
         return
-    logs = execute_plan(plan, project_folder, adjusted_structure, filename_to_path, goal, top_level_dir)
-    print("\nAll steps executed.")
-    print("\nExecution logs:")
-    for log in logs:
-        print(log)
-    print(f"\nYour project files are located in: {project_folder}")
+    asyncio.run(async_main(args.goal, resume=args.resume, update=args.update, plan_file=args.plan,
+                           archive=args.archive))
 
 if __name__ == "__main__":
     main()